@@ -1,8 +1,11 @@
 # This module is compatible with Python 3.7 #
 import sys, os
 import math
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 
-from scipy import stats  # For the p value calculation function.
+import numpy as np
+from scipy import special  # For the p value calculation function.
 
 sys.path.append(os.environ.get("BBLAB_UTIL_PATH", "fail"))
 import sequence_utils
@@ -11,61 +14,255 @@ import math_utils
 sys.path.append(os.environ.get("BBLAB_OP_PATH", "fail"))
 import op_qvalue
 
+# Processes used to test the columns, 1 runs everything in the calling process and 0 uses every core.
+WORKERS = int(os.environ.get("BBLAB_CODON_BY_CODON_WORKERS", "1"))
+MIN_SHARD_COLUMNS = 64  # Smaller alignments aren't worth starting processes for.
 
-def get_output_matrix(protein_sequences, min_count):
-    """
-    This function processes the inputted protein sequence data and outputs a 'matrix'
-    containing all the data needed to construct the resulting excel file.
 
-    depends on: qvalue, sequence_utils, math_utils, scipy, numpy.
+# This function returns the median of a sorted array, like math_utils.median().
+def _sorted_median(values):
+    half_length = len(values) // 2
+    if len(values) % 2 == 0:
+        return float((values[half_length] + values[half_length - 1]) / 2)
+    return float(values[half_length])
+
+
+def _encode_alignment(protein_sequences):
+    """
+    Returns the phenotypes in sorted order, that order, the alignment as an integer matrix
+    (patient x column, in phenotype order), the alphabet and the number of non-mixture codes.
+    Amino acids get codes 0..n_valid-1 and mixtures (X, -, _) get the codes after that.
+    """
+    sequence_length = len(protein_sequences[0][1])
+    if any(len(seq[1]) != sequence_length for seq in protein_sequences):
+        raise ValueError("All protein sequences must be the same length.")
+
+    # Sort the patients by phenotype once, every column reuses this order.
+    decimals = np.array([float(seq[0]) for seq in protein_sequences])
+    order = np.argsort(decimals, kind="stable")
+    sorted_decimals = decimals[order]
+
+    text = "".join(protein_sequences[i][1] for i in order)
+    char_matrix = np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32).reshape(
+        len(protein_sequences), sequence_length
+    )
+    alphabet, codes = np.unique(char_matrix, return_inverse=True)
+    alphabet = [chr(c) for c in alphabet]
+    is_mixture = np.array([c in sequence_utils.protein_mixture_list for c in alphabet])
+    code_order = np.argsort(is_mixture, kind="stable")
+    recode = np.empty(len(alphabet), dtype=np.intp)
+    recode[code_order] = np.arange(len(alphabet))
+    alphabet = [alphabet[c] for c in code_order]
+    n_valid_codes = int(np.sum(~is_mixture))
+    dtype = np.uint8 if len(alphabet) <= 256 else np.uint16
+    codes = recode[codes.reshape(char_matrix.shape)].astype(dtype)
+
+    return sorted_decimals, order, codes, alphabet, n_valid_codes
+
+
+def _column_rows(sorted_decimals, order, codes, alphabet, n_valid_codes, min_count, first_column=0):
     """
+    Tests every column of codes, which starts at column first_column of the alignment.
+    Returns one (coord, amino, with median, not with median, with count, not with count, p-value)
+    tuple per tested amino acid, in column order and first-appearance order within a column.
+    """
+    sequence_length = codes.shape[1]
+    valid = codes < n_valid_codes
+
+    ##### Ranks of every patient within its column (mixtures are left out of a column's ranking).
+
+    # Tied phenotypes share the average of their ranks, as in scipy.stats.rankdata.
+    tie_starts = np.flatnonzero(
+        np.r_[True, sorted_decimals[1:] != sorted_decimals[:-1]]
+    )
+    tie_group = np.cumsum(np.r_[True, sorted_decimals[1:] != sorted_decimals[:-1]]) - 1
+    tie_counts = np.add.reduceat(valid.astype(np.int64), tie_starts, axis=0)
+    ties_before = np.cumsum(tie_counts, axis=0) - tie_counts
+    ranks = (ties_before + (tie_counts + 1) / 2.0)[tie_group]
+
+    column_totals = valid.sum(axis=0)  # Valid characters per column.
+    tie_counts = tie_counts.astype(np.float64)
+    size = column_totals.astype(np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        tie_correction = 1.0 - (tie_counts**3 - tie_counts).sum(axis=0) / (size**3 - size)
+
+    ##### Counts and rank sums for every (column, amino acid) group in one pass.
+
+    keys = (np.arange(sequence_length)[None, :] * n_valid_codes + codes)[valid]
+    n_keys = sequence_length * n_valid_codes
+    group_counts = np.bincount(keys, minlength=n_keys).reshape(
+        sequence_length, n_valid_codes
+    )
+    with_rank_sums = np.bincount(keys, weights=ranks[valid], minlength=n_keys).reshape(
+        sequence_length, n_valid_codes
+    )
+    total_rank_sums = np.sum(with_rank_sums, axis=1, keepdims=True)
+
+    distinct_chars = np.sum(group_counts > 0, axis=1)
+    not_with_counts = column_totals[:, None] - group_counts
+    tested = (
+        (distinct_chars[:, None] > 1)
+        & (group_counts > 0)
+        & (group_counts >= min_count)
+        & (not_with_counts >= min_count)
+    )
+
+    # Kruskal-Wallis H with tie correction, for two groups (with, not with).
+    totaln = column_totals[:, None].astype(np.float64)
+    not_with_rank_sums = total_rank_sums - with_rank_sums
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ssbn = (with_rank_sums * with_rank_sums) / group_counts
+        ssbn += (not_with_rank_sums * not_with_rank_sums) / not_with_counts
+        h_statistic = 12.0 / (totaln * (totaln + 1)) * ssbn - 3 * (totaln + 1)
+        h_statistic /= tie_correction[:, None]
+        raw_p_values = special.chdtrc(1, h_statistic)
+
+    ##### Build the output rows, in column order and first-appearance order of amino acids within a column.
+
+    first_seen = np.full((sequence_length, n_valid_codes), len(order))
+    input_rows = np.broadcast_to(order[:, None], codes.shape)
+    column_index = np.broadcast_to(np.arange(sequence_length)[None, :], codes.shape)
+    np.minimum.at(
+        first_seen, (column_index[valid], codes[valid]), input_rows[valid]
+    )
+
+    rows = []
+
+    for column in np.flatnonzero(tested.any(axis=1)):
+        # Valid patients of this column in phenotype order, grouped by amino acid.
+        column_valid = valid[:, column]
+        column_decimals = sorted_decimals[column_valid]
+        column_codes = codes[column_valid, column]
+        by_code = np.argsort(column_codes, kind="stable")
+        code_starts = np.searchsorted(column_codes[by_code], np.arange(n_valid_codes + 1))
+
+        for code in sorted(
+            np.flatnonzero(tested[column]), key=lambda c: first_seen[column, c]
+        ):
+            members = by_code[code_starts[code] : code_starts[code + 1]]
+            w_count = int(group_counts[column, code])
+            nw_count = int(not_with_counts[column, code])
+
+            # Values of this group are column_decimals[members], already sorted. The k-th smallest
+            # of the rest of the column is found by skipping the group members that come before it.
+            w_values = column_decimals[members]
+            skips = members - np.arange(len(members))
+            kth = np.array([0, (nw_count - 1) // 2, nw_count // 2, nw_count - 1])
+            nw_values = column_decimals[kth + np.searchsorted(skips, kth, side="right")]
+
+            w_median = _sorted_median(w_values)
+            if nw_count % 2 == 0:
+                nw_median = float((nw_values[2] + nw_values[1]) / 2)
+            else:
+                nw_median = float(nw_values[1])
 
-    ##### Class and function definitions
+            # Calculate p-value with proper validation
+            if w_count < 2 or nw_count < 2:
+                # Not enough data for meaningful statistical test
+                p_value = 1.0  # Non-significant p-value
+            elif w_values[0] == w_values[-1] and nw_values[0] == nw_values[3]:
+                # No variance in either group - no meaningful difference
+                p_value = 1.0
+            else:
+                raw_p_value = raw_p_values[column, code]
+                if (
+                    math.isnan(raw_p_value)
+                    or math.isinf(raw_p_value)
+                    or raw_p_value < 0
+                    or raw_p_value > 1
+                ):
+                    # Invalid p-value from statistical test
+                    p_value = 1.0  # Conservative non-significant value
+                else:
+                    p_value = math_utils.round_sf(raw_p_value, 5)
 
-    class ProteinData:
-        """
-        This class holds the data for a single protein character in its column column.
-        """
+            rows.append(
+                (
+                    first_column + int(column) + 1,
+                    alphabet[code],
+                    w_median,
+                    nw_median,
+                    w_count,
+                    nw_count,
+                    p_value,
+                )
+            )
 
-        def __init__(self, char, decimal_list):
-            self.protein_char = char
-            self.decimal_list = decimal_list
+    return rows
 
-        # This function returns how many times this protein characters appears by getting the data
-        # from the decimal value list's length.
-        def get_occurrances(self):
-            return len(self.decimal_list)
 
-    class ColumnData:
-        """
-        This class holds the ProteinData for everything in this column (of the input data).
-        """
 
-        # nw_protein_list is a list of ProteinData classes, while with_protein_data is just one.
-        def __init__(self, column_pos, w_protein_dat, nw_protein_list):
-            self.with_protein_data = w_protein_dat
-            self.not_with_protein_data_list = nw_protein_list
-            self.position = column_pos
+def _shard_rows(shm_name, shape, dtype, sorted_decimals, order, alphabet, n_valid_codes, min_count, start, stop):
+    """
+    Runs _column_rows() on columns start..stop of the alignment held in shared memory.
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        codes = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        rows = _column_rows(
+            sorted_decimals, order, codes[:, start:stop], alphabet, n_valid_codes, min_count, start
+        )
+        del codes
+        return rows
+    finally:
+        shm.close()
 
-        def get_with(self):
-            return self.with_protein_data
 
-        def get_not_with_list(self):
-            return self.not_with_protein_data_list
+def _parallel_rows(encoded, min_count, shards, workers):
+    """
+    Splits the columns into ranges tested by a pool of processes. The encoded alignment is put
+    in shared memory once instead of being pickled for every range, the rows are merged in column order.
+    """
+    sorted_decimals, order, codes, alphabet, n_valid_codes = encoded
+    bounds = np.linspace(0, codes.shape[1], shards + 1).astype(int)
+
+    shm = shared_memory.SharedMemory(create=True, size=max(codes.nbytes, 1))
+    try:
+        np.ndarray(codes.shape, dtype=codes.dtype, buffer=shm.buf)[:] = codes
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(
+                    _shard_rows,
+                    shm.name,
+                    codes.shape,
+                    codes.dtype,
+                    sorted_decimals,
+                    order,
+                    alphabet,
+                    n_valid_codes,
+                    min_count,
+                    int(start),
+                    int(stop),
+                )
+                for start, stop in zip(bounds[:-1], bounds[1:])
+            ]
+            rows = []
+            for future in futures:  # Submission order is column order.
+                rows.extend(future.result())
+        return rows
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def get_output_matrix(protein_sequences, min_count, workers=None):
+    """
+    This function processes the inputted protein sequence data and outputs a 'matrix'
+    containing all the data needed to construct the resulting excel file.
 
-        # This function gets all the decimal lists from not-with and combines them.
-        def get_not_with_decimal_list(self):
-            sum_decimal_list = []
-            for data in self.not_with_protein_data_list:
-                sum_decimal_list += data.decimal_list
-            return sum_decimal_list
+    For every column, each amino acid seen at least min_count times (with at least min_count
+    other amino acids) is compared against the rest of the column with a Kruskal-Wallis test.
+    The alignment is encoded once as an integer matrix and the phenotypes are sorted once,
+    then the rank sums and H statistics for all (column, amino acid) groups come from one
+    vectorized pass, computed the same way scipy.stats.kruskal does.
 
-        # This function gets all the occurrance values from not-with and combines them into one number.
-        def get_not_with_occurrances(self):
-            sum_occurrance_count = 0
-            for data in self.not_with_protein_data_list:
-                sum_occurrance_count += data.get_occurrances()
-            return sum_occurrance_count
+    Long alignments are split into column ranges tested by `workers` processes
+    (default BBLAB_CODON_BY_CODON_WORKERS), the result doesn't depend on the number of workers.
+
+    depends on: qvalue, sequence_utils, math_utils, scipy, numpy.
+    """
+
+    ##### Class and function definitions
 
     class ColumnOutput:
         """
@@ -105,153 +302,23 @@ def get_output_matrix(protein_sequences, min_count):
                 self.q_value,
             ]
 
-    # This function extracts and calculates the needed data from the ColumnData class.
-    def _run_seq_test(column_data, output_matrix):
-        w_amino = column_data.get_with().protein_char  # Get Protein char for with.
-
-        w_decimal_list = (
-            column_data.get_with().decimal_list
-        )  # Save the decimal list for later.
-        w_median = math_utils.median(w_decimal_list)
-
-        # Find the median of all not-with decimal values.
-        nw_decimal_list = column_data.get_not_with_decimal_list()
-        nw_median = math_utils.median(nw_decimal_list)
-
-        w_count = column_data.get_with().get_occurrances()
-        # Find the sum of all not-with occurance counts.
-        nw_count = column_data.get_not_with_occurrances()
-
-        # Calculate p-value with proper validation
-        try:
-            # Check if we have sufficient data for statistical test
-            if (
-                len(w_decimal_list) < 2
-                or len(nw_decimal_list) < 2
-                or len(w_decimal_list) == 0
-                or len(nw_decimal_list) == 0
-            ):
-                # Not enough data for meaningful statistical test
-                p_value = 1.0  # Non-significant p-value
-            else:
-                # Check if all values are identical (no variance)
-                w_variance = len(set(w_decimal_list)) > 1
-                nw_variance = len(set(nw_decimal_list)) > 1
+    ##### Test the columns.
 
-                if not w_variance and not nw_variance:
-                    # No variance in either group - no meaningful difference
-                    p_value = 1.0
-                else:
-                    # Perform Kruskal-Wallis test
-                    kruskal_result = stats.kruskal(w_decimal_list, nw_decimal_list)
-                    raw_p_value = kruskal_result[1]
-
-                    # Validate the result
-                    if (
-                        math.isnan(raw_p_value)
-                        or math.isinf(raw_p_value)
-                        or raw_p_value < 0
-                        or raw_p_value > 1
-                    ):
-                        # Invalid p-value from statistical test
-                        p_value = 1.0  # Conservative non-significant value
-                    else:
-                        p_value = math_utils.round_sf(raw_p_value, 5)
-        except Exception as e:
-            # Any error in statistical calculation - use conservative p-value
-            p_value = 1.0
-
-        # Put all this information into the ColumnOutput class.
-        output_column = ColumnOutput(
-            column_data.position + 1,
-            w_amino,
-            w_median,
-            nw_median,
-            w_count,
-            nw_count,
-            p_value,
-            -1,
-        )
-
-        # Send the output column to the output matrix.
-        output_matrix.append(output_column)
-
-    ##### Run tests on the given sequences.
-
-    sequence_length = len(
-        protein_sequences[0][1]
-    )  # Init the length to be the length of the first protein sequence.
-    output_matrix = []  # This matrix holds the data that will be added to the excel file.(and returned) This is a list of dictionaries, so... matrix?
-
-    # Iterate over each item in the sequences.
-    for column_index in range(sequence_length):
-        # Create and fill a list that contains all proteins at the current position and their decimal value.
-        codon_list = []  # -> [ (char, decimal), ... ]
-        for seq_index in range(len(protein_sequences)):
-            codon_list.append(
-                (
-                    protein_sequences[seq_index][1][column_index],
-                    protein_sequences[seq_index][0],
-                )
-            )  # list of -> (character, decimal)
-
-        # Count how many of each protein there is.
-        data_dict = {}  # This is a dict of ProteinData classes with char as the key. -> { char : ProteinData }
-        valid_characters = 0  # This holds how many valid characters were counted.  ( For checking validity. )
-        for tup in codon_list:
-            char = tup[0]
-            decimal = float(tup[1])
-
-            if (
-                char not in sequence_utils.protein_mixture_list
-            ):  # Make sure that invalid characters (mixtures) are not counted in this step.
-                valid_characters += 1
-
-                if char in data_dict:
-                    data_dict[char].decimal_list += [
-                        decimal
-                    ]  # Populate the decimal list.
-                else:
-                    data_dict[char] = ProteinData(
-                        char, [decimal]
-                    )  # Init the ProteinData class.
-
-        # Find the proteins that have an occurance value higher than minCount.
-        if (
-            len(data_dict) > 1
-        ):  # Case: there are at least two different proteins in this column.
-            valid_data = []
-
-            for char, data in data_dict.items():
-                with_count = data.get_occurrances()
-                not_with_count = valid_characters - with_count
-
-            for data in data_dict.values():
-                # Check if current char is a vaild group.
-                if (
-                    data.get_occurrances() >= min_count
-                    and valid_characters - data.get_occurrances() >= min_count
-                ):
-                    valid_data += [data]
-        else:
-            continue  # Case: all characters equal, ignore.
-
-        if len(valid_data) <= 0:
-            continue  # Case: no valid data groups.
+    encoded = _encode_alignment(protein_sequences)
+    sequence_length = encoded[2].shape[1]
 
-        # Do analysis
-        for index in range(0, len(valid_data)):
-            # Put with and not with into the same container.
-            data_dict.pop(valid_data[index].protein_char)  # Temp pop.
+    if workers is None:
+        workers = WORKERS
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+    shards = min(workers, sequence_length // MIN_SHARD_COLUMNS)
 
-            column_data = ColumnData(
-                column_index, valid_data[index], list(data_dict.values())
-            )
-            _run_seq_test(column_data, output_matrix)  # Run test on the data.
+    if shards > 1:
+        rows = _parallel_rows(encoded, min_count, shards, workers)
+    else:
+        rows = _column_rows(*encoded, min_count)
 
-            data_dict[valid_data[index].protein_char] = valid_data[
-                index
-            ]  # Add the item back to the dictionary.
+    output_matrix = [ColumnOutput(*row, -1) for row in rows]  # This matrix holds the data that will be added to the excel file.(and returned)
 
     # Generate qvalues using the entire list of pvalues.
 
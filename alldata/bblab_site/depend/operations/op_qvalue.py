@@ -1,23 +1,226 @@
 # This module is compatible with python 3.7 #
 
-import subprocess
-import tempfile
+import sys
 import os
+import math
 
+import numpy as np
+from scipy.interpolate import BSpline
 
-def get_qvalues(pvalues):
+sys.path.append(os.environ.get("BBLAB_UTIL_PATH", "fail"))
+import r_pool
+
+# Which implementation get_qvalues() uses: "python" (in-process, default) or "r" (R worker pool).
+QVALUE_ENGINE = os.environ.get("BBLAB_QVALUE_ENGINE", "python").lower()
+
+# Defaults of qval() in qvalue_calculate.r
+DEFAULT_LAMBDAS = np.arange(0, 19) * 0.05  # seq(0, 0.9, 0.05)
+
+# Golden section constant and tolerances of R's smooth.spline() spar search (sbart.c, contr.sp).
+_GOLDEN = 0.381966011250105151795413165634
+_SPAR_LOW, _SPAR_HIGH, _SPAR_TOL, _SPAR_EPS, _SPAR_MAXIT = -1.5, 1.5, 1e-4, 2e-8, 500
+
+
+def _smooth_spline_predict_last(x, y, df):
+    """
+    Fit R's smooth.spline(x, y, df=df) and return the fitted value at max(x).
+
+    x must be sorted and unique (it always is for a lambda grid). Follows R's
+    implementation: a cubic B-spline on all knots with x scaled to [0, 1],
+    lambda = ratio * 256^(3*spar - 1), and spar chosen by the same Brent
+    search that minimizes 3 + (df - trace(S))^2.
     """
-    This function uses the r script to convert a list of pvalues into
-    a list of qvalues.
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    xs = (x - x[0]) / (x[-1] - x[0])
+    knots = np.concatenate([[xs[0]] * 3, xs, [xs[-1]] * 3])
+    nk = len(knots) - 4
+
+    basis = BSpline.design_matrix(xs, knots, 3).toarray()
+    xwx = basis.T @ basis
+    xwy = basis.T @ y
+
+    # sigma[i, j] = integral of B_i''(t) B_j''(t) dt. B'' is linear on each interval, R's sgram.f
+    # integrates it piece by piece and uses .333 for 1/3, which is copied here so spar matches.
+    second = np.column_stack(
+        [BSpline(knots, np.eye(nk)[i], 3).derivative(2)(xs) for i in range(nk)]
+    )
+    sigma = np.zeros((nk, nk))
+    for left in range(len(xs) - 1):
+        width = xs[left + 1] - xs[left]
+        yw1 = second[left]
+        yw2 = second[left + 1] - yw1
+        sigma += width * (
+            np.outer(yw1, yw1)
+            + (np.outer(yw2, yw1) + np.outer(yw1, yw2)) * 0.5
+            + np.outer(yw2, yw2) * 0.333
+        )
+
+    ratio = np.trace(xwx[2 : nk - 3, 2 : nk - 3]) / np.trace(sigma[2 : nk - 3, 2 : nk - 3])
+
+    def fit(spar):
+        lam = ratio * 16.0 ** (spar * 6.0 - 2.0)
+        inverse = np.linalg.inv(xwx + lam * sigma)
+        trace = np.einsum("ij,jk,ik->", basis, inverse, basis)
+        return 3.0 + (df - trace) ** 2, inverse @ xwy
+
+    # Brent's fmin, as in R's sbart.c
+    a, b = _SPAR_LOW, _SPAR_HIGH
+    v = w = x_ = a + _GOLDEN * (b - a)
+    d = e = 0.0
+    fx, coef = fit(x_)
+    fv = fw = fx
+    iteration = 0
+    while True:
+        xm = (a + b) * 0.5
+        tol1 = _SPAR_EPS * abs(x_) + _SPAR_TOL / 3.0
+        tol2 = tol1 * 2.0
+        iteration += 1
+        if abs(x_ - xm) <= tol2 - (b - a) * 0.5 or iteration > _SPAR_MAXIT:
+            break
+
+        parabolic = False
+        if abs(e) > tol1:
+            r = (x_ - w) * (fx - fv)
+            q = (x_ - v) * (fx - fw)
+            p = (x_ - v) * q - (x_ - w) * r
+            q = (q - r) * 2.0
+            if q > 0.0:
+                p = -p
+            q = abs(q)
+            r = e
+            e = d
+            parabolic = abs(p) < abs(0.5 * q * r) and q * (a - x_) < p < q * (b - x_)
+            if parabolic:
+                d = p / q
+                u = x_ + d
+                if u - a < tol2 or b - u < tol2:
+                    d = math.copysign(tol1, xm - x_)
+        if not parabolic:
+            e = (a - x_) if x_ >= xm else (b - x_)
+            d = _GOLDEN * e
 
-    Depends On: R
+        u = x_ + (d if abs(d) >= tol1 else math.copysign(tol1, d))
+        fu, coef = fit(u)
+        if not math.isfinite(fu):
+            fu = 2e100
+        if fu <= fx:
+            if u >= x_:
+                a = x_
+            else:
+                b = x_
+            v, fv = w, fw
+            w, fw = x_, fx
+            x_, fx = u, fu
+        else:
+            if u < x_:
+                a = u
+            else:
+                b = u
+            if fu <= fw or w == x_:
+                v, fv = w, fw
+                w, fw = u, fu
+            elif fu <= fv or v == x_ or v == w:
+                v, fv = u, fu
+
+    # Like R, keep the coefficients of the last spar evaluated rather than refitting at the best one.
+    # Only the last B-spline is non-zero at the right boundary.
+    return coef[-1]
+
+
+def estimate_pi0(
+    pvalues,
+    lambdas=DEFAULT_LAMBDAS,
+    pi0_method="smoother",
+    smooth_df=3,
+    smooth_log_pi0=False,
+    rng=None,
+):
+    """
+    Estimate pi0, the proportion of true null hypotheses, like qval() in qvalue_calculate.r.
+    """
+    p = np.asarray(pvalues, dtype=float)
+    lambdas = np.atleast_1d(np.asarray(lambdas, dtype=float))
+
+    if len(lambdas) > 1 and len(lambdas) < 4:
+        raise ValueError("If length of lambda greater than 1, you need at least 4 values.")
+    if lambdas.min() < 0 or lambdas.max() >= 1:
+        raise ValueError("Lambda must be within [0, 1).")
+
+    if len(lambdas) == 1:
+        pi0 = np.mean(p >= lambdas[0]) / (1 - lambdas[0])
+        return min(pi0, 1.0)
+
+    pi0 = np.array([np.mean(p >= lam) for lam in lambdas]) / (1 - lambdas)
+
+    if pi0_method == "smoother":
+        if smooth_log_pi0:
+            pi0 = np.log(pi0)
+        pi0 = _smooth_spline_predict_last(lambdas, pi0, smooth_df)
+        if smooth_log_pi0:
+            pi0 = math.exp(pi0)
+        return min(pi0, 1.0)
+
+    elif pi0_method == "bootstrap":
+        rng = np.random.default_rng() if rng is None else rng
+        minpi0 = pi0.min()
+        mse = np.zeros(len(lambdas))
+        for _ in range(100):
+            p_boot = rng.choice(p, size=len(p), replace=True)
+            pi0_boot = np.array([np.mean(p_boot > lam) for lam in lambdas]) / (1 - lambdas)
+            mse += (pi0_boot - minpi0) ** 2
+        return min(pi0[mse == mse.min()].min(), 1.0)
+
+    raise ValueError("'pi0_method' must be one of 'smoother' or 'bootstrap'.")
+
+
+def calculate_qvalues(pvalues, pi0=None, robust=False, **pi0_options):
+    """
+    Convert p-values into Storey (2003) q-values, like qval() in qvalue_calculate.r.
+    Returns a NumPy array in the same order as pvalues.  pi0_options are passed to estimate_pi0().
+    """
+    p = np.asarray(pvalues, dtype=float)
+    m = len(p)
+    if m == 0:
+        return np.array([])
+    if p.min() < 0 or p.max() > 1:
+        raise ValueError("p-values not in valid range.")
+
+    if pi0 is None:
+        pi0 = estimate_pi0(p, **pi0_options)
+    if pi0 <= 0:
+        raise ValueError(
+            "The estimated pi0 <= 0. Check that you have valid p-values or use another lambda method."
+        )
+
+    # v = rank of each p-value, ties get the highest rank.
+    v = np.searchsorted(np.sort(p), p, side="right")
+    if robust:
+        qvalues = pi0 * m * p / (v * (1 - (1 - p) ** m))
+    else:
+        qvalues = pi0 * m * p / v
+
+    # Step down from the largest p-value, keeping q-values monotone and at most 1.
+    order = np.argsort(p, kind="stable")
+    qvalues[order] = np.minimum(np.minimum.accumulate(qvalues[order][::-1])[::-1], 1.0)
+    return qvalues
+
+
+def get_qvalues(pvalues, engine=None):
+    """
+    This function converts a list of pvalues into a list of qvalues.
+
+    engine is "python" (in-process) or "r" (qval() from qvalue_functions.r on a pooled R worker),
+    the default is set by the BBLAB_QVALUE_ENGINE environment variable.
+
+    Depends On: numpy, scipy (R for the "r" engine)
     """
     # v2025-07-02c: Maximum debug output for R script interaction
     # print(f"[DEBUG] get_qvalues called with {len(pvalues)} p-values")
     # print(f"[DEBUG] Raw p-values: {pvalues}")
 
     # Input validation and cleaning
-    if not pvalues:
+    if len(pvalues) == 0:
         # print("[DEBUG] No p-values provided, returning empty list")
         return []
 
@@ -41,8 +244,6 @@ def get_qvalues(pvalues):
                 # print(f"[DEBUG] P-value at index {i}: {pval} -> {pval_float}")
 
             # Check for invalid values
-            import math
-
             if (
                 math.isnan(pval_float)
                 or math.isinf(pval_float)
@@ -68,100 +269,18 @@ def get_qvalues(pvalues):
                 f"Invalid p-value after cleaning: {pval}. All p-values must be numeric and in range [0,1]"
             )
 
-    # This block runs the R script from the using the commandline and converts the console output into a list.
-    qvalues = []
-    r_script_path = "{}qvalue_calculate.r".format(
-        os.environ.get("BBLAB_R_PATH", "fail")
-    )
-    r_input = str(cleaned_pvalues)
+    if (engine or QVALUE_ENGINE) != "r":
+        return [float(q) for q in calculate_qvalues(cleaned_pvalues)]
 
-    # print(f"[DEBUG] R script path: {r_script_path}")
-    # print(f"[DEBUG] R script input: {r_input}")
-    # print(f"[DEBUG] R script input type: {type(r_input)}")
-    # print(f"[DEBUG] R script input length: {len(r_input)}")
+    # This block runs qval() on a pooled R worker (qvalue_worker.r), which answers with the q-values separated by spaces.
+    try:
+        output = r_pool.get_pool().run("qvalue", cleaned_pvalues)
+    except r_pool.RWorkerError as e:
+        raise RuntimeError(f"R worker failed: {e}")
 
-    with tempfile.TemporaryFile() as tmpf:
-        proc = subprocess.Popen(
-            ["Rscript", r_script_path, r_input], stdout=tmpf, stderr=subprocess.PIPE
+    qvalues = [float(q) for q in output.split()]
+    if len(qvalues) != len(cleaned_pvalues):
+        raise RuntimeError(
+            f"R worker returned {len(qvalues)} q-values but expected {len(cleaned_pvalues)}"
         )
-        _, stderr = proc.communicate()
-
-        # print(f"[DEBUG] R script return code: {proc.returncode}")
-
-        # Check for R script errors
-        if proc.returncode != 0:
-            stderr_msg = stderr.decode("utf-8") if stderr else "Unknown error"
-            print(f"[ERROR] R script failed with return code {proc.returncode}")
-            print(f"[ERROR] R script stderr: {stderr_msg}")
-            raise RuntimeError(
-                f"R script failed with return code {proc.returncode}. Input p-values: {cleaned_pvalues}. Error: {stderr_msg}"
-            )
-
-        tmpf.seek(0)
-        raw_output = tmpf.read().decode("utf-8").strip()
-
-        # print(f"[DEBUG] R script raw output length: {len(raw_output)}")
-        # print(f"[DEBUG] R script raw output (repr): {repr(raw_output)}")
-        # print(f"[DEBUG] R script raw output (formatted): '{raw_output}'")
-        # print(f"[DEBUG] R script stderr content: '{stderr.decode('utf-8') if stderr else 'None'}'")
-
-        # Handle empty output
-        if not raw_output:
-            print(
-                f"[ERROR] R script produced no output for input p-values: {cleaned_pvalues}"
-            )
-            raise RuntimeError(
-                f"R script produced no output for input p-values: {cleaned_pvalues}"
-            )
-
-        # Robust parsing: handle different R output formats
-        # R script returns space-separated values with a trailing comma: "0.1 0.2 0.3 ,"
-        if raw_output.endswith(","):
-            # Space-separated format with trailing comma
-            # print("[DEBUG] Parsing output as space-separated values with trailing comma")
-            # Remove trailing comma and split by space
-            clean_output = raw_output.rstrip(",").strip()
-            qvalue_strings = clean_output.split()
-        elif "," in raw_output and " " not in raw_output:
-            # Pure comma-separated format (no spaces): "0.1,0.2,0.3"
-            # print("[DEBUG] Parsing output as comma-separated values")
-            qvalue_strings = raw_output.split(",")
-        else:
-            # Space-separated format (old R versions): "0.1 0.2 0.3"
-            # print("[DEBUG] Parsing output as space-separated values")
-            qvalue_strings = raw_output.split()
-
-        # print(f"[DEBUG] Split into {len(qvalue_strings)} parts: {qvalue_strings}")
-
-        # Convert to floats, filtering empty strings
-        qvalues = []
-        for j, qstr in enumerate(qvalue_strings):
-            qstr = qstr.strip()
-            # print(f"[DEBUG] Processing q-value string {j}: '{qstr}'")
-            if qstr:
-                try:
-                    qval = float(qstr)
-                    # print(f"[DEBUG] Converted q-value {j}: '{qstr}' -> {qval}")
-                    qvalues.append(qval)
-                except ValueError as e:
-                    # Skip invalid values but log the issue
-                    print(
-                        f"[ERROR] Could not convert q-value {j}: '{qstr}' (error: {e})"
-                    )
-                    continue
-
-        # print(f"[DEBUG] Final parsed q-values: {qvalues}")
-
-        # Validate that we got the expected number of q-values
-        if len(qvalues) != len(cleaned_pvalues):
-            print(
-                f"[ERROR] R script returned {len(qvalues)} q-values but expected {len(cleaned_pvalues)}"
-            )
-            print(f"[ERROR] Input p-values ({len(cleaned_pvalues)}): {cleaned_pvalues}")
-            print(f"[ERROR] Output q-values ({len(qvalues)}): {qvalues}")
-            raise RuntimeError(
-                f"R script returned {len(qvalues)} q-values but expected {len(cleaned_pvalues)} (input p-values: {len(cleaned_pvalues)})"
-            )
-
-    # print(f"[DEBUG] Returning {len(qvalues)} q-values: {qvalues}")
     return qvalues
@@ -0,0 +1,32 @@
+# Long-lived worker for r_pool.py. Reads one job per line from stdin and answers with one line on stdout.
+#   request:  <function>\t<comma separated numbers>
+#   response: OK\t<space separated results>   or   ERROR\t<message>
+# Functions are loaded once at startup, so a job costs no R startup time.
+
+script_path <- sub("^--file=", "", grep("^--file=", commandArgs(trailingOnly=FALSE), value=TRUE))
+source(file.path(dirname(script_path), "qvalue_functions.r"))
+
+run_qvalue <- function(p) {
+    # qval() prints its errors and returns 0, keep them off the protocol stream.
+    messages <- capture.output(qobj <- qval(p))
+    if (!is.list(qobj)) stop(paste(messages, collapse=" "))
+    qobj$qvalues
+}
+
+jobs <- list(qvalue = run_qvalue)
+
+input <- file("stdin", open="r")
+repeat {
+    line <- readLines(input, n=1)
+    if (length(line) == 0) break  # stdin closed, the pool is shutting this worker down.
+
+    fields <- strsplit(line, "\t", fixed=TRUE)[[1]]
+    response <- tryCatch({
+        if (!(fields[1] %in% names(jobs))) stop(paste("unknown function", fields[1]))
+        values <- if (length(fields) > 1 && nchar(fields[2]) > 0) as.double(strsplit(fields[2], ",", fixed=TRUE)[[1]]) else double(0)
+        paste0("OK\t", paste(jobs[[fields[1]]](values), collapse=" "))
+    }, error = function(e) paste0("ERROR\t", gsub("[\t\n]", " ", conditionMessage(e))))
+
+    cat(response, "\n", sep="")
+    flush(stdout())
+}
@@ -1,7 +1,8 @@
 # Checked for python 3.7
 
-from django.http import HttpResponse
-import os, datetime
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.http import http_date
+import os, re, datetime, codecs
 
 # This function simulates the Apache directory indexes. Return this as
 # an HttpResponse.
@@ -72,3 +73,69 @@ def read_file(filename, dir, script_path):
         
         return HttpResponse("Invalid File")
 
+
+# This function returns a response that streams a file from disk in chunks, so large files are never
+# read into memory. Single "Range: bytes=..." requests are answered with the requested part (206),
+# so interrupted downloads can be resumed. on_complete() is called once the last byte has been sent.
+range_pattern = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+def file_response(request, path, content_type, filename, on_complete=None, chunk_size=64 * 1024):
+        size = os.path.getsize(path)
+        last_modified = http_date(os.path.getmtime(path))
+        start, end = 0, size - 1
+
+        range_header = request.META.get("HTTP_RANGE", "").strip()
+        if_range = request.META.get("HTTP_IF_RANGE", "").strip()
+        match = range_pattern.match(range_header)
+        partial = match is not None and match.group(0) != "bytes=-" and (if_range == "" or if_range == last_modified)
+        if partial:
+                first, last = match.groups()
+                if first == "":  # The last n bytes.
+                        start = max(size - int(last), 0)
+                else:
+                        start = int(first)
+                        if last != "":
+                                end = min(int(last), size - 1)
+                if start >= size or start > end:
+                        response = HttpResponse(status=416)
+                        response["Content-Range"] = "bytes */{}".format(size)
+                        return response
+
+        def stream():
+                remaining = end - start + 1
+                with open(path, "rb") as file:
+                        file.seek(start)
+                        while remaining > 0:
+                                chunk = file.read(min(chunk_size, remaining))
+                                if not chunk:
+                                        break
+                                remaining -= len(chunk)
+                                yield chunk
+                if remaining == 0 and end == size - 1 and on_complete is not None:
+                        on_complete()
+
+        response = StreamingHttpResponse(stream(), status=206 if partial else 200, content_type=content_type)
+        response["Content-Length"] = str(end - start + 1)
+        response["Accept-Ranges"] = "bytes"
+        response["Last-Modified"] = last_modified
+        response["Content-Disposition"] = "inline; filename={}".format(filename)
+        if partial:
+                response["Content-Range"] = "bytes {}-{}/{}".format(start, end, size)
+        return response
+
+# This function writes an uploaded file to path one chunk at a time, so an upload is never held in memory
+# (Django spools large uploads to a temporary file). The file only appears at path once it is complete.
+# Raises UnicodeDecodeError if the upload is not utf-8 text, leaving nothing behind.
+def save_upload(upload, path, chunk_size=64 * 1024):
+        part_path = path + ".part"
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        try:
+                with open(part_path, "wb") as file:
+                        for chunk in upload.chunks(chunk_size):
+                                decoder.decode(chunk)
+                                file.write(chunk)
+                        decoder.decode(b"", final=True)
+        except BaseException:
+                os.remove(part_path)
+                raise
+        os.replace(part_path, path)
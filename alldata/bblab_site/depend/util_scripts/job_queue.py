@@ -0,0 +1,434 @@
+# This module is compatible with python 3.7 #
+
+# A persistent job queue for the tools, so long analyses don't hold an apache worker for minutes.
+# Jobs are kept in a SQLite file (no broker needed) and survive mod_wsgi and worker restarts.
+# Views submit jobs with get_queue().submit(), worker processes are started with:
+#     python job_queue.py [--workers N]
+
+import os
+import sys
+import time
+import re
+import uuid
+import pickle
+import hashlib
+import shutil
+import signal
+import sqlite3
+import argparse
+import traceback
+import multiprocessing
+from contextlib import closing
+
+# Queue settings, these can be changed with environment variables.
+JOB_DIR = os.environ.get(
+    "BBLAB_JOB_DIR", os.path.join(os.environ.get("BBLAB_MEDIA_ROOT", "fail"), "jobs")
+)  # Holds the queue database and a directory per job for its uploaded files.
+JOB_DB = os.environ.get("BBLAB_JOB_DB", os.path.join(JOB_DIR, "jobs.sqlite3"))
+JOB_WORKERS = int(os.environ.get("BBLAB_JOB_WORKERS", "2"))  # Jobs that run at once.
+JOB_POLL_INTERVAL = float(os.environ.get("BBLAB_JOB_POLL_INTERVAL", "0.5"))  # Seconds an idle worker waits between checks.
+JOB_MAX_AGE = float(os.environ.get("BBLAB_JOB_MAX_AGE", str(7 * 24 * 3600)))  # Seconds finished jobs are kept.
+JOB_MAX_ATTEMPTS = 3  # A job whose worker died this many times is failed instead of being run again.
+JOB_FILE_NAME = re.compile(r"^[0-9a-f]{64}\.[0-9a-z]+$")  # Names of files saved with save_file().
+JOB_URL = "/django/tools/jobs/{}/"  # Page of a job (tools/jobs).
+FILE_URL = JOB_URL + "files/{}"  # A file saved with a job, see save_output().
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED_STATES = (DONE, FAILED, CANCELLED)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    payload BLOB NOT NULL,
+    status TEXT NOT NULL,
+    result BLOB,
+    error TEXT,
+    worker_pid INTEGER,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created REAL NOT NULL,
+    started REAL,
+    finished REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created);
+"""
+
+
+def save_file(directory, data, extension, gzipped=None):
+    """
+    Saves data (bytes or text) in directory, named by its sha256 and extension, and returns the name.
+    A name always refers to the same content, so the file can be cached for good and saving the
+    same output again (or from parallel requests) does nothing. gzipped, the data already gzipped,
+    is saved next to it as <name>.gz and sent instead to browsers that accept gzip.
+    """
+    if isinstance(data, str):
+        data = data.encode("utf8")
+    name = "{}.{}".format(hashlib.sha256(data).hexdigest(), extension)
+    path = os.path.join(directory, name)
+    os.makedirs(directory, exist_ok=True)
+    for file_path, content in ((path + ".gz", gzipped), (path, data)):  # The plain file last, it marks the name as saved.
+        if content is None or os.path.exists(file_path):
+            continue
+        part_path = "{}.{}.{}.part".format(file_path, os.getpid(), uuid.uuid4().hex)
+        with open(part_path, "wb") as file:
+            file.write(content)
+        os.replace(part_path, file_path)
+    return name
+
+
+class JobFile:
+    """
+    Stands in for an uploaded file in a job's arguments. The upload is saved in the job's
+    directory when the job is submitted, the worker opens it and passes the open (binary) file instead.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+
+class JobQueue:
+    """
+    Submits jobs, reports their state and hands them to workers. Every call opens its own
+    connection so a queue can be shared between threads and processes.
+    """
+
+    def __init__(self, path=JOB_DB, job_dir=JOB_DIR):
+        self.path = path
+        self.job_dir = job_dir
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        os.makedirs(job_dir, exist_ok=True)
+        with self._connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(_SCHEMA)
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        return closing(connection)
+
+    def job_path(self, job_id):
+        """
+        Returns the directory of a job, where its uploaded files are kept.
+        """
+        return os.path.join(self.job_dir, job_id)
+
+    def submit(self, function, *args, **kwargs):
+        """
+        Queues function(*args, **kwargs) and returns the job id. The function must be importable by the
+        workers (a module level function) and the arguments picklable, except for uploaded files
+        (anything with a .chunks() method) which are saved to the job directory first.
+        """
+        job_id = uuid.uuid4().hex
+        args = [self._save_upload(job_id, "arg{}".format(i), value) for i, value in enumerate(args)]
+        kwargs = {key: self._save_upload(job_id, key, value) for key, value in kwargs.items()}
+        payload = pickle.dumps((function, args, kwargs))
+        name = "{}.{}".format(function.__module__, function.__qualname__)
+
+        with self._connect() as connection:
+            connection.execute(
+                "INSERT INTO jobs (id, name, payload, status, created) VALUES (?, ?, ?, ?, ?)",
+                (job_id, name, payload, QUEUED, time.time()),
+            )
+        return job_id
+
+    def record(self, name, result):
+        """
+        Stores the result of work already done in the request (a job that is finished straight away),
+        so it gets a job page and directory like queued jobs. Returns the job id.
+        """
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._connect() as connection:
+            connection.execute(
+                "INSERT INTO jobs (id, name, payload, status, result, created, started, finished) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (job_id, name, pickle.dumps(None), DONE, pickle.dumps(result), now, now, now),
+            )
+        return job_id
+
+    def _save_upload(self, job_id, name, value):
+        if not hasattr(value, "chunks"):
+            return value
+        os.makedirs(self.job_path(job_id), exist_ok=True)
+        path = os.path.join(self.job_path(job_id), name)
+        with open(path, "wb") as file:
+            for chunk in value.chunks():
+                file.write(chunk)
+        return JobFile(path)
+
+    def get(self, job_id):
+        """
+        Returns a dict with the job's status, error, timestamps and queue position, or None for unknown jobs.
+        """
+        with self._connect() as connection:
+            row = connection.execute(
+                "SELECT id, name, status, error, attempts, created, started, finished FROM jobs WHERE id = ?",
+                (job_id,),
+            ).fetchone()
+            if row is None:
+                return None
+            job = dict(row)
+            job["position"] = 0
+            if job["status"] == QUEUED:
+                job["position"] = connection.execute(
+                    "SELECT COUNT(*) FROM jobs WHERE status = ? AND created <= ?",
+                    (QUEUED, job["created"]),
+                ).fetchone()[0]
+        return job
+
+    def result(self, job_id):
+        """
+        Returns what the job's function returned, None if it hasn't finished.
+        """
+        with self._connect() as connection:
+            row = connection.execute("SELECT result FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None or row["result"] is None:
+            return None
+        return pickle.loads(row["result"])
+
+    def cancel(self, job_id):
+        """
+        Cancels a job that hasn't started yet. Returns True if it was cancelled.
+        """
+        with self._connect() as connection:
+            cursor = connection.execute(
+                "UPDATE jobs SET status = ?, finished = ? WHERE id = ? AND status = ?",
+                (CANCELLED, time.time(), job_id, QUEUED),
+            )
+        return cursor.rowcount == 1
+
+    def claim(self, worker_pid):
+        """
+        Marks the oldest queued job as running for worker_pid. Returns (job_id, payload), or None if the queue is empty.
+        """
+        with self._connect() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = connection.execute(
+                    "SELECT id, payload FROM jobs WHERE status = ? ORDER BY created LIMIT 1", (QUEUED,)
+                ).fetchone()
+                if row is not None:
+                    connection.execute(
+                        "UPDATE jobs SET status = ?, worker_pid = ?, attempts = attempts + 1, started = ? WHERE id = ?",
+                        (RUNNING, worker_pid, time.time(), row["id"]),
+                    )
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+        return None if row is None else (row["id"], row["payload"])
+
+    def finish(self, job_id, result=None, error=None):
+        """
+        Stores the result of a job, or its error message when error is given.
+        """
+        status = DONE if error is None else FAILED
+        with self._connect() as connection:
+            connection.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, finished = ? WHERE id = ?",
+                (status, pickle.dumps(result), error, time.time(), job_id),
+            )
+
+    def requeue_orphans(self, live_pids=()):
+        """
+        Puts running jobs whose worker isn't in live_pids back in the queue, or fails them after
+        JOB_MAX_ATTEMPTS tries. Returns the number of jobs requeued.
+        """
+        live_pids = list(live_pids)
+        placeholders = ",".join("?" * len(live_pids))
+        orphaned = "status = ?" + (" AND worker_pid NOT IN ({})".format(placeholders) if live_pids else "")
+        with self._connect() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                connection.execute(
+                    "UPDATE jobs SET status = ?, error = ?, finished = ? WHERE {} AND attempts >= ?".format(orphaned),
+                    [FAILED, "The worker running this job stopped.", time.time(), RUNNING] + live_pids + [JOB_MAX_ATTEMPTS],
+                )
+                cursor = connection.execute(
+                    "UPDATE jobs SET status = ?, worker_pid = NULL WHERE {}".format(orphaned),
+                    [QUEUED, RUNNING] + live_pids,
+                )
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+        return cursor.rowcount
+
+    def cleanup(self, max_age=JOB_MAX_AGE):
+        """
+        Deletes finished jobs older than max_age seconds, with their directories.
+        """
+        cutoff = time.time() - max_age
+        with self._connect() as connection:
+            job_ids = [
+                row["id"]
+                for row in connection.execute(
+                    "SELECT id FROM jobs WHERE status IN (?, ?, ?) AND finished < ?", FINISHED_STATES + (cutoff,)
+                )
+            ]
+            connection.executemany("DELETE FROM jobs WHERE id = ?", [(job_id,) for job_id in job_ids])
+        for job_id in job_ids:
+            shutil.rmtree(self.job_path(job_id), ignore_errors=True)
+        return len(job_ids)
+
+    def stats(self):
+        """
+        Returns the number of jobs in each state.
+        """
+        with self._connect() as connection:
+            return {row[0]: row[1] for row in connection.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status")}
+
+
+_queue = None
+
+
+def get_queue():
+    """
+    Returns the queue shared by this process, stored at BBLAB_JOB_DB.
+    """
+    global _queue
+    if _queue is None:
+        _queue = JobQueue()
+    return _queue
+
+
+##### Workers
+
+
+_current_job_path = None
+
+
+def current_job_path():
+    """
+    Returns the directory of the job this process is running, for a job's function to keep files
+    in (like a result table, see result_table.store). None when not running a job.
+    """
+    return _current_job_path
+
+
+def save_output(name, data, extension, gzipped=None):
+    """
+    Saves an output file (like a plot) with the job that is running, or with a new finished job
+    named name for tools that run in the request, and returns its url (see save_file). The files
+    are deleted with their job (see JobQueue.cleanup).
+    """
+    directory = current_job_path()
+    if directory is None:
+        queue = get_queue()
+        directory = queue.job_path(queue.record(name, None))
+    file_name = save_file(directory, data, extension, gzipped)
+    return FILE_URL.format(os.path.basename(directory), file_name)
+
+
+def setup_django():
+    """
+    Sets Django up in a worker process, the tools use its settings (like the static file urls in
+    their pages). Does nothing where it is already set up, like in mod_wsgi.
+    """
+    import django
+    from django.apps import apps
+
+    if not apps.ready:
+        os.environ.setdefault("DJANGO_SETTINGS_MODULE", "bblab_site.settings")
+        django.setup()
+
+
+def run_job(queue, job_id, payload):
+    """
+    Runs one claimed job and stores its result, or the traceback if it raised.
+    """
+    global _current_job_path
+    files = []
+    setup_django()
+
+    def _open(value):
+        if isinstance(value, JobFile):
+            files.append(open(value.path, "rb"))
+            return files[-1]
+        return value
+
+    _current_job_path = queue.job_path(job_id)
+    try:
+        function, args, kwargs = pickle.loads(payload)
+        result = function(*[_open(v) for v in args], **{k: _open(v) for k, v in kwargs.items()})
+    except Exception:
+        queue.finish(job_id, error=traceback.format_exc())
+    else:
+        queue.finish(job_id, result)
+    finally:
+        _current_job_path = None
+        for file in files:
+            file.close()
+
+
+def work(queue=None, poll_interval=JOB_POLL_INTERVAL):
+    """
+    Runs queued jobs one at a time, forever.
+    """
+    queue = queue or get_queue()
+    while True:
+        claimed = queue.claim(os.getpid())
+        if claimed is None:
+            time.sleep(poll_interval)
+        else:
+            run_job(queue, *claimed)
+
+
+def start_worker(queue, poll_interval=JOB_POLL_INTERVAL):
+    """
+    Starts a worker process running jobs from queue and returns it. Workers aren't daemonic,
+    so jobs can start processes of their own (like codon by codon's BBLAB_CODON_BY_CODON_WORKERS),
+    run_workers terminates them when it is stopped.
+    """
+    process = multiprocessing.Process(target=work, args=(queue, poll_interval))
+    process.start()
+    return process
+
+
+def run_workers(count=JOB_WORKERS, poll_interval=JOB_POLL_INTERVAL):
+    """
+    Starts count worker processes and keeps them running. Jobs left running by dead workers
+    (or by a previous run of the workers) are put back in the queue.
+    """
+    queue = get_queue()
+    queue.requeue_orphans()
+    workers = []
+    last_cleanup = 0
+
+    def _stop(signum, frame):
+        for process in workers:
+            process.terminate()
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+
+    while True:
+        workers = [process for process in workers if process.is_alive()]
+        queue.requeue_orphans(process.pid for process in workers)
+        while len(workers) < count:
+            workers.append(start_worker(queue, poll_interval))
+
+        if time.time() - last_cleanup > 3600:
+            queue.cleanup()
+            last_cleanup = time.time()
+        time.sleep(max(poll_interval, 1))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the worker processes of the tools' job queue.")
+    parser.add_argument("--workers", type=int, default=JOB_WORKERS, help="number of jobs to run at once")
+    options = parser.parse_args()
+
+    # Jobs refer to functions in the tools package, so the site directory must be importable.
+    sys.path.insert(0, os.path.dirname(os.path.normpath(os.environ.get("BBLAB_TOOL_ROOT", "fail"))))
+
+    # Use the importable module rather than __main__, so JobFile is the same class the views pickled.
+    import job_queue
+
+    # Once here, so the workers start with Django set up.
+    job_queue.setup_django()
+    job_queue.run_workers(options.workers)
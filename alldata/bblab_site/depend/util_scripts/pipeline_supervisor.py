@@ -0,0 +1,449 @@
+# This module is compatible with python 3.7 #
+
+# Runs a pipeline of external programs as a supervised DAG of stages. The state of every run, its stages
+# (with the pids and exit codes of their processes) and its status messages are kept in a SQLite registry,
+# so web requests can follow a run (long-polling for new messages) and cancel it from another process.
+# Waiting requests are woken up by the process that writes a message, through a unix socket per waiter
+# (in the <registry>.notify directory), so they don't poll the database.
+
+import os
+import time
+import uuid
+import signal
+import select
+import socket
+import sqlite3
+import hashlib
+import selectors
+import subprocess
+from contextlib import closing, contextmanager
+
+import job_queue
+
+REGISTRY_DB = os.environ.get("BBLAB_PIPELINE_DB", job_queue.JOB_DB)  # Shares the job queue's database by default.
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+TIMED_OUT = "timed out"
+SKIPPED = "skipped"
+FINISHED_STATES = (DONE, FAILED, CANCELLED, TIMED_OUT)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS pipeline_runs (
+    id TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    created REAL NOT NULL,
+    finished REAL
+);
+CREATE TABLE IF NOT EXISTS pipeline_stages (
+    run_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    state TEXT NOT NULL,
+    pid INTEGER,
+    returncode INTEGER,
+    started REAL,
+    finished REAL,
+    PRIMARY KEY (run_id, name)
+);
+CREATE TABLE IF NOT EXISTS pipeline_events (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    run_id TEXT NOT NULL,
+    message TEXT NOT NULL,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS pipeline_events_run ON pipeline_events (run_id, seq);
+"""
+
+
+def _waiter_prefix(run_id):
+    """
+    The start of the socket names of a run's waiters, short because unix socket paths are limited to ~100 bytes.
+    """
+    return hashlib.sha1(str(run_id).encode("utf8")).hexdigest()[:12]
+
+
+def _kill_group(pid):
+    """
+    Stops a stage's process and everything it started (stages run in their own session).
+    """
+    try:
+        os.killpg(pid, signal.SIGTERM)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+class Registry:
+    """
+    The states of pipeline runs and their stages, and their status messages.
+    Every call opens its own connection so it can be used from any thread or process.
+    """
+
+    def __init__(self, path=REGISTRY_DB):
+        self.path = path
+        self.notify_dir = path + ".notify"  # The sockets of the requests waiting for new events.
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        os.makedirs(self.notify_dir, exist_ok=True)
+        with self._connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(_SCHEMA)
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        return closing(connection)
+
+    def start_run(self, run_id, stage_names):
+        """
+        Registers a run and its stages. Returns False if the run was cancelled before it started.
+        Processes left behind by an earlier attempt of the same run (a worker that died) are stopped.
+        """
+        with self._connect() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute("SELECT state FROM pipeline_runs WHERE id = ?", (run_id,)).fetchone()
+            if row is not None and row["state"] == CANCELLED:
+                connection.execute("COMMIT")
+                return False
+            leftovers = connection.execute(
+                "SELECT pid FROM pipeline_stages WHERE run_id = ? AND state = ? AND pid IS NOT NULL", (run_id, RUNNING)
+            ).fetchall()
+            connection.execute(
+                "INSERT OR REPLACE INTO pipeline_runs (id, state, created) VALUES (?, ?, ?)", (run_id, RUNNING, time.time())
+            )
+            connection.execute("DELETE FROM pipeline_stages WHERE run_id = ?", (run_id,))
+            connection.executemany(
+                "INSERT INTO pipeline_stages (run_id, name, state) VALUES (?, ?, ?)",
+                [(run_id, name, PENDING) for name in stage_names],
+            )
+            connection.execute("COMMIT")
+        for row in leftovers:
+            _kill_group(row["pid"])
+        return True
+
+    def finish_run(self, run_id, state):
+        with self._connect() as connection:
+            connection.execute(
+                "UPDATE pipeline_runs SET state = ?, finished = ? WHERE id = ? AND state = ?",
+                (state, time.time(), run_id, RUNNING),
+            )
+        self._notify(run_id)
+
+    def set_stage(self, run_id, name, state, pid=None, returncode=None):
+        now = time.time()
+        with self._connect() as connection:
+            if state == RUNNING:
+                connection.execute(
+                    "UPDATE pipeline_stages SET state = ?, pid = ?, started = ? WHERE run_id = ? AND name = ?",
+                    (state, pid, now, run_id, name),
+                )
+            else:
+                connection.execute(
+                    "UPDATE pipeline_stages SET state = ?, returncode = ?, finished = ? WHERE run_id = ? AND name = ?",
+                    (state, returncode, now, run_id, name),
+                )
+
+    def add_event(self, run_id, message):
+        """
+        Adds a status message to a run, returns its sequence number.
+        """
+        with self._connect() as connection:
+            cursor = connection.execute(
+                "INSERT INTO pipeline_events (run_id, message, created) VALUES (?, ?, ?)", (run_id, str(message), time.time())
+            )
+        self._notify(run_id)
+        return cursor.lastrowid
+
+    def events(self, run_id, after=0):
+        """
+        Returns the (seq, message) pairs of a run that came after sequence number `after`.
+        """
+        with self._connect() as connection:
+            rows = connection.execute(
+                "SELECT seq, message FROM pipeline_events WHERE run_id = ? AND seq > ? ORDER BY seq", (run_id, after)
+            ).fetchall()
+        return [(row["seq"], row["message"]) for row in rows]
+
+    def wait_for_events(self, run_id, after=0, timeout=20, interval=1):
+        """
+        Long-poll: returns new events as soon as there are any, or an empty list after timeout seconds
+        or once the run has finished. Between checks it sleeps until a writer wakes it up (see _notify),
+        or checks every `interval` seconds where it can't listen for that.
+        """
+        deadline = time.monotonic() + timeout
+        with self._wake_ups(run_id, interval) as wait:
+            while True:
+                events = self.events(run_id, after)
+                if events:
+                    return events
+                run = self.get_run(run_id)
+                if run is not None and run["state"] in FINISHED_STATES:
+                    return self.events(run_id, after)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return events
+                wait(remaining)
+
+    @contextmanager
+    def _wake_ups(self, run_id, interval):
+        """
+        Listens for the wake-ups of a run's writers, on a socket made before the waiter first checks
+        the database so nothing written after that check is missed. Gives a function that waits up to
+        the seconds it's given, until woken up.
+        """
+        path = os.path.join(self.notify_dir, _waiter_prefix(run_id) + uuid.uuid4().hex[:8])
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            listener.bind(path)
+        except OSError:
+            listener.close()
+            yield lambda seconds: time.sleep(min(seconds, interval))
+            return
+
+        def wait(seconds):
+            if select.select([listener], [], [], seconds)[0]:
+                try:
+                    while listener.recv(16):
+                        pass
+                except BlockingIOError:
+                    pass
+
+        listener.setblocking(False)
+        try:
+            yield wait
+        finally:
+            listener.close()
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _notify(self, run_id):
+        """
+        Wakes up the requests waiting for the events of a run. Called after the change is committed.
+        """
+        prefix = _waiter_prefix(run_id)
+        try:
+            paths = [os.path.join(self.notify_dir, name) for name in os.listdir(self.notify_dir) if name.startswith(prefix)]
+        except OSError:
+            return
+        if not paths:
+            return
+        with closing(socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)) as sender:
+            sender.setblocking(False)
+            for path in paths:
+                try:
+                    sender.sendto(b"1", path)
+                except (ConnectionRefusedError, FileNotFoundError):
+                    try:
+                        os.remove(path)  # Left behind by a process that died while waiting.
+                    except OSError:
+                        pass
+                except OSError:
+                    pass  # Its buffer is full, it has wake-ups waiting already.
+
+    def get_run(self, run_id):
+        """
+        Returns a dict with the run's state and a list of its stages, or None for unknown runs.
+        """
+        with self._connect() as connection:
+            run = connection.execute("SELECT * FROM pipeline_runs WHERE id = ?", (run_id,)).fetchone()
+            if run is None:
+                return None
+            stages = connection.execute("SELECT * FROM pipeline_stages WHERE run_id = ?", (run_id,)).fetchall()
+        return dict(run, stages=[dict(stage) for stage in stages])
+
+    def is_cancelled(self, run_id):
+        run = self.get_run(run_id)
+        return run is not None and run["state"] == CANCELLED
+
+    def cancel(self, run_id):
+        """
+        Cancels a run: running stages are stopped right away and a run that hasn't started won't.
+        Returns False if the run had already finished.
+        """
+        with self._connect() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute("SELECT state FROM pipeline_runs WHERE id = ?", (run_id,)).fetchone()
+            if row is not None and row["state"] in FINISHED_STATES:
+                connection.execute("COMMIT")
+                return False
+            connection.execute(
+                "INSERT OR REPLACE INTO pipeline_runs (id, state, created, finished) VALUES (?, ?, ?, ?)",
+                (run_id, CANCELLED, time.time(), time.time()),
+            )
+            running = connection.execute(
+                "SELECT pid FROM pipeline_stages WHERE run_id = ? AND state = ? AND pid IS NOT NULL", (run_id, RUNNING)
+            ).fetchall()
+            connection.execute("COMMIT")
+        self._notify(run_id)
+        for row in running:
+            _kill_group(row["pid"])
+        return True
+
+    def delete_run(self, run_id):
+        with self._connect() as connection:
+            for table, column in (("pipeline_runs", "id"), ("pipeline_stages", "run_id"), ("pipeline_events", "run_id")):
+                connection.execute("DELETE FROM {} WHERE {} = ?".format(table, column), (run_id,))
+        self._notify(run_id)
+
+
+class Stage:
+    """
+    One program of a pipeline. It starts once every stage named in `after` is done,
+    `description` is used in the status messages ("starting <description>", "done <description>", ...).
+    Instead of a command, a stage can be a Python function run in the supervisor's process
+    (it fails if the function raises). Those can't be interrupted, so keep them short.
+    """
+
+    def __init__(self, name, command=None, after=(), cwd=None, description=None, function=None):
+        self.name = name
+        self.command = command
+        self.function = function
+        self.after = tuple(after)
+        self.cwd = cwd
+        self.description = description or name
+
+
+def _wait_any(processes, timeout):
+    """
+    Blocks until one of the processes exits or timeout seconds pass. Uses pidfds where the
+    system has them, so exits (and cancellations, which kill the process) are seen immediately.
+    """
+    if hasattr(os, "pidfd_open"):
+        selector = selectors.DefaultSelector()
+        fds = []
+        try:
+            for process in processes:
+                try:
+                    fds.append(os.pidfd_open(process.pid))
+                except OSError:
+                    return  # Already gone.
+                selector.register(fds[-1], selectors.EVENT_READ)
+            selector.select(timeout)
+        finally:
+            selector.close()
+            for fd in fds:
+                os.close(fd)
+    else:
+        time.sleep(min(timeout, 0.1))
+
+
+class Supervisor:
+    """
+    Runs the stages of a registered run in dependency order, independent stages at the same time.
+    Every child is reaped and its exit code recorded. A stage that fails or times out stops the
+    stages that depend on it, and a cancelled run stops everything.
+    """
+
+    def __init__(self, registry, run_id, stages, timeout):
+        self.registry = registry
+        self.run_id = run_id
+        self.stages = list(stages)
+        self.timeout = timeout  # Seconds each stage may run.
+
+    def _status(self, message):
+        self.registry.add_event(self.run_id, message)
+
+    def run(self):
+        """
+        Runs the pipeline and returns its state: DONE, FAILED, TIMED_OUT or CANCELLED.
+        The run itself is left open, the caller finishes it with Registry.finish_run() once it's done with the output.
+        """
+        if not self.registry.start_run(self.run_id, [stage.name for stage in self.stages]):
+            return CANCELLED
+
+        states = {stage.name: PENDING for stage in self.stages}
+        running = {}  # name -> (stage, process, start time)
+
+        while True:
+            # Start every stage whose dependencies are done, skip the ones that can't run anymore.
+            called = False  # A function stage finished, stages after it may be ready now.
+            for stage in self.stages:
+                if states[stage.name] != PENDING:
+                    continue
+                if any(states[name] in (FAILED, TIMED_OUT, SKIPPED, CANCELLED) for name in stage.after):
+                    states[stage.name] = SKIPPED
+                    self.registry.set_stage(self.run_id, stage.name, SKIPPED)
+                elif all(states[name] == DONE for name in stage.after) and stage.function is not None:
+                    if not self.registry.is_cancelled(self.run_id):
+                        states[stage.name] = self._call(stage)
+                        called = True
+                elif all(states[name] == DONE for name in stage.after):
+                    self._status("starting {}".format(stage.description))
+                    process = subprocess.Popen(
+                        stage.command,
+                        cwd=stage.cwd,
+                        stdout=subprocess.DEVNULL,
+                        stderr=subprocess.DEVNULL,
+                        start_new_session=True,
+                    )
+                    states[stage.name] = RUNNING
+                    running[stage.name] = (stage, process, time.monotonic())
+                    self.registry.set_stage(self.run_id, stage.name, RUNNING, pid=process.pid)
+            if called:
+                continue
+
+            # Checked after recording the pids, so a cancel either sees them or is seen here.
+            if self.registry.is_cancelled(self.run_id):
+                for stage, process, started in running.values():
+                    self._stop(stage, process, started, CANCELLED, "terminated")
+                    states[stage.name] = CANCELLED
+                return CANCELLED
+
+            if not running:
+                break
+
+            now = time.monotonic()
+            next_deadline = min(started + self.timeout for stage, process, started in running.values())
+            _wait_any([process for stage, process, started in running.values()], max(next_deadline - now, 0))
+
+            for name, (stage, process, started) in list(running.items()):
+                if process.poll() is not None:
+                    del running[name]
+                    self._status("took {} seconds".format(int(time.monotonic() - started)))
+                    if self.registry.is_cancelled(self.run_id):
+                        states[name] = CANCELLED
+                        self.registry.set_stage(self.run_id, name, CANCELLED, returncode=process.returncode)
+                        self._status("{} terminated".format(stage.description))
+                    elif process.returncode == 0:
+                        states[name] = DONE
+                        self.registry.set_stage(self.run_id, name, DONE, returncode=0)
+                        self._status("done {}".format(stage.description))
+                    else:
+                        states[name] = FAILED
+                        self.registry.set_stage(self.run_id, name, FAILED, returncode=process.returncode)
+                        self._status("{} failed".format(stage.description))
+                elif time.monotonic() - started > self.timeout:
+                    del running[name]
+                    self._stop(stage, process, started, TIMED_OUT, "timed out")
+                    states[name] = TIMED_OUT
+
+        if any(state == TIMED_OUT for state in states.values()):
+            return TIMED_OUT
+        if all(state == DONE for state in states.values()):
+            return DONE
+        return FAILED
+
+    def _call(self, stage):
+        self._status("starting {}".format(stage.description))
+        self.registry.set_stage(self.run_id, stage.name, RUNNING)
+        started = time.monotonic()
+        try:
+            stage.function()
+        except Exception as e:
+            state, message = FAILED, "{} failed ({})".format(stage.description, e)
+        else:
+            state, message = DONE, "done {}".format(stage.description)
+        self.registry.set_stage(self.run_id, stage.name, state)
+        self._status("took {} seconds".format(int(time.monotonic() - started)))
+        self._status(message)
+        return state
+
+    def _stop(self, stage, process, started, state, verb):
+        _kill_group(process.pid)
+        process.wait()
+        self.registry.set_stage(self.run_id, stage.name, state, returncode=process.returncode)
+        self._status("took {} seconds".format(int(time.monotonic() - started)))
+        self._status("{} {}".format(stage.description, verb))
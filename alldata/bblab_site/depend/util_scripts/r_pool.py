@@ -0,0 +1,195 @@
+# This module is compatible with python 3.7 #
+
+# A pool of long-lived R processes, so R-backed operations don't pay the Rscript startup cost per call.
+# Each worker runs depend/r_scripts/qvalue_worker.r and talks over stdin/stdout, one job per line.
+
+import os
+import select
+import subprocess
+import threading
+import time
+import atexit
+
+# Pool settings, these can be changed with environment variables.
+POOL_SIZE = int(os.environ.get("BBLAB_R_POOL_SIZE", "2"))  # Most R processes alive at once (per wsgi process).
+POOL_MAX_JOBS = int(os.environ.get("BBLAB_R_POOL_MAX_JOBS", "200"))  # Restart a worker after this many jobs.
+POOL_TIMEOUT = float(os.environ.get("BBLAB_R_POOL_TIMEOUT", "60"))  # Seconds a job may take before its worker is killed.
+
+
+class RWorkerError(RuntimeError):
+    """
+    Raised when R reports an error for a job, or a worker dies or times out.
+    """
+
+
+class RWorkerTimeout(RWorkerError):
+    """
+    Raised when a job takes longer than the pool's timeout, the worker is killed.
+    """
+
+
+class RWorker:
+    """
+    One R process answering line-delimited jobs.
+    """
+
+    def __init__(self, command):
+        self.jobs_done = 0
+        self._buffer = b""
+        self._process = subprocess.Popen(
+            command,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+
+    def is_alive(self):
+        return self._process.poll() is None
+
+    def run(self, function, values, timeout):
+        """
+        Send one job and return the text R answered with. Raises RWorkerError on errors and timeouts.
+        """
+        request = "{}\t{}\n".format(function, ",".join(repr(float(v)) for v in values))
+        try:
+            self._process.stdin.write(request.encode("ascii"))
+            self._process.stdin.flush()
+        except (BrokenPipeError, OSError) as e:
+            raise RWorkerError("R worker could not accept the job: {}".format(e))
+
+        status, _, text = self._readline(timeout).partition("\t")
+        self.jobs_done += 1
+        if status != "OK":
+            raise RWorkerError("R worker failed the job: {}".format(text))
+        return text
+
+    def _readline(self, timeout):
+        """
+        Read one response line, without blocking for more than timeout seconds.
+        """
+        deadline = time.monotonic() + timeout
+        fd = self._process.stdout.fileno()
+        while b"\n" not in self._buffer:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+                self.kill()
+                raise RWorkerTimeout("R worker timed out after {} seconds".format(timeout))
+            chunk = os.read(fd, 64 * 1024)
+            if not chunk:
+                self.kill()
+                raise RWorkerError("R worker exited unexpectedly")
+            self._buffer += chunk
+        line, _, self._buffer = self._buffer.partition(b"\n")
+        return line.decode("utf-8").strip()
+
+    def kill(self):
+        self._process.kill()
+        self._process.wait()
+
+    def close(self):
+        if self.is_alive():
+            try:
+                self._process.stdin.close()  # The worker exits when stdin closes.
+                self._process.wait(1)
+            except (OSError, subprocess.TimeoutExpired):
+                self.kill()
+
+
+class RWorkerPool:
+    """
+    Hands jobs to at most `size` R workers. Callers beyond that wait in a queue,
+    workers are started on demand and replaced after `max_jobs` jobs, an error or a timeout.
+    """
+
+    def __init__(self, command, size=POOL_SIZE, max_jobs=POOL_MAX_JOBS, timeout=POOL_TIMEOUT):
+        self.command = command
+        self.size = size
+        self.max_jobs = max_jobs
+        self.timeout = timeout
+
+        self._lock = threading.Condition()
+        self._idle = []  # Started workers waiting for a job.
+        self._busy = 0  # Workers that are running a job right now.
+        self._waiting = 0  # Callers queued for a worker.
+        self._counters = {"jobs": 0, "errors": 0, "timeouts": 0, "started": 0, "recycled": 0}
+
+    def run(self, function, values):
+        """
+        Run one job on a pooled worker and return R's answer as text.
+        """
+        worker = self._acquire()
+        failed = False
+        try:
+            return worker.run(function, values, self.timeout)
+        except RWorkerError as e:
+            failed = True
+            with self._lock:
+                self._counters["errors"] += 1
+                if isinstance(e, RWorkerTimeout):
+                    self._counters["timeouts"] += 1
+            raise
+        finally:
+            self._release(worker, failed)
+
+    def _acquire(self):
+        with self._lock:
+            self._waiting += 1
+            try:
+                while not self._idle and self._busy >= self.size:
+                    self._lock.wait()
+                self._busy += 1
+                if self._idle:
+                    return self._idle.pop()
+            finally:
+                self._waiting -= 1
+            self._counters["started"] += 1
+        try:
+            return RWorker(self.command)
+        except Exception:
+            with self._lock:
+                self._busy -= 1
+                self._lock.notify()
+            raise
+
+    def _release(self, worker, failed):
+        recycle = failed or not worker.is_alive() or worker.jobs_done >= self.max_jobs
+        if recycle:
+            worker.close()
+        with self._lock:
+            self._busy -= 1
+            self._counters["jobs"] += 1
+            if recycle:
+                self._counters["recycled"] += 1
+            else:
+                self._idle.append(worker)
+            self._lock.notify()
+
+    def stats(self):
+        """
+        Returns a dict of queue depth, worker counts and job counters.
+        """
+        with self._lock:
+            return dict(self._counters, queue_depth=self._waiting, busy=self._busy, idle=len(self._idle), size=self.size)
+
+    def shutdown(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for worker in idle:
+            worker.close()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """
+    Returns the pool shared by this process, running qvalue_worker.r from BBLAB_R_PATH.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            worker_path = "{}qvalue_worker.r".format(os.environ.get("BBLAB_R_PATH", "fail"))
+            _pool = RWorkerPool(["Rscript", worker_path])
+            atexit.register(_pool.shutdown)
+        return _pool
@@ -0,0 +1,218 @@
+# This module is compatible with python 3.7 #
+
+# A cache of the results of the deterministic tools, so resubmitting the same input doesn't compute it again.
+# Results are pickled to files named by a hash of (tool, tool version, normalized input, parameters),
+# an SQLite index keeps their sizes and last use, and the least recently used ones are deleted
+# when the cache grows past BBLAB_CACHE_MAX_BYTES. The tools use it with:
+#     value = result_cache.cached("tool name", VERSION, data, compute, params)
+
+import os
+import re
+import json
+import time
+import pickle
+import sqlite3
+import hashlib
+from contextlib import closing
+
+# Cache settings, these can be changed with environment variables.
+CACHE_DIR = os.environ.get(
+    "BBLAB_CACHE_DIR", os.path.join(os.environ.get("BBLAB_MEDIA_ROOT", "fail"), "cache")
+)
+CACHE_MAX_BYTES = int(os.environ.get("BBLAB_CACHE_MAX_BYTES", str(1024 ** 3)))  # 0 turns the cache off.
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    tool TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used);
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+
+def normalize_text(text):
+    """
+    Returns text with the same line endings (\\n) and no trailing blank lines, so an input pasted
+    from another system or saved by another editor gets the same key.
+    """
+    if isinstance(text, bytes):
+        text = text.decode("utf8")
+    return re.sub(r"\r\n?", "\n", text).rstrip("\n")
+
+
+def cache_key(tool, version, data, params=None):
+    """
+    Returns the key of a result: a sha256 of the tool's name and version, its input and its
+    parameters. data and params must be json serializable (text, numbers, lists and dicts).
+    """
+    text = json.dumps([tool, str(version), data, params], sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(text.encode("utf8")).hexdigest()
+
+
+class ResultCache:
+    """
+    Results stored by key, shared by all the processes using the same directory.
+    """
+
+    def __init__(self, directory=CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.path = os.path.join(directory, "cache.sqlite3")
+        os.makedirs(directory, exist_ok=True)
+        with self._connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(_SCHEMA)
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        return closing(connection)
+
+    def _file(self, key):
+        return os.path.join(self.directory, key[:2], key + ".pickle")
+
+    def _count(self, connection, name):
+        connection.execute(
+            "INSERT INTO counters (name, value) VALUES (?, 1) ON CONFLICT (name) DO UPDATE SET value = value + 1",
+            (name,),
+        )
+
+    def get(self, key):
+        """
+        Returns the result stored under key, raises KeyError if there isn't one. Counts a hit or a miss.
+        """
+        with self._connect() as connection:
+            found = connection.execute("SELECT 1 FROM entries WHERE key = ?", (key,)).fetchone()
+            if found:
+                try:
+                    with open(self._file(key), "rb") as file:
+                        value = pickle.load(file)
+                except (OSError, EOFError, pickle.UnpicklingError):
+                    connection.execute("DELETE FROM entries WHERE key = ?", (key,))  # Deleted or damaged.
+                    found = None
+            if not found:
+                self._count(connection, "misses")
+                raise KeyError(key)
+            connection.execute("UPDATE entries SET last_used = ? WHERE key = ?", (time.time(), key))
+            self._count(connection, "hits")
+        return value
+
+    def put(self, key, value, tool=""):
+        """
+        Stores value under key, then deletes the least recently used results until the cache
+        fits in max_bytes. Values bigger than the whole cache aren't stored.
+        """
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.max_bytes:
+            return
+        path = self._file(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        part_path = "{}.{}.part".format(path, os.getpid())
+        with open(part_path, "wb") as file:
+            file.write(data)
+        os.replace(part_path, path)
+
+        with self._connect() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO entries (key, tool, size, last_used) VALUES (?, ?, ?, ?)",
+                (key, tool, len(data), time.time()),
+            )
+            self._evict(connection)
+
+    def _evict(self, connection):
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            total = connection.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+            evicted = []
+            if total > self.max_bytes:
+                for key, size in connection.execute("SELECT key, size FROM entries ORDER BY last_used"):
+                    evicted.append(key)
+                    total -= size
+                    if total <= self.max_bytes:
+                        break
+                connection.executemany("DELETE FROM entries WHERE key = ?", [(key,) for key in evicted])
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        for key in evicted:
+            try:
+                os.remove(self._file(key))
+            except FileNotFoundError:
+                pass
+
+    def cached(self, key, compute, tool=""):
+        """
+        Returns the result stored under key, or computes it with compute() and stores it.
+        The cache is only a shortcut: if it can't be read or written the result is computed anyway.
+        """
+        try:
+            return self.get(key)
+        except KeyError:
+            pass
+        except (OSError, sqlite3.Error):
+            return compute()
+        value = compute()
+        try:
+            self.put(key, value, tool)
+        except (OSError, sqlite3.Error, pickle.PicklingError):
+            pass
+        return value
+
+    def stats(self):
+        """
+        Returns the number of hits and misses so far, and the number and total size of stored results.
+        """
+        with self._connect() as connection:
+            stats = {"hits": 0, "misses": 0}
+            stats.update(connection.execute("SELECT name, value FROM counters"))
+            stats["entries"], stats["bytes"] = connection.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries"
+            ).fetchone()
+        return stats
+
+    def clear(self):
+        """
+        Deletes every stored result and resets the counters.
+        """
+        with self._connect() as connection:
+            keys = [row[0] for row in connection.execute("SELECT key FROM entries")]
+            connection.execute("DELETE FROM entries")
+            connection.execute("DELETE FROM counters")
+        for key in keys:
+            try:
+                os.remove(self._file(key))
+            except FileNotFoundError:
+                pass
+
+
+_cache = None
+
+
+def get_cache():
+    """
+    Returns the cache shared by this process, stored in BBLAB_CACHE_DIR.
+    """
+    global _cache
+    if _cache is None:
+        _cache = ResultCache()
+    return _cache
+
+
+def cached(tool, version, data, compute, params=None):
+    """
+    Returns compute() for this input, from the shared cache if the same tool version already
+    computed it. Turned off (always computes) when BBLAB_CACHE_MAX_BYTES is 0.
+    """
+    if CACHE_MAX_BYTES <= 0:
+        return compute()
+    try:
+        cache = get_cache()
+    except (OSError, sqlite3.Error):
+        return compute()
+    return cache.cached(cache_key(tool, version, data, params), compute, tool)
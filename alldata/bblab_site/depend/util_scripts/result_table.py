@@ -0,0 +1,267 @@
+# This module is compatible with python 3.7 #
+
+# A result table that tools fill row by row, and exporters that write it out as CSV, TSV or XLSX.
+# The exporters are generators, so a download is sent as it is serialized (StreamingHttpResponse)
+# and the file never exists as one big string. The format comes from the request's "format" field.
+#
+# Tables can also be stored (in a job's directory) and served a page at a time, sorted by any
+# column, to the virtualized table in static/result_table.js (see the jobs app's rows/ view).
+
+import csv
+import json
+import math
+import os
+import sqlite3
+from contextlib import closing
+
+EXPORT_CHUNK_SIZE = 64 * 1024
+TABLE_FILE = "table.sqlite3"
+
+
+class ResultTable:
+    """
+    Column names and rows of values. rows can be any iterable, e.g. a generator that computes
+    each row when the table is exported; such a table can only be exported once.
+    """
+
+    def __init__(self, columns, rows=None, title="Data"):
+        self.columns = list(columns)
+        self.title = title  # Used as the sheet name in xlsx files.
+        self.rows = [] if rows is None else rows
+
+    def append(self, row):
+        self.rows.append(row)
+
+    def __iter__(self):
+        return iter(self.rows)
+
+
+class TablePage:
+    """
+    What a tool that runs in the request returns instead of its results page, when the page shows
+    a result table with viewer_html(): the page's html and the table, stored with a finished job
+    by the jobs app's show_table().
+    """
+
+    def __init__(self, html, table):
+        self.html = html
+        self.table = table
+
+
+class _LineBuffer:
+    """
+    A file for csv.writer that hands back what was written, so rows can be yielded one at a time.
+    """
+
+    def __init__(self):
+        self.text = ""
+
+    def write(self, text):
+        self.text += text
+
+    def pop(self):
+        text, self.text = self.text, ""
+        return text
+
+
+def iter_delimited(table, delimiter=",", lineterminator="\r\n"):
+    """
+    Yields the table as delimited text, a few rows at a time.
+    """
+    buffer = _LineBuffer()
+    writer = csv.writer(buffer, delimiter=delimiter, lineterminator=lineterminator)
+    writer.writerow(table.columns)
+    for row in table:
+        writer.writerow(row)
+        if len(buffer.text) >= EXPORT_CHUNK_SIZE:
+            yield buffer.pop()
+    yield buffer.pop()
+
+
+def iter_csv(table):
+    return iter_delimited(table, ",", "\r\n")
+
+
+def iter_tsv(table):
+    return iter_delimited(table, "\t", "\n")
+
+
+def iter_xlsx(table):
+    """
+    Yields the table as an xlsx file. The workbook has to be complete before any of it can be
+    sent (the zip directory comes last), so it is built in a spooled temporary file first.
+    """
+    import xlsx_export
+
+    xlsx = xlsx_export.XlsxExport()
+    try:
+        sheet = xlsx.add_sheet(table.title, table.columns)
+        for row in table:
+            sheet.append(list(row))
+        file = xlsx.save()
+        for chunk in iter(lambda: file.read(EXPORT_CHUNK_SIZE), b""):
+            yield chunk
+    finally:
+        xlsx.close()
+
+
+# Format name: (exporter, file extension, content type)
+EXPORT_FORMATS = {
+    "csv": (iter_csv, "csv", "text/csv"),
+    "tsv": (iter_tsv, "tsv", "text/tab-separated-values"),
+    "xlsx": (iter_xlsx, "xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+}
+
+
+def requested_format(data, default):
+    """
+    Returns the export format asked for in data (request.POST or request.GET), or default
+    if none or an unknown one was given.
+    """
+    export_format = data.get("format", default).lower()
+    return export_format if export_format in EXPORT_FORMATS else default
+
+
+def export(table, export_format):
+    """
+    Returns a generator of the table in export_format ("csv", "tsv" or "xlsx").
+    """
+    return EXPORT_FORMATS[export_format][0](table)
+
+
+def response(table, export_format, filename):
+    """
+    Returns a StreamingHttpResponse that downloads the table as filename.<extension>.
+    """
+    from django.http import StreamingHttpResponse
+
+    exporter, extension, content_type = EXPORT_FORMATS[export_format]
+    response = StreamingHttpResponse(exporter(table), content_type=content_type)
+    response["Content-Disposition"] = "attachment; filename={}.{}".format(filename, extension)
+    return response
+
+
+##### Stored tables
+
+
+def _cell(value):
+    """
+    Returns value as something json can hold (NaN and infinity aren't valid json).
+    """
+    if value is None or isinstance(value, (str, bool, int)):
+        return value
+    if isinstance(value, float):
+        return value if math.isfinite(value) else str(value)
+    return str(value)
+
+
+def _sort_key(value):
+    """
+    Numbers (and numeric strings) sort before text, empty cells last.
+    """
+    if value is None or value == "":
+        return (2, 0.0, "")
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return (1, 0.0, str(value).lower())
+    if math.isnan(number):
+        return (1, 0.0, str(value).lower())
+    return (0, number, "")
+
+
+def store(table, directory):
+    """
+    Saves the table in directory, to be read back with StoredTable. Returns the file's path.
+    """
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, TABLE_FILE)
+    part_path = path + ".part"
+    if os.path.exists(part_path):
+        os.remove(part_path)
+
+    with closing(sqlite3.connect(part_path)) as connection:
+        connection.execute("CREATE TABLE info (columns TEXT NOT NULL, title TEXT NOT NULL)")
+        connection.execute("CREATE TABLE rows (idx INTEGER PRIMARY KEY, data TEXT NOT NULL)")
+        connection.execute("INSERT INTO info VALUES (?, ?)", (json.dumps(table.columns), table.title))
+        connection.executemany(
+            "INSERT INTO rows VALUES (?, ?)",
+            ((i, json.dumps([_cell(value) for value in row])) for i, row in enumerate(table)),
+        )
+        connection.commit()
+    os.replace(part_path, path)
+    return path
+
+
+class StoredTable:
+    """
+    A table saved with store(), read a slice at a time. The order for a sort column is worked
+    out the first time it is asked for and kept in the file.
+    """
+
+    def __init__(self, directory):
+        self.path = os.path.join(directory, TABLE_FILE)
+        if not os.path.exists(self.path):
+            raise FileNotFoundError(self.path)
+        with closing(self._connect()) as connection:
+            columns, self.title = connection.execute("SELECT columns, title FROM info").fetchone()
+            self.columns = json.loads(columns)
+            self.total = connection.execute("SELECT COUNT(*) FROM rows").fetchone()[0]
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def _sort_order(self, connection, column):
+        """
+        Makes sure table order_<column> holds the row indexes sorted by that column.
+        """
+        name = "order_{:d}".format(column)
+        exists = "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?"
+        if connection.execute(exists, (name,)).fetchone():
+            return name
+
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            if not connection.execute(exists, (name,)).fetchone():  # Another request may have just made it.
+                keys = [(_sort_key(json.loads(data)[column]), idx) for idx, data in connection.execute("SELECT idx, data FROM rows")]
+                keys.sort()
+                connection.execute("CREATE TABLE {} (pos INTEGER PRIMARY KEY, idx INTEGER NOT NULL)".format(name))
+                connection.executemany("INSERT INTO {} VALUES (?, ?)".format(name), ((pos, idx) for pos, (_, idx) in enumerate(keys)))
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return name
+
+    def rows(self, offset=0, limit=100, sort=None, descending=False, column_offset=0, column_limit=None):
+        """
+        Returns rows offset to offset + limit, in the order of column sort (input order if None),
+        with only columns column_offset to column_offset + column_limit of each.
+        """
+        if sort is not None and not 0 <= sort < len(self.columns):
+            raise IndexError("no column {}".format(sort))
+        direction = "DESC" if descending else "ASC"
+
+        with closing(self._connect()) as connection:
+            if sort is None:
+                query = "SELECT data FROM rows ORDER BY idx {} LIMIT ? OFFSET ?".format(direction)
+            else:
+                order = self._sort_order(connection, sort)
+                query = "SELECT data FROM {0} JOIN rows ON rows.idx = {0}.idx ORDER BY pos {1} LIMIT ? OFFSET ?".format(order, direction)
+            rows = [json.loads(data) for (data,) in connection.execute(query, (limit, offset))]
+
+        column_end = None if column_limit is None else column_offset + column_limit
+        if column_offset or column_end is not None:
+            rows = [row[column_offset:column_end] for row in rows]
+        return rows
+
+
+def viewer_html(rows_url="rows/", column_width=None):
+    """
+    Returns the html of a virtualized table showing the stored table served at rows_url.
+    """
+    from web_output import static_url
+
+    width = "" if column_width is None else ' data-column-width="{:d}"'.format(column_width)
+    return ('<div class="result-table" data-url="{}"{}></div>'
+            '<script src="{}"></script>').format(rows_url, width, static_url("result_table.js"))
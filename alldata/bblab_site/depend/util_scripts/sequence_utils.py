@@ -4,9 +4,11 @@
 # See: ( https://github.com/emartin-cfe/emartin-personal/blob/master/PYTHON/miseqUtils.py ) for original file.  (More functions but in 2.7)
 
 from datetime import datetime
-import sys, re, math
+import sys, re, math, codecs
 import random
 
+import numpy
+
 # I found this function -gabe
 def xrange(x, y, z):
     return iter(range(x, y, z))
@@ -129,27 +131,112 @@ def convert_csf (csf_handle):
 
 def convert_fasta (lines):	
     blocks = []
-    sequence = ''
+    sequence = []
     for i in lines:
         if i[0] == '$': # skip h info
             continue
         elif i[0] == '>' or i[0] == '#':
             if len(sequence) > 0:
-                blocks.append([h,sequence])
-                sequence = ''	# reset containers
+                blocks.append([h,''.join(sequence)])
+                sequence = []	# reset containers
                 h = i.strip('\n')[1:]
             else:
                 h = i.strip('\n')[1:]
-        else:
-            sequence += i.strip('\n')
+        elif i.strip('\n'):
+            sequence.append(i.strip('\n'))
     try:
-        blocks.append([h,sequence])	# handle last entry
+        blocks.append([h,''.join(sequence)])	# handle last entry
     except:
         #raise Exception("convert_fasta(): Error appending to blocks [{},{}]".format(h, sequence))
         raise Exception("convert_fasta(): Had error with list : {}".format(lines))
     return blocks
 
 
+def iter_chunks (source, chunk_size=64*1024):
+    """
+    Yield the text of a str, a file-like object (text or binary) or a Django UploadedFile
+    piece by piece, reading chunk_size at a time.  Bytes are decoded as utf-8.
+    """
+    if isinstance(source, (str, bytes)):
+        chunks = iter([source])
+    elif hasattr(source, 'chunks'):  # Django UploadedFile
+        chunks = source.chunks(chunk_size)
+    else:
+        chunks = iter(lambda: source.read(chunk_size), None)
+
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    for chunk in chunks:
+        if not chunk:
+            break
+        if isinstance(chunk, bytes):
+            chunk = decoder.decode(chunk)
+        if chunk:
+            yield chunk
+    tail = decoder.decode(b'', final=True)
+    if tail:
+        yield tail
+
+
+def iter_lines (source, chunk_size=64*1024):
+    """
+    Yield the non-empty lines of source (see iter_chunks) without their line endings.
+    \n, \r and \r\n are all treated as line endings, only one line is buffered at a time.
+    """
+    pending = ''
+    for chunk in iter_chunks(source, chunk_size):
+        lines = (pending + chunk).replace('\r', '\n').split('\n')
+        pending = lines.pop()
+        for line in lines:
+            if line:
+                yield line
+    if pending:
+        yield pending
+
+
+def iter_fasta (source, chunk_size=64*1024):
+    """
+    Read FASTA data from source (see iter_chunks) and yield (header, sequence) tuples one record at a time.
+    Follows convert_fasta(): '$' lines are skipped, headers start with '>' or '#',
+    and a header with no sequence is replaced by the next header.
+    Raises ValueError if there is sequence data before the first header or no header at all.
+    """
+    header = None
+    sequence = []
+    for line in iter_lines(source, chunk_size):
+        if line[0] == '$': # skip h info
+            continue
+        elif line[0] == '>' or line[0] == '#':
+            if sequence:
+                yield (header, ''.join(sequence))
+                sequence = []	# reset containers
+            header = line[1:]
+        elif header is None:
+            raise ValueError("iter_fasta(): found sequence data before the first header : {}".format(line[:50]))
+        else:
+            sequence.append(line)
+
+    if header is None:
+        raise ValueError("iter_fasta(): no fasta header found")
+    yield (header, ''.join(sequence))	# handle last entry
+
+
+def iter_csf (source, chunk_size=64*1024):
+    """
+    Read CSF data from source (see iter_chunks) and yield (header, offset, sequence) tuples one line at a time.
+    """
+    for line in iter_lines(source, chunk_size):
+        fields = line.split(',')
+        yield (fields[0], int(fields[1]), fields[2])
+
+
+def iter_fasta_text (records, line_ending='\n'):
+    """
+    The inverse of iter_fasta(), yields the FASTA text for (header, sequence) records one record at a time.
+    """
+    for header, sequence in records:
+        yield '>{}{}{}{}'.format(header, line_ending, sequence, line_ending)
+
+
 complement_dict = {'A':'T', 'C':'G', 'G':'C', 'T':'A', 
                     'W':'S', 'R':'Y', 'K':'M', 'Y':'R', 'S':'W', 'M':'K',
                     'B':'V', 'D':'H', 'H':'D', 'V':'B',
@@ -192,6 +279,67 @@ mixture_dict = {'W':'AT', 'R':'AG', 'K':'GT', 'Y':'CT', 'S':'CG',
 ambig_dict = dict(("".join(sorted(v)), k) for k, v in mixture_dict.items())
 
 
+def _translate_codon (codon, resolve=False):
+    """
+    Translate a single codon the slow way, resolving nucleotide mixtures
+    by trying every alternative codon. Used to build the lookup tables
+    below and for codons that fall outside of them.
+    """
+    # note that we're willing to handle a single missing nucleotide as an ambiguity
+    if codon.count('-') > 1 or '?' in codon:
+        if codon == '---':	# don't bother to translate incomplete codons
+            return '-'
+        return '?'
+
+    # look for nucleotide mixtures in codon, resolve to alternative codons if found
+    num_mixtures = len(mixture_regex.findall(codon))
+
+    if num_mixtures == 0:
+        return codon_dict[codon]
+
+    elif num_mixtures == 1:
+        resolved_AAs = []
+        for pos in range(3):
+            if codon[pos] in mixture_dict.keys():
+                for r in mixture_dict[codon[pos]]:
+                    rcodon = codon[0:pos] + r + codon[(pos+1):]
+                    if codon_dict[rcodon] not in resolved_AAs:
+                        resolved_AAs.append(codon_dict[rcodon])
+        if len(resolved_AAs) > 1:
+            if resolve:
+                # for purposes of aligning AA sequences
+                # it is better to have one of the resolutions
+                # than a completely ambiguous '?'
+                return resolved_AAs[0]
+            return '?'
+        return resolved_AAs[0]
+
+    return '?'
+
+
+# All 16 IUPAC characters (bases, mixtures and the gap) that can appear in a codon.
+iupac_nuc_chars = 'ACGTWRKYSMBDHVN-'
+
+# Precomputed translations of all 16^3 IUPAC codons, one table per value of 'resolve'.
+codon_table = {}
+codon_table_resolved = {}
+for _a in iupac_nuc_chars:
+    for _b in iupac_nuc_chars:
+        for _c in iupac_nuc_chars:
+            _codon = _a + _b + _c
+            codon_table[_codon] = _translate_codon(_codon, False)
+            codon_table_resolved[_codon] = _translate_codon(_codon, True)
+
+# The same tables as byte arrays indexed by (16*16*i + 16*j + k) for translate_nuc_batch().
+_nuc_index = numpy.full(256, 255, dtype=numpy.uint8)
+for _i, _char in enumerate(iupac_nuc_chars):
+    _nuc_index[ord(_char)] = _i
+_codon_array = numpy.frombuffer(''.join(codon_table[a+b+c] for a in iupac_nuc_chars
+    for b in iupac_nuc_chars for c in iupac_nuc_chars).encode('ascii'), dtype=numpy.uint8)
+_codon_array_resolved = numpy.frombuffer(''.join(codon_table_resolved[a+b+c] for a in iupac_nuc_chars
+    for b in iupac_nuc_chars for c in iupac_nuc_chars).encode('ascii'), dtype=numpy.uint8)
+
+
 def translate_nuc (seq, offset, resolve=False):
     """
     Translate nucleotide sequence into amino acid sequence.
@@ -201,54 +349,56 @@ def translate_nuc (seq, offset, resolve=False):
     """
 
     seq = '-'*offset + seq
+    table = codon_table_resolved if resolve else codon_table
 
+    # Incomplete trailing codons are dropped, codons outside the table (ex. lowercase or '?') are translated the slow way.
     aa_list = []
-    aa_seq = ''	# use to align against reference, for resolving indels
-
-    # loop over codon sites in nucleotide sequence
-    for codon_site in xrange(0, len(seq), 3):
+    for codon_site in range(0, len(seq) - len(seq) % 3, 3):
         codon = seq[codon_site:codon_site+3]
+        aa = table.get(codon)
+        aa_list.append(aa if aa is not None else _translate_codon(codon, resolve))
 
-        if len(codon) < 3:
-            break
-
-        # note that we're willing to handle a single missing nucleotide as an ambiguity
-        if codon.count('-') > 1 or '?' in codon:
-            if codon == '---':	# don't bother to translate incomplete codons
-                aa_seq += '-'
-            else:
-                aa_seq += '?'
-            continue
+    return ''.join(aa_list)
 
-        # look for nucleotide mixtures in codon, resolve to alternative codons if found
-        num_mixtures = len(mixture_regex.findall(codon))
-
-        if num_mixtures == 0:
-            aa_seq += codon_dict[codon]
-
-        elif num_mixtures == 1:
-            resolved_AAs = []
-            for pos in range(3):
-                if codon[pos] in mixture_dict.keys():
-                    for r in mixture_dict[codon[pos]]:
-                        rcodon = codon[0:pos] + r + codon[(pos+1):]
-                        if codon_dict[rcodon] not in resolved_AAs:
-                            resolved_AAs.append(codon_dict[rcodon])
-            if len(resolved_AAs) > 1:
-                if resolve:
-                    # for purposes of aligning AA sequences
-                    # it is better to have one of the resolutions
-                    # than a completely ambiguous '?'
-                    aa_seq += resolved_AAs[0]
-                else:
-                    aa_seq += '?'
-            else:
-                aa_seq += resolved_AAs[0]
 
+def translate_nuc_batch (seqs, offset=0, resolve=False):
+    """
+    Translate many nucleotide sequences at once, returns a list of amino acid sequences.
+    seqs is either a list of strings, a NumPy bytes array (dtype 'S') or a 2D uint8 array
+    with one sequence per row.  Output is identical to calling translate_nuc() on each sequence.
+    """
+    if not isinstance(seqs, numpy.ndarray):
+        return [translate_nuc(seq, offset, resolve) for seq in seqs]
+
+    if seqs.dtype.kind == 'S' and seqs.ndim == 1:
+        lengths = numpy.char.str_len(seqs)
+        matrix = seqs.view(numpy.uint8).reshape(len(seqs), seqs.dtype.itemsize)
+    elif seqs.dtype == numpy.uint8 and seqs.ndim == 2:
+        lengths = numpy.full(seqs.shape[0], seqs.shape[1])
+        matrix = seqs
+    else:
+        raise TypeError("translate_nuc_batch(): expected a 1D bytes array or a 2D uint8 array, got {} {}".format(seqs.ndim, seqs.dtype))
+
+    if offset > 0:
+        matrix = numpy.hstack([numpy.full((matrix.shape[0], offset), ord('-'), dtype=numpy.uint8), matrix])
+        lengths = lengths + offset
+
+    num_codons = matrix.shape[1] // 3
+    codes = _nuc_index[matrix[:, :num_codons*3]].reshape(matrix.shape[0], num_codons, 3).astype(numpy.intp)
+    unknown = (codes == 255).any(axis=2)  # Codons that need the slow path (or are padding).
+    codon_index = (codes[:, :, 0] << 8) | (codes[:, :, 1] << 4) | codes[:, :, 2]
+    codon_index[unknown] = 0
+    aa_matrix = (_codon_array_resolved if resolve else _codon_array)[codon_index]
+
+    aa_seqs = []
+    for row in range(matrix.shape[0]):
+        row_codons = lengths[row] // 3
+        if unknown[row, :row_codons].any():
+            aa_seqs.append(translate_nuc(matrix[row, offset:lengths[row]].tobytes().decode('latin-1'), offset, resolve))
         else:
-            aa_seq += '?'
+            aa_seqs.append(aa_matrix[row, :row_codons].tobytes().decode('ascii'))
 
-    return aa_seq
+    return aa_seqs
 
 
 
@@ -322,19 +472,19 @@ def parse_fasta (handle):
     header, sequence tuples.
     """
     res = []
-    sequence = ''
+    sequence = []
     for line in handle:
         if line.startswith('$'): # skip annotations
             continue
         elif line.startswith('>') or line.startswith('#'):
             if len(sequence) > 0:
-                res.append((h, sequence))
-                sequence = ''   # reset containers
+                res.append((h, ''.join(sequence)))
+                sequence = []   # reset containers
             h = line.lstrip('>#').rstrip('\n')
-        else:
-            sequence += line.strip('\n')
+        elif line.strip('\n'):
+            sequence.append(line.strip('\n'))
 
-    res.append((h, sequence)) # handle last entry
+    res.append((h, ''.join(sequence))) # handle last entry
     return res
 
 
@@ -0,0 +1,93 @@
+# This module is compatible with python 3.7 #
+
+# Output stage for the plotting tools' SVGs (drawsvg drawings, also the ones genetracks makes).
+# Large plots repeat the same fill/stroke/font attributes on thousands of <rect>, <path> and <text>
+# elements, compact_styles() moves them into a few shared CSS classes. The SVG is also saved
+# gzipped next to the plain file, the jobs app sends that copy with Content-Encoding: gzip.
+
+import io
+import gzip
+from collections import Counter
+
+# Presentation attributes that can be moved into a CSS rule.
+STYLE_ATTRIBUTES = (
+    "fill", "fill-opacity", "stroke", "stroke-width", "stroke-opacity", "stroke-dasharray",
+    "stroke-linecap", "stroke-linejoin", "opacity", "font-family", "font-size", "font-weight",
+    "font-style", "text-anchor", "dominant-baseline",
+)
+LENGTH_ATTRIBUTES = ("stroke-width", "font-size")  # CSS needs a unit where the attribute didn't.
+
+
+def _elements(elements):
+    for element in elements:
+        if hasattr(element, "args"):
+            yield element
+            yield from _elements(getattr(element, "children", ()))
+
+
+def _styles(element):
+    args = element.args
+    if "class" in args or "style" in args:
+        return None  # Already styled some other way, left as it is.
+    styles = tuple((name, args[name]) for name in STYLE_ATTRIBUTES if args.get(name) is not None)
+    return styles or None
+
+
+def _css_value(name, value):
+    if name in LENGTH_ATTRIBUTES and isinstance(value, (int, float)):
+        return "{}px".format(value)
+    return str(value)
+
+
+def compact_styles(drawing, min_count=2, prefix="s"):
+    """
+    Moves the styling attributes that at least min_count elements of the drawing share into
+    CSS classes named prefix0, prefix1, ... Returns the drawing. The plot looks the same:
+    presentation attributes are the least specific CSS anyway, so a class rule takes their place.
+    """
+    elements = list(_elements(drawing.elements))
+    counts = Counter(styles for styles in map(_styles, elements) if styles)
+    classes = {}
+    for styles, count in counts.most_common():
+        if count >= min_count:
+            classes[styles] = "{}{}".format(prefix, len(classes))
+
+    seen = set()
+    for element in elements:
+        if id(element) in seen:
+            continue  # The same element can be drawn more than once.
+        seen.add(id(element))
+        styles = _styles(element)
+        if styles in classes:
+            for name, _ in styles:
+                del element.args[name]
+            element.args["class"] = classes[styles]
+
+    if classes:
+        drawing.append_css("\n".join(
+            ".{}{{{}}}".format(name, ";".join("{}:{}".format(key, _css_value(key, value)) for key, value in styles))
+            for styles, name in classes.items()
+        ))
+    return drawing
+
+
+def gzip_bytes(data):
+    """
+    Returns data (bytes or text) gzipped. The output only depends on data (no timestamp).
+    """
+    if isinstance(data, str):
+        data = data.encode("utf8")
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode="wb", compresslevel=9, mtime=0) as file:
+        file.write(data)
+    return buffer.getvalue()
+
+
+def save(path, svg):
+    """
+    Writes the svg text to path, and gzipped to path + ".gz".
+    """
+    with open(path, "w", encoding="utf8") as file:
+        file.write(svg)
+    with open(path + ".gz", "wb") as file:
+        file.write(gzip_bytes(svg))
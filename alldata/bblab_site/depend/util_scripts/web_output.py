@@ -3,6 +3,8 @@ import cgi
 ## Changes: (while migrating to django)
 ## - Removed debug mode
 ## - Returns html as string instead of printing.
+## - Static urls are resolved here, so the output is plain html that doesn't need to go through a django template.
+## - Output is kept in lists of strings and joined once, instead of growing one string.
 
 #TODO: implement these two styles.
 SITE_PLAIN = 0
@@ -19,6 +21,14 @@ def clean_html(string):
 	return string.replace('<', "&lt;").replace('>', "&gt;")
 
 
+def static_url(path):
+	'''
+	Returns the url of a static file, like the {% static %} template tag.
+	'''
+	from django.templatetags.static import static
+	return static(path)
+
+
 class Site:
 	'''
 	This class handles formatting a simple text output feed website with css using the cgi module.
@@ -29,15 +39,14 @@ class Site:
 
 	def __init__(self, title="Website", site_style=SITE_BOXED):
 		self._site_title = title
-		self._box_list = [ "" ]  # Inits with one box.
+		self._box_list = [ [] ]  # Inits with one box.  (Each box is a list of the strings sent to it.)
 
-		self._errors = ""
-		self._warnings = ""
+		self._errors = []
+		self._warnings = []
 		self._style = site_style
 
 
 		self._footer_text = "this is a website"
-		self._html = ""
 
 	def set_title(self, title):
 		self._site_title = title
@@ -47,45 +56,62 @@ class Site:
 		self._footer_text = footer_text
 
 	def _print_header(self):
-		self._html += '{% load static %}\n<html><head>'
-		self._html += '<link rel="stylesheet" href="{% static "wo_style.css" %}"/>' # Django static file integration.
-		self._html += '<title>{}</title>'.format( self._site_title )  # Site Title
-		self._html += '</head><body><div id="container">'
+		yield '<html><head>'
+		yield '<link rel="stylesheet" href="{}"/>'.format( static_url("wo_style.css") ) # Django static file integration.
+		yield '<title>{}</title>'.format( self._site_title )  # Site Title
+		yield '</head><body><div id="container">'
 
-	def generate_site(self):
+	def iter_site(self):
 		'''
-		This function prints all code to the console which builds
-		the website.  This should be called at the end of the script.
+		This function yields the html of the website piece by piece.
 		'''
 
-		self._print_header()
+		yield from self._print_header()
 
 		# Print errors first.
-		if self._errors != "":
-			self._html += '<div class="box"><br>{}<br></div>'.format(self._errors)
+		if self._errors:
+			yield '<div class="box"><br>'
+			yield from self._errors
+			yield '<br></div>'
 
 		# Print warnings second.
-		if self._warnings != "":
-			self._html += '<div class="box"><br>{}<br></div>'.format(self._warnings)
+		if self._warnings:
+			yield '<div class="box"><br>'
+			yield from self._warnings
+			yield '<br></div>'
 			
-		if self._warnings == "" and self._errors == "":
-			self._html += '<div class="box"><em><br>analysis executed successfully<br></em><br></div>'
+		if not self._warnings and not self._errors:
+			yield '<div class="box"><em><br>analysis executed successfully<br></em><br></div>'
 
 		# Print all the strings in the feed_contents list.
 		for contents in self._box_list:
-			self._html += '<div class="box"><br>{}<br></div>'.format(contents)
+			yield '<div class="box"><br>'
+			yield from contents
+			yield '<br></div>'
 
 		# Complete tags
-		self._html += '</div></body>'
-		self._html += '<p id="footer">' + self._footer_text + '</p>'
-		self._html += '</html>'
-		return self._html
+		yield '</div></body>'
+		yield '<p id="footer">' + self._footer_text + '</p>'
+		yield '</html>'
+
+	def generate_site(self):
+		'''
+		This function returns the html of the website as a string.  This should be called at the end of the script.
+		'''
+		return "".join(self.iter_site())
+
+	def response(self):
+		'''
+		This function returns the website as a django HttpResponse.
+		'''
+		from django.http import HttpResponse
+		return HttpResponse(self.generate_site())
 
 	def new_box(self):
 		'''
 		This function sends any text after it to the next box down the screen.
 		'''
-		self._box_list.append( "" )  # Add a new string to box list.  (Each string is the contents of a new box.)
+		self._box_list.append( [] )  # Add a new list to box list.  (Each list holds the contents of a new box.)
 
 
 	def send(self, string):
@@ -97,7 +123,7 @@ class Site:
 		cannot perform cross-site-scripting attacks.
 		'''
 		# Add the string to the bottom most element of the box_list.  (Add to the bottom most box)
-		self._box_list[ len(self._box_list)-1 ] += string + "<br>"
+		self._box_list[-1].append( string + "<br>" )
 	
 	def clean_html(self, string):
 		'''
@@ -107,10 +133,10 @@ class Site:
 		return clean_html(string)
 
 	def has_error(self):
-		return False if self._errors=="" else True
+		return bool(self._errors)
 
 	def has_warning(self):
-		return False if self._warnings=="" else True
+		return bool(self._warnings)
 
 	def send_error(self, bold, notbold=""):
 		'''
@@ -129,7 +155,7 @@ class Site:
 		error_string = '<b><r style="color: red">Error: </r>{}</b>{}'.format(bold, notbold)
 
 		# Even when Debug mode, the error list must be filled so that has_error functions.
-		self._errors += error_string + '<br>'
+		self._errors.append( error_string + '<br>' )
 
 	def send_warning(self, bold, notbold=""):
 		'''
@@ -140,4 +166,4 @@ class Site:
 		warning_string = '<b><r style="color: orange">Warning: </r>{}</b>{}'.format(bold, notbold)
 
 		# Even when Debug mode, the warning list must be filled so that has_warning functions.
-		self._warnings += warning_string + '<br>'
+		self._warnings.append( warning_string + '<br>' )
@@ -0,0 +1,229 @@
+# This module is compatible with python 3.7 #
+
+# Streaming .xlsx export for the tools' result tables. Rows go through openpyxl's write-only
+# worksheets and are written to disk as they are appended, strings inline so there is no shared
+# string table to grow, and the finished workbook is zipped into a spooled temporary file.
+# Memory use stays the same for 100 rows or 100,000.
+#
+# The streaming classes below override private parts of the openpyxl vendored in BBLAB_LIB_PATH,
+# version 2.5.4: WriteOnlyWorksheet._write_header (the generator append() and close() drive),
+# WriteOnlyWorksheet._cleanup, Workbook._add_sheet, ExcelWriter._write_worksheets and a worksheet's
+# _rels. test_xlsx_export.py fails when any of them change, check these classes again before updating.
+
+import os
+import sys
+import tempfile
+
+sys.path.append(os.environ.get("BBLAB_LIB_PATH", "fail"))  # Add the path to openpyxl.
+from openpyxl import Workbook
+from openpyxl.cell import Cell, WriteOnlyCell
+from openpyxl.drawing.spreadsheet_drawing import SpreadsheetDrawing
+from openpyxl.styles import Font, colors
+from openpyxl.utils import get_column_letter
+from openpyxl.worksheet.write_only import WriteOnlyWorksheet
+from openpyxl.writer.etree_worksheet import etree_write_cell
+from openpyxl.writer.excel import ExcelWriter
+from openpyxl.xml.constants import SHEET_MAIN_NS, XML_NS
+from openpyxl.xml.functions import Element, SubElement, tostring
+from openpyxl.packaging.relationship import get_rels_path
+from zipfile import ZipFile, ZIP_DEFLATED
+
+OPENPYXL_VERSION = "2.5.4"  # The openpyxl these overrides were written against.
+
+# Workbooks smaller than this (in bytes) never leave memory, larger ones are moved to a temporary file.
+SPOOL_SIZE = int(os.environ.get("BBLAB_XLSX_SPOOL_SIZE", str(8 * 1024 * 1024)))
+
+CONTENT_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+FAIL_FONT = Font(color=colors.RED)
+
+
+class XlsxSheet:
+    """
+    One worksheet of an XlsxExport. Rows are written out as soon as they are appended, so they
+    can't be changed or styled afterwards; styles are given with the row instead.
+    """
+
+    def __init__(self, worksheet):
+        self._worksheet = worksheet
+        self.rows = 0
+
+    def append(self, row, fonts=None):
+        """
+        Adds a row of values. fonts maps column indexes (from 0) to the Font of that cell.
+        """
+        if fonts:
+            row = [self._styled(value, fonts[i]) if i in fonts else value for i, value in enumerate(row)]
+        self._worksheet.append(row)
+        self.rows += 1
+
+    def _styled(self, value, font):
+        cell = WriteOnlyCell(self._worksheet, value)
+        cell.font = font
+        return cell
+
+    def set_widths(self, widths):
+        """
+        Sets the width of the first len(widths) columns, this must be done before the first row is appended.
+        """
+        for i, width in enumerate(widths, 1):
+            self._worksheet.column_dimensions[get_column_letter(i)].width = width
+
+
+class XlsxExport:
+    """
+    A write-only workbook. Add sheets with add_sheet(), fill them with XlsxSheet.append(), then
+    hand the result to an email with attachment() or to the browser with response().
+    A workbook can only be saved once.
+    """
+
+    def __init__(self):
+        self._workbook = Workbook(write_only=True)
+        self._file = None
+
+    def add_sheet(self, title, header=None):
+        """
+        Returns a new sheet, with header as its first row if given.
+        """
+        worksheet = _StreamingWorksheet(self._workbook, title)
+        self._workbook._add_sheet(worksheet)
+        sheet = XlsxSheet(worksheet)
+        if header is not None:
+            sheet.append(header)
+        return sheet
+
+    def save(self):
+        """
+        Zips the workbook into a spooled temporary file and returns it, positioned at the start.
+        """
+        if self._file is None:
+            if not self._workbook.worksheets:
+                self.add_sheet("Sheet")
+            self._file = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+            archive = ZipFile(self._file, "w", ZIP_DEFLATED, allowZip64=True)
+            try:
+                _StreamingExcelWriter(self._workbook, archive).write_data()
+            finally:
+                archive.close()
+        self._file.seek(0)
+        return self._file
+
+    def attachment(self, filename):
+        """
+        Returns the workbook as an email attachment named filename.xlsx (see mailer.create_file).
+        """
+        import mailer
+
+        return mailer.create_file(filename, "xlsx", self.save().read())
+
+    def response(self, filename):
+        """
+        Returns a response that streams the workbook to the browser as filename.xlsx.
+        """
+        from django.http import FileResponse
+
+        response = FileResponse(self.save(), content_type=CONTENT_TYPE)
+        response["Content-Disposition"] = "inline; filename={}.xlsx".format(filename)
+        return response
+
+    def close(self):
+        """
+        Removes the temporary files of a workbook that won't be saved, or of a saved one.
+        """
+        for worksheet in self._workbook.worksheets:
+            if os.path.exists(worksheet.filename):
+                os.remove(worksheet.filename)
+        if self._file is not None:
+            self._file.close()
+
+
+class _StreamingWorksheet(WriteOnlyWorksheet):
+    """
+    openpyxl's write-only worksheet only streams its rows when lxml is installed, with the
+    standard library's ElementTree it keeps the whole sheet in memory until it is closed.
+    This one writes the xml of every row to its temporary file as the row is appended.
+    """
+
+    def _write_header(self):
+        with open(self.filename, "wb") as out:
+            out.write('<worksheet xmlns="{}">'.format(SHEET_MAIN_NS).encode("utf-8"))
+            self.sheet_format.outlineLevelCol = self.column_dimensions.max_outline
+            for tree in (self.sheet_properties.to_tree(), self.views.to_tree(),
+                         self.sheet_format.to_tree(), self.column_dimensions.to_tree()):
+                if tree is not None:
+                    out.write(tostring(tree))
+
+            out.write(b"<sheetData>")
+            cell = WriteOnlyCell(self)
+            try:
+                while True:
+                    values = (yield)
+                    row = _Row("row", {"r": "%d" % self._max_row})
+                    for col_idx, value in enumerate(values, 1):
+                        if value is None:
+                            continue
+                        if isinstance(value, Cell):
+                            cell = value
+                        else:
+                            cell.value = value
+                        cell.col_idx = col_idx
+                        cell.row = self._max_row
+                        _write_cell(row, self, cell)
+                        if cell.has_style:
+                            cell = WriteOnlyCell(self)
+                    out.write(tostring(row.element))
+            except GeneratorExit:
+                pass
+            out.write(b"</sheetData></worksheet>")
+
+
+class _Row:
+    """
+    Collects the cells openpyxl writes for one row (it only needs a write() method).
+    """
+
+    def __init__(self, tag, attributes):
+        self.element = Element(tag, attributes)
+
+    def write(self, element):
+        self.element.append(element)
+
+
+def _write_cell(row, worksheet, cell):
+    if cell.data_type != "s":
+        etree_write_cell(row, worksheet, cell, cell.has_style)
+        return
+    attributes = {"r": cell.coordinate, "t": "inlineStr"}
+    if cell.has_style:
+        attributes["s"] = "%d" % cell.style_id
+    text = SubElement(SubElement(row.element, "c", attributes), "is")
+    text = SubElement(text, "t")
+    if cell.value != cell.value.strip():
+        text.set("{%s}space" % XML_NS, "preserve")
+    text.text = cell.value
+
+
+class _StreamingExcelWriter(ExcelWriter):
+    """
+    openpyxl's writer reads each finished worksheet back into a string before zipping it;
+    this one copies the worksheet's temporary file into the archive instead.
+    """
+
+    def _write_worksheets(self):
+        for idx, ws in enumerate(self.workbook.worksheets, 1):
+            ws._id = idx
+            ws._drawing = SpreadsheetDrawing()
+            ws.close()
+            self._archive.write(ws.filename, ws.path[1:])
+            ws._cleanup()
+            self.manifest.append(ws)
+
+            if ws._rels:
+                self._archive.writestr(get_rels_path(ws.path)[1:], tostring(ws._rels.to_tree()))
+
+
+def fail_fonts(row, first_column=1):
+    """
+    Returns the fonts for XlsxSheet.append() that colour every "FAIL..." value of row red,
+    starting at first_column.
+    """
+    return {i: FAIL_FONT for i, value in enumerate(row) if i >= first_column and str(value)[:4] == "FAIL"}
@@ -0,0 +1,186 @@
+// Virtualized result table.
+// Shows a result table stored on the server (depend/util_scripts/result_table.py) a screenful at a time:
+// only the rows and columns in view are fetched from the job's rows/ url and put in the page,
+// so large results load as fast as small ones. Click a column header to sort by it.
+//
+// Usage: <div class="result-table" data-url="rows/" data-column-width="120"></div>
+
+
+(function() {
+    if (window.ResultTable) {
+        return;  // Already loaded (the script is included once per table).
+    }
+
+    var ROW_HEIGHT = 24;  // pixels
+    var BLOCK_ROWS = 100;  // Rows and columns fetched per request.
+    var BLOCK_COLUMNS = 50;
+    var HEIGHT = 600;
+
+    var STYLE = (
+        ".result-table { border: 1px solid #aaa; overflow: auto; position: relative; font: 13px monospace; background: #fff; }" +
+        ".result-table .rt-canvas { position: relative; }" +
+        ".result-table .rt-header { position: sticky; top: 0; z-index: 1; background: #dde; }" +
+        ".result-table .rt-cell { position: absolute; box-sizing: border-box; padding: 0 4px; overflow: hidden; " +
+        "  white-space: nowrap; text-overflow: ellipsis; border-right: 1px solid #ddd; border-bottom: 1px solid #eee; }" +
+        ".result-table .rt-header .rt-cell { font-weight: bold; cursor: pointer; border-bottom: 1px solid #aaa; }" +
+        ".result-table .rt-loading { color: #aaa; }"
+    );
+
+    function ResultTable(element) {
+        this.element = element;
+        this.url = element.getAttribute("data-url");
+        this.columnWidth = parseInt(element.getAttribute("data-column-width") || "120", 10);
+        this.columns = [];
+        this.total = 0;
+        this.sort = null;
+        this.descending = false;
+        this.blocks = {};  // "rowBlock,columnBlock" -> rows, or null while the request is out.
+        this.generation = 0;  // Changes with the sort order, so late answers for an old order are dropped.
+
+        element.style.height = HEIGHT + "px";
+        this.canvas = document.createElement("div");
+        this.canvas.className = "rt-canvas";
+        this.header = document.createElement("div");
+        this.header.className = "rt-header";
+        this.body = document.createElement("div");
+        this.canvas.appendChild(this.header);
+        this.canvas.appendChild(this.body);
+        element.appendChild(this.canvas);
+
+        var table = this;
+        var scheduled = false;
+        element.addEventListener("scroll", function() {
+            if (!scheduled) {
+                scheduled = true;
+                window.requestAnimationFrame(function() {
+                    scheduled = false;
+                    table.render();
+                });
+            }
+        });
+        this.header.addEventListener("click", function(event) {
+            var column = event.target.getAttribute("data-column");
+            if (column !== null) {
+                table.sortBy(parseInt(column, 10));
+            }
+        });
+
+        this.fetch(0, 0, 0, function(data) {  // Just the column names and row count.
+            table.columns = data.columns;
+            table.total = data.total;
+            table.canvas.style.width = (table.columns.length * table.columnWidth) + "px";
+            table.canvas.style.height = ((table.total + 1) * ROW_HEIGHT) + "px";
+            table.header.style.height = ROW_HEIGHT + "px";
+            table.render();
+        });
+    }
+
+    ResultTable.prototype.fetch = function(rowBlock, columnBlock, limit, callback) {
+        var query = ["offset=" + rowBlock * BLOCK_ROWS, "limit=" + limit,
+                     "col_offset=" + columnBlock * BLOCK_COLUMNS, "col_limit=" + BLOCK_COLUMNS];
+        if (this.sort !== null) {
+            query.push("sort=" + this.sort, "order=" + (this.descending ? "desc" : "asc"));
+        }
+        return fetch(this.url + "?" + query.join("&")).then(function(response) {
+            if (!response.ok) {
+                throw new Error(response.statusText);
+            }
+            return response.json();
+        }).then(callback);
+    };
+
+    ResultTable.prototype.block = function(rowBlock, columnBlock) {
+        var key = rowBlock + "," + columnBlock;
+        if (key in this.blocks) {
+            return this.blocks[key];
+        }
+        this.blocks[key] = null;
+        var table = this;
+        var generation = this.generation;
+        this.fetch(rowBlock, columnBlock, BLOCK_ROWS, function(data) {
+            if (generation == table.generation) {
+                table.blocks[key] = data.rows;
+                table.render();
+            }
+        }).catch(function() {
+            if (generation == table.generation) {
+                delete table.blocks[key];  // Asked for again at the next scroll.
+            }
+        });
+        return null;
+    };
+
+    ResultTable.prototype.sortBy = function(column) {
+        this.descending = (this.sort === column) ? !this.descending : false;
+        this.sort = column;
+        this.blocks = {};
+        this.generation++;
+        this.render();
+    };
+
+    function cell(text, top, left, width) {
+        var div = document.createElement("div");
+        div.className = "rt-cell";
+        div.style.top = top + "px";
+        div.style.left = left + "px";
+        div.style.width = width + "px";
+        div.style.height = ROW_HEIGHT + "px";
+        div.style.lineHeight = ROW_HEIGHT + "px";
+        div.textContent = text;
+        div.title = text;
+        return div;
+    }
+
+    ResultTable.prototype.render = function() {
+        var element = this.element;
+        var width = this.columnWidth;
+        var firstRow = Math.floor(element.scrollTop / ROW_HEIGHT);
+        var lastRow = Math.min(this.total, firstRow + Math.ceil(element.clientHeight / ROW_HEIGHT) + 1);
+        var firstColumn = Math.floor(element.scrollLeft / width);
+        var lastColumn = Math.min(this.columns.length, firstColumn + Math.ceil(element.clientWidth / width) + 1);
+
+        var header = document.createDocumentFragment();
+        for (var c = firstColumn; c < lastColumn; c++) {
+            var arrow = (c === this.sort) ? (this.descending ? " ▼" : " ▲") : "";
+            var th = cell(this.columns[c] + arrow, 0, c * width, width);
+            th.setAttribute("data-column", c);
+            header.appendChild(th);
+        }
+        this.header.replaceChildren(header);
+
+        var body = document.createDocumentFragment();
+        for (var r = firstRow; r < lastRow; r++) {
+            for (var c = firstColumn; c < lastColumn; c++) {
+                var rows = this.block(Math.floor(r / BLOCK_ROWS), Math.floor(c / BLOCK_COLUMNS));
+                var td;
+                if (rows === null) {
+                    td = cell("…", (r + 1) * ROW_HEIGHT, c * width, width);
+                    td.className += " rt-loading";
+                } else {
+                    var value = rows[r % BLOCK_ROWS][c % BLOCK_COLUMNS];
+                    td = cell(value === null || value === undefined ? "" : String(value), (r + 1) * ROW_HEIGHT, c * width, width);
+                }
+                body.appendChild(td);
+            }
+        }
+        this.body.replaceChildren(body);
+    };
+
+    window.ResultTable = ResultTable;
+
+    function start() {
+        var style = document.createElement("style");
+        style.textContent = STYLE;
+        document.head.appendChild(style);
+        var elements = document.querySelectorAll(".result-table");
+        for (var i = 0; i < elements.length; i++) {
+            new ResultTable(elements[i]);
+        }
+    }
+
+    if (document.readyState == "loading") {
+        document.addEventListener("DOMContentLoaded", start);
+    } else {
+        start();
+    }
+})();
@@ -1,5 +1,6 @@
 var dirNum = "";  // global variable
-var interval;
+var statusSince = 0;  // sequence number of the last status message received
+var statusText = "";
 
 
 // ************************************************************************* //
@@ -72,7 +73,7 @@ $('#mainForm').on('submit', function(event){
 $('#terminateBtn').on('click', function(event){
     event.preventDefault();
     //if(dirNum != "") {
-        terminateDirectory(dirNum, interval);
+        terminateDirectory(dirNum);
     //} else {
     //    console.log("no dirNum -> this does nothing")
     //}
@@ -85,7 +86,7 @@ function requestDirectory() {
     
     // destroy old directory before making a new one.
     if(dirNum != "") {  
-        terminateDirectory(dirNum, interval);
+        terminateDirectory(dirNum);
     }
 
     $.ajax({
@@ -96,7 +97,9 @@ function requestDirectory() {
         // handle a successful response
         success : function(json) {
 	    dirNum = json["dirNum"];
-            interval = setInterval( getStatus, 2000, dirNum );  // get status every two seconds
+            statusSince = 0;
+            statusText = "";
+            getStatus(dirNum);  // long-polls for status messages until the run is done
             
             console.log(dirNum);
             startPipeline(dirNum);
@@ -133,7 +136,7 @@ function startPipeline(directoryNumber) {
                 $('#results').html( "<p>Successfully started pipeline</p>" )  // empties the results area.  
             } else {
                 console.log(response + " -> termination")
-                terminateDirectory(directoryNumber, interval);
+                terminateDirectory(directoryNumber);
             }
             
             // This listens for input processing stage errors.
@@ -147,6 +150,10 @@ function startPipeline(directoryNumber) {
                 $('#info').html( $('#info').html() + "<p>Please sumbit the two needed files</p>" )  
             } else if (response == "file too big") {
                 $('#info').html( $('#info').html() + "<p>At least one of your files is too big (over 50mb), you may ask for this value to be increased by contacting the server admin.</p>" )  
+            } else if (response == "file empty") {
+                $('#info').html( $('#info').html() + "<p>At least one of your files is empty.</p>" )  
+            } else if (response == "file not utf-8") {
+                $('#info').html( $('#info').html() + "<p>Your files must be text files (utf-8).</p>" )  
             } else if (response == "need email") {
                 $('#info').html( $('#info').html() + "<p>You must submit a valid email address in order to recieve an email.</p>" )  
             }
@@ -164,9 +171,8 @@ function startPipeline(directoryNumber) {
 }
 
 
-function terminateDirectory(directoryNumber, runningInterval) {
+function terminateDirectory(directoryNumber) {
     console.log("terminating directory " + directoryNumber);
-    clearInterval( runningInterval );
     if(dirNum == "") {
         return
     } else {    
@@ -193,37 +199,48 @@ function terminateDirectory(directoryNumber, runningInterval) {
     });
 }
 
+// The server answers as soon as there are new status messages (or after a while without any),
+// then the next request is sent. Polling stops when the run is done or dirNum changes.
 function getStatus(directoryNumber) {
     $.ajax({
         url : "get_status/", // endpoint
         type : "GET",
-        data : { "dirNum" : directoryNumber },
+        data : { "dirNum" : directoryNumber, "since" : statusSince },
+        dataType : "json",
 	cache : false,
 
         // handle a successful response
-        success : function(response) {
-            if (response == "directory not assigned") {
-                $('#results').html($('#results').html() + "<p>Your internal directory has not been assigned, try refreshing the page or contacting the server admin.</p>" )  
-                $("#info").html( response );
-            } else if( response == "request download" ) {
-                // send download file request.
-                downloadFile(dirNum);
-                $("#info").html( "file downloaded" );
-            } else if (response == "no download") {
-                $('#info').html("analysis completed (file emailed)");
-                clearInterval(interval);
-            } else if (response == "requested status doesn't exist") {
-                clearInterval(interval);
-                $("#info").html( response + ". (There was likely an error with your analysis.)" );
-            } else if (response.split("\n")[response.split("\n").length - 2] == "done") {
-                $("#info").html( response );
-                clearInterval(interval);
-                console.log("done!");
-            } else {
-                $("#info").html( response );
+        success : function(status) {
+            if (directoryNumber != dirNum) {
+                return;  // terminated, or a new run was started.
             }
 
-            console.log(response);
+            if (status["state"] == "missing") {
+                $("#info").html( "requested status doesn't exist. (There was likely an error with your analysis.)" );
+                return;
+            }
+
+            statusSince = status["since"];
+            var messages = status["messages"];
+            for (var i = 0; i < messages.length; i++) {
+                if (messages[i] == "request download") {
+                    // send download file request.
+                    downloadFile(directoryNumber);
+                    $("#info").html( "file downloaded" );
+                    return;
+                } else if (messages[i] == "no download") {
+                    $('#info').html("analysis completed (file emailed)");
+                    return;
+                }
+                statusText += messages[i] + "\n";
+            }
+            $("#info").html( statusText );
+
+            if (messages.indexOf("done") != -1 || (messages.length == 0 && status["state"] != "queued" && status["state"] != "running")) {
+                console.log("done!");
+                return;
+            }
+            getStatus(directoryNumber);
         },
 
         // handle a non-successful response
@@ -237,16 +254,9 @@ function getStatus(directoryNumber) {
 }
 
 // If the site adddress changes, this will break.
+// A plain GET link, so the browser can resume an interrupted download.
 function downloadFile(directoryNumber) {
-    clearInterval(interval);
-    // redirect to "download_file/"
-    var url = document.location.origin + "/django/tools/tcr_distance/download_file/"
-    var form = $( '<form action="' + url + '" method="post">' +
-                  '<input type="hidden" name="csrfmiddlewaretoken" value="' + $( "#mainForm > input" ).val() + '">' + 
-                  '<input type="hidden" name="dirNum" value="' + directoryNumber + '" />' + 
-                  '</form>' );
-    $('body').append(form);
-    form.submit();
+    window.location = document.location.origin + "/django/tools/tcr_distance/download_file/?dirNum=" + encodeURIComponent(directoryNumber);
 
     dirNum = "";
 }
@@ -0,0 +1,115 @@
+"""
+Parity tests for the vectorized codon by codon statistics against a per-column scipy.stats.kruskal reference.
+"""
+
+import os
+import random
+import sys
+
+import pytest
+from scipy import stats
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(BASE_DIR, 'depend', 'util_scripts'))
+sys.path.append(os.path.join(BASE_DIR, 'depend', 'operations'))
+import math_utils
+import op_codon_by_codon
+
+# Codon by codon test run (tools/codon_by_codon/index.html) and its recorded output (tests/codon_by_codon/test_codon_by_codon.xlsx).
+EXPECTED_ROWS = [
+    (63, 'E', 0.467, 0.982, 3, 3, 0.049535),
+    (33, 'V', 0.982, 0.467, 3, 3, 0.12663),
+    (43, 'I', 0.982, 0.467, 3, 3, 0.12663),
+    (168, 'M', 0.982, 0.467, 3, 3, 0.12663),
+    (182, 'V', 0.467, 0.982, 3, 3, 0.12663),
+    (15, 'T', 0.786, 0.982, 3, 3, 0.27523),
+    (98, 'E', 0.467, 0.801, 3, 3, 0.27523),
+    (138, 'C', 0.786, 0.982, 3, 3, 0.27523),
+    (138, 'T', 0.982, 0.786, 3, 3, 0.27523),
+    (184, 'K', 0.786, 0.982, 3, 3, 0.27523),
+    (184, 'R', 0.982, 0.786, 3, 3, 0.27523),
+    (192, 'H', 0.786, 0.982, 3, 3, 0.27523),
+    (39, 'K', 0.786, 0.801, 3, 3, 0.51269),
+    (39, 'R', 0.801, 0.786, 3, 3, 0.51269),
+    (150, 'P', 0.786, 0.801, 3, 3, 0.82726),
+    (188, 'R', 0.786, 0.801, 3, 3, 0.82726),
+]
+
+
+def reference_rows(protein_sequences, min_count):
+    """
+    The column by column computation the vectorized version replaced.
+    """
+    rows = []
+    for column in range(len(protein_sequences[0][1])):
+        data = {}
+        for decimal, sequence in protein_sequences:
+            if sequence[column] not in ['X', '-', '_']:
+                data.setdefault(sequence[column], []).append(float(decimal))
+        if len(data) < 2:
+            continue
+        total = sum(len(values) for values in data.values())
+        for char, values in data.items():
+            if len(values) < min_count or total - len(values) < min_count:
+                continue
+            others = [v for c, vs in data.items() if c != char for v in vs]
+            if len(values) < 2 or len(others) < 2:
+                p_value = 1.0
+            elif len(set(values)) == 1 and len(set(others)) == 1:
+                p_value = 1.0
+            else:
+                p_value = math_utils.round_sf(stats.kruskal(values, others)[1], 5)
+            rows.append((column + 1, char, math_utils.median(values), math_utils.median(others),
+                         len(values), len(others), p_value))
+    return rows
+
+
+def load_test_input():
+    with open(os.path.join(BASE_DIR, 'tools', 'codon_by_codon', 'index.html')) as f:
+        html = f.read()
+    start = html.index('>', html.index('name="functionProtein"')) + 1
+    text = html[start:html.index('</textarea>', start)]
+    return [tuple(line.replace(' ', '').split('\t')) for line in text.splitlines() if line.strip()]
+
+
+def rows_of(output_matrix):
+    return [tuple(item.get_formatted_row()[:7]) for item in output_matrix]
+
+
+def test_recorded_output():
+    output_matrix = op_codon_by_codon.get_output_matrix(load_test_input(), 3)
+    rows = sorted(rows_of(output_matrix), key=lambda row: row[6])
+    assert rows == EXPECTED_ROWS
+
+
+@pytest.mark.parametrize('seed', range(8))
+def test_matches_reference(seed):
+    rng = random.Random(seed)
+    patients = rng.randint(4, 60)
+    length = rng.randint(1, 40)
+    alphabet = rng.choice(['KR', 'KRE', 'ACDEFGHIKLMNPQRSTVWY', 'KRX-'])
+    # Few distinct phenotypes so ties are common.
+    decimals = [str(rng.choice(range(10)) / 4) if rng.random() < 0.5 else str(rng.random()) for _ in range(patients)]
+    protein_sequences = [(decimal, ''.join(rng.choice(alphabet) for _ in range(length))) for decimal in decimals]
+    min_count = rng.randint(1, 4)
+
+    rows = rows_of(op_codon_by_codon.get_output_matrix(protein_sequences, min_count))
+    expected = reference_rows(protein_sequences, min_count)
+    assert [row[:6] for row in rows] == [row[:6] for row in expected]
+    assert [row[6] for row in rows] == [row[6] for row in expected]
+
+
+def test_unequal_lengths():
+    with pytest.raises(ValueError):
+        op_codon_by_codon.get_output_matrix([('1', 'KR'), ('2', 'K')], 1)
+
+
+def test_parallel_matches_serial(monkeypatch):
+    monkeypatch.setattr(op_codon_by_codon, 'MIN_SHARD_COLUMNS', 16)
+    rng = random.Random(11)
+    protein_sequences = [(str(rng.randint(0, 20) / 8), ''.join(rng.choice('KREX') for _ in range(150)))
+                         for _ in range(40)]
+
+    serial = op_codon_by_codon.get_output_matrix(protein_sequences, 2, workers=1)
+    parallel = op_codon_by_codon.get_output_matrix(protein_sequences, 2, workers=3)
+    assert [item.get_formatted_row() for item in parallel] == [item.get_formatted_row() for item in serial]
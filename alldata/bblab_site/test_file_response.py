@@ -0,0 +1,125 @@
+"""
+Tests for django_utils.file_response, the chunked file download with Range support,
+and django_utils.save_upload, the chunked upload written to disk.
+"""
+
+import os
+import sys
+import tracemalloc
+
+import pytest
+from django.conf import settings
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'depend', 'util_scripts'))
+
+if not settings.configured:
+    settings.configure()
+
+from django.core.files.uploadedfile import SimpleUploadedFile, TemporaryUploadedFile
+from django.test import RequestFactory
+import django_utils
+
+DATA = bytes(range(256)) * 1000
+
+
+@pytest.fixture
+def path(tmp_path):
+    path = tmp_path / 'matrices.zip'
+    path.write_bytes(DATA)
+    return str(path)
+
+
+def get(path, on_complete=None, **headers):
+    request = RequestFactory().get('/download_file/', **headers)
+    response = django_utils.file_response(request, path, 'application/zip', 'matrices.zip',
+                                          on_complete=on_complete, chunk_size=1000)
+    body = b''.join(response.streaming_content) if response.status_code != 416 else b''
+    return response, body
+
+
+def test_whole_file(path):
+    completed = []
+    response, body = get(path, on_complete=lambda: completed.append(True))
+    assert response.status_code == 200
+    assert body == DATA
+    assert response['Content-Length'] == str(len(DATA))
+    assert response['Accept-Ranges'] == 'bytes'
+    assert completed == [True]
+
+
+@pytest.mark.parametrize('header, start, end', [
+    ('bytes=0-99', 0, 99),
+    ('bytes=1000-', 1000, len(DATA) - 1),
+    ('bytes=-500', len(DATA) - 500, len(DATA) - 1),
+    ('bytes=255000-999999', 255000, len(DATA) - 1),
+])
+def test_ranges(path, header, start, end):
+    response, body = get(path, HTTP_RANGE=header)
+    assert response.status_code == 206
+    assert body == DATA[start:end + 1]
+    assert response['Content-Range'] == 'bytes {}-{}/{}'.format(start, end, len(DATA))
+    assert response['Content-Length'] == str(end - start + 1)
+
+
+def test_on_complete_only_after_the_last_byte(path):
+    completed = []
+    get(path, on_complete=lambda: completed.append(True), HTTP_RANGE='bytes=0-99')
+    assert completed == []
+    get(path, on_complete=lambda: completed.append(True), HTTP_RANGE='bytes=100-')
+    assert completed == [True]
+
+
+def test_unsatisfiable_range(path):
+    response, _ = get(path, HTTP_RANGE='bytes={}-'.format(len(DATA)))
+    assert response.status_code == 416
+    assert response['Content-Range'] == 'bytes */{}'.format(len(DATA))
+
+
+def test_stale_if_range_gets_the_whole_file(path):
+    response, body = get(path, HTTP_RANGE='bytes=0-99', HTTP_IF_RANGE='Mon, 01 Jan 2001 00:00:00 GMT')
+    assert response.status_code == 200
+    assert body == DATA
+
+
+def test_unsupported_range_gets_the_whole_file(path):
+    response, body = get(path, HTTP_RANGE='bytes=0-9,20-29')
+    assert response.status_code == 200
+    assert body == DATA
+
+
+def test_save_upload(tmp_path):
+    text = 'cdr3\tα β γ\r\n'.encode('utf-8') * 1000
+    path = str(tmp_path / 'clones_file')
+    django_utils.save_upload(SimpleUploadedFile('clones.tsv', text), path, chunk_size=1001)  # Chunks split characters.
+    with open(path, 'rb') as file:
+        assert file.read() == text
+    assert os.listdir(str(tmp_path)) == ['clones_file']
+
+
+def test_save_upload_not_utf8(tmp_path):
+    path = str(tmp_path / 'clones_file')
+    with pytest.raises(UnicodeDecodeError):
+        django_utils.save_upload(SimpleUploadedFile('clones.tsv', b'cdr3\t\xff\n' * 10), path)
+    with pytest.raises(UnicodeDecodeError):
+        django_utils.save_upload(SimpleUploadedFile('clones.tsv', 'α'.encode('utf-8')[:1]), path)
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_save_large_upload(tmp_path):
+    size = 50 * 1024 * 1024
+    upload = TemporaryUploadedFile('annotations.csv', 'text/csv', size, 'utf-8')
+    line = b'AAACCTGAGAAACCAT-1,True,AAACCTGAGAAACCAT-1_contig_1,True,556,TRA,TRAV8-3\n'
+    for _ in range(size // len(line)):
+        upload.write(line)
+    upload.seek(0)
+    path = str(tmp_path / 'filtered_contig_annotations.tsv')
+
+    tracemalloc.start()
+    try:
+        django_utils.save_upload(upload, path)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+        upload.close()
+    assert os.path.getsize(path) == size // len(line) * len(line)
+    assert peak < 1024 * 1024  # A chunk at a time, not the whole file.
@@ -0,0 +1,292 @@
+"""
+Tests for the tools' job queue, running the worker side in-process.
+"""
+
+import os
+import subprocess
+import sys
+import textwrap
+import time
+
+import pytest
+from django.conf import settings
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(BASE_DIR, 'depend', 'util_scripts'))
+import job_queue
+
+if not settings.configured:
+    settings.configure()
+
+
+def add(a, b=0):
+    return a + b
+
+
+def read_upload(file):
+    return file.read().decode('utf-8')
+
+
+def explode():
+    raise ValueError('bad input')
+
+
+class FakeUpload:
+    """
+    Looks like a django UploadedFile.
+    """
+
+    def __init__(self, data):
+        self.data = data
+
+    def chunks(self):
+        yield self.data[:3]
+        yield self.data[3:]
+
+
+@pytest.fixture
+def queue(tmp_path):
+    return job_queue.JobQueue(str(tmp_path / 'jobs.sqlite3'), str(tmp_path / 'jobs'))
+
+
+def run_next(queue):
+    claimed = queue.claim(os.getpid())
+    assert claimed is not None
+    job_queue.run_job(queue, *claimed)
+    return claimed[0]
+
+
+def test_submit_and_run(queue):
+    job_id = queue.submit(add, 2, b=3)
+    assert queue.get(job_id)['status'] == job_queue.QUEUED
+    assert queue.get(job_id)['position'] == 1
+    assert queue.result(job_id) is None
+
+    assert run_next(queue) == job_id
+    assert queue.get(job_id)['status'] == job_queue.DONE
+    assert queue.result(job_id) == 5
+    assert queue.claim(os.getpid()) is None
+
+
+def test_jobs_run_in_submission_order(queue):
+    job_ids = [queue.submit(add, i) for i in range(5)]
+    assert [queue.get(job_id)['position'] for job_id in job_ids] == [1, 2, 3, 4, 5]
+    assert [run_next(queue) for _ in job_ids] == job_ids
+
+
+def test_uploads_are_saved_with_the_job(queue):
+    job_id = queue.submit(read_upload, FakeUpload(b'>seq\nACGT\n'))
+    assert os.listdir(queue.job_path(job_id)) == ['arg0']
+    run_next(queue)
+    assert queue.result(job_id) == '>seq\nACGT\n'
+
+
+def test_failed_job(queue):
+    job_id = queue.submit(explode)
+    run_next(queue)
+    job = queue.get(job_id)
+    assert job['status'] == job_queue.FAILED
+    assert 'ValueError: bad input' in job['error']
+
+
+def test_failed_job_page(queue, monkeypatch):
+    import django
+    from django.test import RequestFactory, override_settings
+    from tools.jobs import views
+
+    django.setup()  # static() asks the app registry whether staticfiles is installed.
+    monkeypatch.setattr(job_queue, '_queue', queue)
+    job_id = queue.submit(explode)
+    run_next(queue)
+    request = RequestFactory().get('/')
+    request.user = type('AnonymousUser', (), {'is_authenticated': False})()
+    templates = [{'BACKEND': 'django.template.backends.django.DjangoTemplates',
+                  'DIRS': [os.path.join(BASE_DIR, 'templates'), os.path.join(BASE_DIR, 'tools')]}]
+    with override_settings(TEMPLATES=templates, STATIC_URL='/static/'):
+        page = views.job(request, job_id).content.decode()
+    assert 'the analysis failed' in page
+    assert '<pre>ValueError: bad input</pre>' in page
+    assert 'Traceback' not in page
+
+
+def test_cancel(queue):
+    job_id = queue.submit(add, 1)
+    assert queue.cancel(job_id)
+    assert queue.get(job_id)['status'] == job_queue.CANCELLED
+    assert queue.claim(os.getpid()) is None
+    assert not queue.cancel(job_id)
+
+
+def test_orphaned_jobs_are_requeued(queue):
+    job_id = queue.submit(add, 1)
+    queue.claim(12345)
+
+    assert queue.requeue_orphans([12345]) == 0
+    assert queue.get(job_id)['status'] == job_queue.RUNNING
+
+    # The worker died, or the workers were restarted.
+    assert queue.requeue_orphans() == 1
+    assert queue.get(job_id)['status'] == job_queue.QUEUED
+    run_next(queue)
+    assert queue.result(job_id) == 1
+
+
+def test_job_that_keeps_killing_workers_fails(queue):
+    job_id = queue.submit(add, 1)
+    for _ in range(job_queue.JOB_MAX_ATTEMPTS):
+        queue.claim(12345)
+        queue.requeue_orphans()
+    assert queue.get(job_id)['status'] == job_queue.FAILED
+
+
+def test_cleanup(queue):
+    old_job = queue.submit(read_upload, FakeUpload(b'data'))
+    new_job = queue.submit(add, 1)
+    run_next(queue)
+    time.sleep(0.01)
+    cutoff = time.time()
+    run_next(queue)
+
+    assert queue.cleanup(max_age=time.time() - cutoff) == 1
+    assert queue.get(old_job) is None
+    assert not os.path.exists(queue.job_path(old_job))
+    assert queue.get(new_job)['status'] == job_queue.DONE
+    assert queue.stats() == {job_queue.DONE: 1}
+
+
+def plot(svg):
+    return job_queue.save_file(job_queue.current_job_path(), svg, 'svg')
+
+
+def test_saved_files_are_named_by_content(queue):
+    first = queue.submit(plot, '<svg>1</svg>')
+    second = queue.submit(plot, '<svg>2</svg>')
+    run_next(queue)
+    run_next(queue)
+    name = queue.result(first)
+    assert job_queue.JOB_FILE_NAME.match(name) and name.endswith('.svg')
+    assert name != queue.result(second)
+    with open(os.path.join(queue.job_path(first), name)) as file:
+        assert file.read() == '<svg>1</svg>'
+
+    # Saving the same content again keeps the file.
+    assert job_queue.save_file(queue.job_path(first), b'<svg>1</svg>', 'svg') == name
+    assert os.listdir(queue.job_path(first)) == [name]
+
+
+def test_job_file_view(queue, monkeypatch):
+    from django.http import Http404
+    from django.test import RequestFactory
+    from tools.jobs import views
+
+    monkeypatch.setattr(job_queue, '_queue', queue)
+    url = job_queue.save_output('isoforms_plot', '<svg>plot</svg>', 'svg')
+    job_id, name = url.split('/')[-3], url.split('/')[-1]
+    assert url == job_queue.FILE_URL.format(job_id, name)
+    assert queue.get(job_id)['status'] == job_queue.DONE
+
+    response = views.job_file(RequestFactory().get(url), job_id, name)
+    assert response['Content-Type'] == 'image/svg+xml'
+    assert 'immutable' in response['Cache-Control']
+    assert b''.join(response.streaming_content) == b'<svg>plot</svg>'
+
+    for bad_name in ['../jobs.sqlite3', 'missing.svg', name.replace('.svg', '.png')]:
+        with pytest.raises(Http404):
+            views.job_file(RequestFactory().get(url), job_id, bad_name)
+
+
+def test_gzipped_copy_is_sent_when_accepted(queue, monkeypatch):
+    from django.test import RequestFactory
+    from tools.jobs import views
+    import svg_output
+
+    monkeypatch.setattr(job_queue, '_queue', queue)
+    svg = '<svg>' + '<rect class="s0"/>' * 100 + '</svg>'
+    url = job_queue.save_output('proviral_landscape_plot', svg, 'svg', svg_output.gzip_bytes(svg))
+    job_id, name = url.split('/')[-3], url.split('/')[-1]
+
+    response = views.job_file(RequestFactory().get(url, HTTP_ACCEPT_ENCODING='gzip, deflate, br'), job_id, name)
+    assert response['Content-Encoding'] == 'gzip'
+    assert response['Content-Type'] == 'image/svg+xml'
+    assert response['Vary'] == 'Accept-Encoding'
+    body = b''.join(response.streaming_content)
+    assert int(response['Content-Length']) == len(body) < len(svg)
+    assert svg_output.gzip_bytes(svg) == body
+
+    response = views.job_file(RequestFactory().get(url), job_id, name)
+    assert not response.has_header('Content-Encoding')
+    assert b''.join(response.streaming_content) == svg.encode()
+
+
+def parallel_codon_by_codon():
+    sys.path.append(os.path.join(BASE_DIR, 'depend', 'operations'))
+    import op_codon_by_codon
+
+    protein_sequences = [(str(i % 7), ''.join('KR'[(i * j) % 3 == 0] for j in range(150))) for i in range(40)]
+    return len(op_codon_by_codon.get_output_matrix(protein_sequences, 2, workers=2))
+
+
+def test_jobs_can_start_processes(queue):
+    # Workers aren't daemonic, daemonic processes can't have children.
+    job_id = queue.submit(parallel_codon_by_codon)
+    worker = job_queue.start_worker(queue, poll_interval=0.05)
+    try:
+        deadline = time.time() + 60
+        while queue.get(job_id)['status'] not in job_queue.FINISHED_STATES and time.time() < deadline:
+            time.sleep(0.05)
+    finally:
+        worker.terminate()
+        worker.join()
+    job = queue.get(job_id)
+    assert job['status'] == job_queue.DONE, job['error']
+    assert queue.result(job_id) > 0
+
+
+def run_in_worker(tmp_path, submit):
+    """
+    Runs the job queued by the submit code in a new process set up like the workers, without
+    configuring Django first. Returns the job's status and result.
+    """
+    (tmp_path / 'worker_settings.py').write_text("STATIC_URL = '/static/'\n")
+    script = textwrap.dedent('''
+        import os, sys
+        import job_queue, mailer
+        mailer.send_sfu_email = lambda *args, **kwargs: 1
+        queue = job_queue.JobQueue({db!r}, {jobs!r})
+        {submit}
+        job_queue.run_job(queue, *queue.claim(os.getpid()))
+        print(queue.get(job_id)['status'])
+        print(queue.get(job_id)['error'] or queue.result(job_id))
+    ''').format(db=str(tmp_path / 'jobs.sqlite3'), jobs=str(tmp_path / 'jobs'), submit=submit)
+    util_path = os.path.join(BASE_DIR, 'depend', 'util_scripts') + '/'
+    env = dict(os.environ,
+               BBLAB_UTIL_PATH=util_path,
+               BBLAB_OP_PATH=os.path.join(BASE_DIR, 'depend', 'operations') + '/',
+               BBLAB_LIB_PATH=os.path.join(BASE_DIR, 'depend', 'libraries') + '/',
+               DJANGO_SETTINGS_MODULE='worker_settings',
+               PYTHONPATH=os.pathsep.join([str(tmp_path), BASE_DIR, util_path]))
+    output = subprocess.run([sys.executable, '-c', script], env=env, cwd=str(tmp_path),
+                            stdout=subprocess.PIPE, universal_newlines=True, check=True).stdout
+    status, result = output.split('\n', 1)
+    return status, result
+
+
+def test_tool_runs_in_worker(tmp_path):
+    status, result = run_in_worker(tmp_path, textwrap.dedent('''
+        from tools.unique_sequence import unique_sequence
+        job_id = queue.submit(unique_sequence.run, '>a\\nACGT\\n>b\\nACGT\\n', '', 'someone@example.com')
+    '''))
+    assert status == job_queue.DONE, result
+    assert '/static/' in result
+
+
+def test_result_table_viewer_in_worker(tmp_path):
+    # Codon by codon shows its table with result_table.viewer_html() when it's run by the queue.
+    status, result = run_in_worker(tmp_path, textwrap.dedent('''
+        from tools.codon_by_codon import codon_by_codon
+        rows = ''.join('{}\\tK{}\\n'.format(i, 'KR'[i % 2]) for i in range(20))
+        job_id = queue.submit(codon_by_codon.run, rows, '3', '', 'someone@example.com')
+    '''))
+    assert status == job_queue.DONE, result
+    assert 'class="result-table"' in result
+    assert '/static/result_table.js' in result
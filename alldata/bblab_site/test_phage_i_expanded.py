@@ -0,0 +1,197 @@
+"""
+Tests for PHAGE-I-expanded's translation, epitope database and lookups.
+"""
+
+import os
+import random
+import shutil
+import sys
+import time
+
+import pytest
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(BASE_DIR, 'depend', 'util_scripts'))
+import result_cache
+from tools.phage_i_expanded.scripts import PHAGE
+
+EPITOPES_FILE = os.path.join(BASE_DIR, 'tools', 'phage_i_expanded', PHAGE.EPITOPES_FILE)
+
+
+@pytest.mark.parametrize('sequence, flag, expected', [
+    ('ATG GCC\r\nTAA\nGG', 3, ['M', 'A', '*']),  # The last, incomplete codon is left out.
+    ('---XXXA-GX-T', 3, ['-', '-', '?', '?']),
+    ('TTYRAYatr', 1, ['X', 'X', 'X']),
+    ('TTYRAYatr', 2, ['F', 'X', 'X']),
+    ('TTYRAYNNN', 3, ['F', '[D/N]', None]),
+    ('AUGTT', 3, []),  # Can't be resolved.
+])
+def test_translate(sequence, flag, expected):
+    translated = PHAGE.translateDNA(sequence, flag=flag)
+    assert len(translated) == len(expected)
+    for aa, expected_aa in zip(translated, expected):
+        if expected_aa and expected_aa.startswith('['):
+            assert sorted(aa[1:-1].split('/')) == expected_aa[1:-1].split('/')  # The order of a mixture's amino acids varies.
+        elif expected_aa:
+            assert aa == expected_aa
+    assert PHAGE.translateDNA(sequence, resolvecharacter='#', flag=flag) == [
+        '#' if aa == 'X' and flag in (1, 2) else aa for aa in translated
+    ]
+
+
+@pytest.mark.benchmark
+def test_translating_pol_is_fast():
+    rng = random.Random(1)
+    sequences = [''.join(rng.choice('ACGT' * 30 + 'RYKMSWN') for _ in range(3009)) for _ in range(100)] * 100
+    start = time.perf_counter()
+    translated = [PHAGE.translateDNA(sequence) for sequence in sequences]
+    elapsed = time.perf_counter() - start
+    assert all(len(aas) == 1003 for aas in translated)
+    assert elapsed < 30
+
+
+def scan(epitopes, pos):
+    """The epitopes around pos, found by checking every epitope."""
+    return [e for e in epitopes if e.start - 3 <= pos <= e.end + 3]
+
+
+def test_index_finds_the_same_epitopes():
+    index = PHAGE.loadEpitopes(EPITOPES_FILE)
+    assert PHAGE.loadEpitopes(EPITOPES_FILE) is index  # Read once per process.
+    hlas = sorted({hla for e in index.epitopes for hla in e.hlas | e.r4 | e.r2})
+    found = 0
+    for protein in ['Gag', 'Pol', 'Env', 'Nef']:
+        for names in [('hlas',), ('r4', 'r2')]:
+            for hla in hlas[::5]:
+                epitopes = [e for e in index.epitopes
+                            if e.protein == protein and any(hla in getattr(e, name) for name in names)]
+                for pos in range(-5, 1000, 2):
+                    expected = scan(epitopes, pos)
+                    assert index.find(protein, hla, pos, names) == expected
+                    found += len(expected)
+    assert found > 1000
+
+
+def test_epitopes_are_loaded_once(tmp_path, monkeypatch):
+    epitopes_file = str(tmp_path / 'epitopes.txt')
+    shutil.copy(EPITOPES_FILE, epitopes_file)
+    monkeypatch.setattr(PHAGE, 'EPITOPES_PICKLE', str(tmp_path / 'epitopes.pickle'))
+    index = PHAGE.loadEpitopes(epitopes_file)
+    assert PHAGE.loadEpitopes(epitopes_file) is index
+    assert os.path.exists(PHAGE.EPITOPES_PICKLE)
+
+    # The same HLA sets are shared.
+    r4 = {}
+    for e in index.epitopes:
+        assert isinstance(e.hlas, frozenset)
+        assert r4.setdefault(e.r4, e.r4) is e.r4
+    assert len(r4) < len(index.epitopes)
+
+    # Another worker reads the pickled copy.
+    monkeypatch.setattr(PHAGE, '_epitope_indexes', {})
+    monkeypatch.setattr(PHAGE, 'readEpitopes', None)
+    pickled = PHAGE.loadEpitopes(epitopes_file)
+    fields = lambda e: [getattr(e, name) for name in e.__slots__]
+    assert [fields(e) for e in pickled.epitopes] == [fields(e) for e in index.epitopes]
+    monkeypatch.undo()
+
+    # An edited file is read again.
+    with open(epitopes_file) as f:
+        lines = f.readlines()
+    with open(epitopes_file, 'w') as f:
+        f.writelines(lines[:11])
+    os.utime(epitopes_file, ns=(1, 1))
+    assert len(PHAGE.loadEpitopes(epitopes_file).epitopes) == 10
+
+
+def test_analyze():
+    patients = ('001\tA02:01:01G\tA03:01:01G\tB08:01:01G\tB51:01:01G\tC04:01:01G\tC14:02:01G\tATGTGCTGCGGGATCCGAGAC\n'
+                '002\tA02:01:01G\tA02:01:01G\tB01:01:01G\tB51:01:01G\tC04:01:01G\tC16:02:01G\tATGCGCTGCGGCTTCCGAGAC')
+    hlas = 'B*08:01\t2R\tnonadapted\nB*08:01\t2C\tadapted'
+    assert PHAGE.analyze(hlas, patients, 'Env') == [
+        ['001', 'Env', 'B0801', '2', 'C', 'adapted', '((RVKEKYQHL))', '(B0801)', '(2-10)', '((AList))', 'NA', '1'],
+    ]
+
+
+def test_cached_rows_follow_the_epitopes_file(tmp_path, monkeypatch):
+    epitopes_file = str(tmp_path / 'epitopes.txt')
+    shutil.copy(EPITOPES_FILE, epitopes_file)
+    monkeypatch.setattr(PHAGE, 'EPITOPES_PATH', epitopes_file)
+    monkeypatch.setattr(PHAGE, 'EPITOPES_PICKLE', str(tmp_path / 'epitopes.pickle'))
+    monkeypatch.setattr(result_cache, '_cache', result_cache.ResultCache(str(tmp_path / 'cache'), 10 ** 8))
+    monkeypatch.setattr(result_cache, 'CACHE_MAX_BYTES', 10 ** 8)
+    patients = '001\tB08:01:01G\tATGTGCTGCGGGATCCGAGAC'
+    hlas = 'B*08:01\t2C\tadapted'
+    rows = list(PHAGE.run(hlas, patients, 'Env', 'dl')[1])
+    assert rows[0][6] == '((RVKEKYQHL))'
+
+    # The epitope is removed from the file, the cached rows aren't used anymore.
+    with open(epitopes_file) as f:
+        lines = [line for line in f if 'RVKEKYQHL' not in line]
+    with open(epitopes_file, 'w') as f:
+        f.writelines(lines)
+    rows = list(PHAGE.run(hlas, patients, 'Env', 'dl')[1])
+    assert rows[0][6] == 'NA'
+
+
+def make_cohort(patients, seed=1):
+    rng = random.Random(seed)
+    index = PHAGE.loadEpitopes(EPITOPES_FILE)
+    alleles = sorted({hla for e in index.epitopes for hla in e.hlas if len(hla) == 5})
+    hlas = '\n'.join('{}*{}:{}\t{}{}\t{}'.format(hla[0], hla[1:3], hla[3:], rng.randrange(1, 300),
+                                                  rng.choice('ACDEFGHIKLMNPQRSTVWY'), rng.choice(['adapted', 'nonadapted']))
+                     for hla in alleles for _ in range(3))
+    lines = []
+    for patient in range(patients):
+        patient_hlas = [rng.choice(alleles) for _ in range(6)]
+        for protein in ['Nef', 'Gag', 'Pol']:
+            sequence = ''.join(rng.choice('ACGTACGTACGTRYN') for _ in range(900))
+            lines.append('\t'.join(['P{}'.format(patient)] + patient_hlas + [protein, sequence]))
+    return hlas, '\n'.join(lines)
+
+
+def test_batch(monkeypatch):
+    hlas, batch = make_cohort(20)
+    rows = PHAGE.analyzeBatch(hlas, batch, workers=1)
+    assert {row[1] for row in rows} == {'Gag', 'Pol', 'Nef'}
+
+    # The same rows as one protein at a time.
+    expected = []
+    for protein in ['Gag', 'Pol', 'Nef']:
+        patients = [line.split('\t') for line in batch.splitlines()]
+        patients = '\n'.join('\t'.join(line[:-2] + line[-1:]) for line in patients if line[-2] == protein)
+        expected += PHAGE.analyze(hlas, patients, protein)
+    assert rows == expected
+    assert PHAGE.analyzeBatch(hlas, batch, workers=2) == expected
+
+    monkeypatch.setattr(result_cache, 'CACHE_MAX_BYTES', 0)
+    is_download, table, name = PHAGE.run(hlas, batch, PHAGE.BATCH, 'dl')
+    assert is_download and list(table) == expected and name.startswith('phage_i_expanded_results_batch_')
+
+
+@pytest.mark.parametrize('line, error', [
+    ('001\tB*08:01\tXYZ\tATG', 'unknown protein "XYZ" for patient 001'),
+    ('001\tATG', 'each line of a batch needs'),
+    ('001\tB*08:01\tgag\tATG\n001\tB*08:01\tGag\tATG', 'patient 001 has more than one Gag sequence'),
+])
+def test_batch_errors(line, error, monkeypatch):
+    monkeypatch.setattr(result_cache, 'CACHE_MAX_BYTES', 0)
+    is_download, message = PHAGE.run('B*08:01\t2R\tnonadapted', line, PHAGE.BATCH, 'run')
+    assert not is_download and error in message
+
+
+def test_batch_upload_that_is_not_text():
+    from django.conf import settings
+    if not settings.configured:
+        settings.configure()
+    from django.core.files.uploadedfile import SimpleUploadedFile
+    from django.test import RequestFactory
+    from tools.phage_i_expanded import views
+
+    request = RequestFactory().post('/results/', {
+        'hlas_input': 'B*08:01\t2R\tnonadapted',
+        'protein_selection': PHAGE.BATCH,
+        'runPHAGE': 'run',
+        'patients_file': SimpleUploadedFile('batch.xlsx', b'PK\x03\x04\xff\xfe'),
+    })
+    assert views.results(request).content == b'The patients file must be a text file (utf-8).'
@@ -0,0 +1,179 @@
+"""
+Tests for the pipeline supervisor, with small Python programs as stages.
+"""
+
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'depend', 'util_scripts'))
+import pipeline_supervisor as ps
+
+
+def program(code):
+    return [sys.executable, '-c', code]
+
+
+def touch(path, delay=0):
+    return program('import time; time.sleep({}); open({!r}, "a").close()'.format(delay, str(path)))
+
+
+@pytest.fixture
+def registry(tmp_path):
+    return ps.Registry(str(tmp_path / 'registry.sqlite3'))
+
+
+def messages(registry, run_id):
+    return [message for seq, message in registry.events(run_id)]
+
+
+def test_stages_run_in_dependency_order(registry, tmp_path):
+    order = tmp_path / 'order'
+    stages = [
+        ps.Stage('zip', program('open({!r}, "a").write("zip ")'.format(str(order))), after=['distances'], description='compression'),
+        ps.Stage('distances', program('open({!r}, "a").write("distances ")'.format(str(order))), after=['convert'], description='distance computation'),
+        ps.Stage('convert', program('open({!r}, "a").write("convert ")'.format(str(order))), description='10x conversion'),
+    ]
+    assert ps.Supervisor(registry, '1', stages, timeout=30).run() == ps.DONE
+    assert order.read_text() == 'convert distances zip '
+
+    run = registry.get_run('1')
+    assert run['state'] == ps.RUNNING  # The caller finishes the run.
+    assert {stage['name']: (stage['state'], stage['returncode']) for stage in run['stages']} == {
+        'convert': (ps.DONE, 0), 'distances': (ps.DONE, 0), 'zip': (ps.DONE, 0)}
+    assert all(stage['pid'] for stage in run['stages'])
+    assert [m for m in messages(registry, '1') if not m.startswith('took')] == [
+        'starting 10x conversion', 'done 10x conversion',
+        'starting distance computation', 'done distance computation',
+        'starting compression', 'done compression',
+    ]
+
+    registry.finish_run('1', ps.DONE)
+    assert registry.get_run('1')['state'] == ps.DONE
+
+
+def test_independent_stages_run_together(registry, tmp_path):
+    stages = [
+        ps.Stage('a', touch(tmp_path / 'a', 0.5)),
+        ps.Stage('b', touch(tmp_path / 'b', 0.5)),
+        ps.Stage('c', touch(tmp_path / 'c'), after=['a', 'b']),
+    ]
+    started = time.monotonic()
+    assert ps.Supervisor(registry, '1', stages, timeout=30).run() == ps.DONE
+    assert time.monotonic() - started < 1.5
+    assert all((tmp_path / name).exists() for name in 'abc')
+
+
+def test_failed_stage_skips_dependents(registry, tmp_path):
+    stages = [
+        ps.Stage('convert', program('raise SystemExit(3)'), description='10x conversion'),
+        ps.Stage('distances', touch(tmp_path / 'distances'), after=['convert']),
+    ]
+    assert ps.Supervisor(registry, '1', stages, timeout=30).run() == ps.FAILED
+    assert not (tmp_path / 'distances').exists()
+    states = {stage['name']: (stage['state'], stage['returncode']) for stage in registry.get_run('1')['stages']}
+    assert states == {'convert': (ps.FAILED, 3), 'distances': (ps.SKIPPED, None)}
+    assert '10x conversion failed' in messages(registry, '1')
+
+
+def test_timeout(registry):
+    stages = [ps.Stage('slow', program('import time; time.sleep(30)'), description='distance computation')]
+    started = time.monotonic()
+    assert ps.Supervisor(registry, '1', stages, timeout=0.5).run() == ps.TIMED_OUT
+    assert time.monotonic() - started < 5
+    assert messages(registry, '1')[-1] == 'distance computation timed out'
+
+
+def test_cancel_stops_the_running_stage_immediately(registry, tmp_path):
+    stages = [
+        ps.Stage('slow', program('import time; time.sleep(30)'), description='distance computation'),
+        ps.Stage('zip', touch(tmp_path / 'zip'), after=['slow']),
+    ]
+    supervisor = ps.Supervisor(registry, '1', stages, timeout=60)
+    result = {}
+    thread = threading.Thread(target=lambda: result.update(state=supervisor.run()))
+    thread.start()
+    while not any(stage['state'] == ps.RUNNING for stage in (registry.get_run('1') or {'stages': []})['stages']):
+        time.sleep(0.01)
+
+    cancelled_at = time.monotonic()
+    assert registry.cancel('1')
+    thread.join(10)
+    assert result['state'] == ps.CANCELLED
+    assert time.monotonic() - cancelled_at < 1
+    assert not (tmp_path / 'zip').exists()
+    assert messages(registry, '1')[-1] == 'distance computation terminated'
+    assert not registry.cancel('1')
+
+
+def test_cancel_before_start(registry, tmp_path):
+    assert registry.cancel('1')
+    stages = [ps.Stage('convert', touch(tmp_path / 'convert'))]
+    assert ps.Supervisor(registry, '1', stages, timeout=30).run() == ps.CANCELLED
+    assert not (tmp_path / 'convert').exists()
+
+
+def test_wait_for_events(registry):
+    assert registry.wait_for_events('1', timeout=0.1) == []
+
+    seq = registry.add_event('1', 'starting clones_file')
+    assert registry.wait_for_events('1') == [(seq, 'starting clones_file')]
+    assert registry.wait_for_events('1', after=seq, timeout=0.1) == []
+
+    threading.Timer(0.2, registry.add_event, ('1', 'clones_file written')).start()
+    started = time.monotonic()
+    assert [message for _, message in registry.wait_for_events('1', after=seq, timeout=10)] == ['clones_file written']
+    assert time.monotonic() - started < 2
+
+    registry.delete_run('1')
+    assert registry.events('1') == []
+
+
+def test_waiters_are_woken_up(registry, monkeypatch):
+    checks = []
+    events = registry.events
+    monkeypatch.setattr(registry, 'events', lambda *args: checks.append(1) or events(*args))
+
+    # From another process, the waiter doesn't check the database until then.
+    util_path = os.path.dirname(ps.__file__)
+    writer = program('import sys, time; sys.path.append({!r}); import pipeline_supervisor as ps; time.sleep(0.5); '
+                     'ps.Registry({!r}).add_event("1", "10x files written")'.format(util_path, registry.path))
+    threading.Thread(target=subprocess.run, args=(writer,)).start()
+    started = time.monotonic()
+    assert [message for _, message in registry.wait_for_events('1', timeout=30, interval=30)] == ['10x files written']
+    assert time.monotonic() - started < 10
+    assert len(checks) <= 3
+
+    # A finished run wakes its waiters too, which leave nothing behind.
+    registry.start_run('1', [])
+    threading.Timer(0.2, registry.finish_run, ('1', ps.DONE)).start()
+    started = time.monotonic()
+    assert registry.wait_for_events('1', after=10 ** 6, timeout=30, interval=30) == []
+    assert time.monotonic() - started < 10
+    assert os.listdir(registry.notify_dir) == []
+
+
+def test_function_stages(registry, tmp_path):
+    calls = []
+    stages = [
+        ps.Stage('report', function=lambda: calls.append('report'), after=['zip']),
+        ps.Stage('distances', touch(tmp_path / 'distances')),
+        ps.Stage('zip', function=lambda: calls.append('zip'), after=['distances'], description='compression'),
+    ]
+    assert ps.Supervisor(registry, '1', stages, timeout=30).run() == ps.DONE
+    assert calls == ['zip', 'report']
+    assert 'done compression' in messages(registry, '1')
+
+
+def test_failed_function_stage(registry):
+    def explode():
+        raise OSError('disk full')
+
+    stages = [ps.Stage('zip', function=explode, description='compression'), ps.Stage('after', function=list, after=['zip'])]
+    assert ps.Supervisor(registry, '1', stages, timeout=30).run() == ps.FAILED
+    assert 'compression failed (disk full)' in messages(registry, '1')
+    assert {stage['name']: stage['state'] for stage in registry.get_run('1')['stages']} == {'zip': ps.FAILED, 'after': ps.SKIPPED}
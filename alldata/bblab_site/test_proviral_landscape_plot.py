@@ -0,0 +1,133 @@
+"""
+Tests for the proviral landscape plot, mostly its dense mode and sample ordering for large cohorts.
+"""
+
+import io
+import os
+import random
+import re
+import subprocess
+import sys
+import time
+
+import pytest
+
+pytest.importorskip('genetracks')
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(BASE_DIR, 'depend', 'util_scripts'))
+sys.path.append(os.path.join(BASE_DIR, 'tools', 'proviral_landscape_plot'))
+import proviral_landscape_plot
+
+DEFECTS = ['Intact', 'Hypermut', 'LargeDeletion', '5DEFECT', 'InternalInversion', 'Frameshift']
+
+
+def make_csv(samples, patterns=40, seed=1):
+    """A cohort where every sample has one of a few segment patterns."""
+    rng = random.Random(seed)
+    shapes = []
+    for _ in range(patterns):
+        segments, pos = [], 645
+        while pos < 9500:
+            end = min(9666, pos + rng.choice([400, 1200, 2500, 9000]))
+            segments.append((pos, end, rng.random() < 0.05))
+            pos = end + rng.choice([20, 300, 1500])
+        shapes.append((rng.choice(DEFECTS), segments))
+
+    lines = ['samp_name,run_name,ref_start,ref_end,defect,is_inverted,is_defective']
+    for sample in range(samples):
+        defect, segments = rng.choice(shapes)
+        lines += ['S{},run,{},{},{},{},'.format(sample, start, end, defect, 'True' if inverted else '')
+                  for start, end, inverted in segments]
+    return '\n'.join(lines) + '\n'
+
+
+def plot(csv_text, dense):
+    return proviral_landscape_plot.draw_proviral_plot(io.StringIO(csv_text), dense).as_svg()
+
+
+def height(svg):
+    return float(re.search(r'<svg[^>]* height="([0-9.]+)"', svg).group(1))
+
+
+def test_dense_plot_has_the_same_layout():
+    csv_text = make_csv(500)
+    sparse, dense = plot(csv_text, False), plot(csv_text, True)
+    assert height(dense) == pytest.approx(height(sparse))
+    assert 'N=500' in dense and 'N=500' in sparse
+    assert dense.count('<rect') < sparse.count('<rect') / 5
+
+
+def test_dense_plot_size_follows_patterns_not_samples():
+    small, large = plot(make_csv(1000), True), plot(make_csv(10000), True)
+    assert len(large) < 1.5 * len(small)
+
+
+def test_dense_mode_is_the_default_for_large_cohorts(monkeypatch):
+    monkeypatch.setattr(proviral_landscape_plot, 'DENSE_SAMPLES', 100)
+    csv_text = make_csv(200)
+    assert plot(csv_text, None) == plot(csv_text, True)
+    monkeypatch.setattr(proviral_landscape_plot, 'DENSE_SAMPLES', 1000)
+    assert plot(csv_text, None) == plot(csv_text, False)
+
+
+def test_small_gaps_are_closed():
+    segs = [proviral_landscape_plot.Segment(0, 40, start, end) for start, end in
+            [(700, 2000), (2030, 5000), (5100, 6000), (6020, 9580)]]
+    proviral_landscape_plot.close_small_gaps(segs)
+    assert [(seg.start, seg.end) for seg in segs] == [(666, 5000), (2000, 5000), (5100, 9580), (6000, 9604)]
+
+    segs = [proviral_landscape_plot.Segment(0, 40, 700, 2000), proviral_landscape_plot.Segment(0, 40, 2030, 9000, True)]
+    proviral_landscape_plot.close_small_gaps(segs)
+    assert [(seg.start, seg.end) for seg in segs] == [(666, 2000), (2030, 9000)]  # Inverted, left alone.
+
+
+def test_samples_are_ordered_by_defect_and_gaps():
+    csv_text = '\n'.join([
+        'samp_name,run_name,ref_start,ref_end,defect,is_inverted,is_defective',
+        'B,run,666,3000,LargeDeletion,,',
+        'B,run,6000,9604,LargeDeletion,,',
+        'A,run,666,9604,Intact,,',
+        ' C ,run,5000,9604,LongDeletion,,',
+        ' C ,run,666,4000,LongDeletion,,',
+        'D,run,666,2000,LargeDeletion,,',
+        'D,run,7000,9604,LargeDeletion,,',
+    ])
+    names, defect_types, segments = proviral_landscape_plot.read_segments(io.StringIO(csv_text))
+    assert names == ['B', 'A', 'C', 'D']
+    order = [
+        (defect_type, [[(names[seg.sample], seg.start, seg.end) for seg in segs]
+                       for segs in proviral_landscape_plot.order_samples_by_gaps(samples)])
+        for defect_type, samples in proviral_landscape_plot.sort_csv_lines(segments, defect_types, names)
+    ]
+    assert order == [
+        ('Intact', [[('A', 666, 9604)]]),
+        ('Large Deletion', [
+            [('D', 666, 2000), ('D', 7000, 9604)],
+            [('B', 666, 3000), ('B', 6000, 9604)],
+            [('C', 666, 4000), ('C', 5000, 9604)],
+        ]),
+    ]
+
+
+
+def test_command_line_needs_no_site(tmp_path):
+    input_csv = tmp_path / 'input.csv'
+    input_csv.write_text(make_csv(20))
+    env = {name: value for name, value in os.environ.items() if not name.startswith('BBLAB_')}
+    script = os.path.join(BASE_DIR, 'tools', 'proviral_landscape_plot', 'proviral_landscape_plot.py')
+    subprocess.run([sys.executable, script, str(input_csv), str(tmp_path / 'output.svg')], env=env, check=True)
+    assert (tmp_path / 'output.svg').read_text().startswith('<?xml')
+    assert not (tmp_path / 'output.svg.gz').exists()
+
+
+@pytest.mark.benchmark
+def test_ordering_a_large_cohort_is_fast():
+    csv_text = make_csv(17000, patterns=400)
+    start = time.perf_counter()
+    names, defect_types, segments = proviral_landscape_plot.read_segments(io.StringIO(csv_text))
+    for _, samples in proviral_landscape_plot.sort_csv_lines(segments, defect_types, names):
+        proviral_landscape_plot.order_samples_by_gaps(samples, dense=True)
+    elapsed = time.perf_counter() - start
+    assert len(segments) > 50000
+    assert elapsed < 5
@@ -0,0 +1,100 @@
+"""
+Parity tests for the in-process q-value engine against outputs recorded from qvalue_calculate.r.
+"""
+
+import os
+import shutil
+import sys
+
+import numpy
+import pytest
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(BASE_DIR, 'depend', 'util_scripts'))
+sys.path.append(os.path.join(BASE_DIR, 'depend', 'operations'))
+import op_qvalue
+
+# The q-value tool's default input and its recorded R output (tests/qvalue/q-values_output.xlsx).
+QVALUE_TOOL_P = [0.51, 0.01, 0.12, 0.16, 0.92, 0.16, 0.01, 0.51, 0.62]
+QVALUE_TOOL_Q = [0.473555434798544, 0.0324989023881353, 0.207992975284066, 0.207992975284066,
+                 0.664422004379656, 0.207992975284066, 0.0324989023881353, 0.473555434798544,
+                 0.503732987016098]
+
+# Codon by codon test run and its recorded R output (tests/codon_by_codon/test_codon_by_codon.xlsx).
+CODON_BY_CODON_P = [0.049535] + [0.12663] * 4 + [0.27523] * 7 + [0.51269] * 2 + [0.82726] * 2
+CODON_BY_CODON_Q = [0.0630616327534093] * 12 + [0.100687949807212] * 2 + [0.142158466495982] * 2
+
+
+@pytest.mark.parametrize('pvalues, expected', [
+    (QVALUE_TOOL_P, QVALUE_TOOL_Q),
+    (CODON_BY_CODON_P, CODON_BY_CODON_Q),
+])
+def test_matches_recorded_r_output(pvalues, expected):
+    assert op_qvalue.get_qvalues(pvalues, engine='python') == pytest.approx(expected, rel=1e-12)
+
+
+def test_accepts_arrays():
+    assert op_qvalue.get_qvalues(numpy.array(QVALUE_TOOL_P), engine='python') == op_qvalue.get_qvalues(QVALUE_TOOL_P, engine='python')
+
+
+def test_smooth_spline_matches_r():
+    # smooth.spline(seq(0, 0.9, 0.1), pi0, df=3) then predict(spi0, x=0.9)$y gives 0.9485383 in R.
+    pi0 = [1.0000000, 0.9759067, 0.9674164, 0.9622673, 0.9573241,
+           0.9573241, 0.9558824, 0.9573241, 0.9544406, 0.9457901]
+    assert op_qvalue._smooth_spline_predict_last(numpy.arange(10) * 0.1, pi0, 3) == pytest.approx(0.9485383, abs=5e-8)
+
+
+def test_single_lambda_and_robust():
+    p = numpy.array(QVALUE_TOOL_P)
+    assert op_qvalue.estimate_pi0(p, lambdas=0.5) == pytest.approx(numpy.mean(p >= 0.5) / 0.5)
+
+    qvalues = op_qvalue.calculate_qvalues(p)
+    robust = op_qvalue.calculate_qvalues(p, robust=True)
+    assert numpy.all(robust >= qvalues)
+    assert numpy.all(robust <= 1)
+
+
+def test_bootstrap_pi0():
+    p = numpy.random.default_rng(0).uniform(size=500)
+    pi0 = op_qvalue.estimate_pi0(p, pi0_method='bootstrap', rng=numpy.random.default_rng(1))
+    assert 0.8 < pi0 <= 1
+
+
+def test_invalid_input():
+    assert op_qvalue.get_qvalues([]) == []
+    assert op_qvalue.get_qvalues(numpy.array([])) == []
+    with pytest.raises(ValueError):
+        op_qvalue.estimate_pi0([0.1, 0.2], lambdas=[0.1, 0.2])
+    with pytest.raises(ValueError):
+        op_qvalue.estimate_pi0([0.1, 0.2], pi0_method='other')
+
+
+@pytest.mark.skipif(shutil.which('Rscript') is None, reason='R is not installed')
+def test_r_engine_matches_python():
+    os.environ.setdefault('BBLAB_R_PATH', os.path.join(BASE_DIR, 'depend', 'r_scripts') + os.sep)
+    p = numpy.random.default_rng(2).uniform(size=200) ** 2
+    assert op_qvalue.get_qvalues(p, engine='r') == pytest.approx(op_qvalue.get_qvalues(p, engine='python'), rel=1e-6)
+
+
+class AnsweringPool:
+    """Stands in for r_pool's pool, answering every job with the given text (or error)."""
+
+    def __init__(self, answer):
+        self.answer = answer
+
+    def run(self, function, values):
+        if isinstance(self.answer, Exception):
+            raise self.answer
+        return self.answer
+
+
+def test_r_engine_output(monkeypatch):
+    monkeypatch.setattr(op_qvalue.r_pool, 'get_pool', lambda: AnsweringPool('0.25 0.5 1'))
+    assert op_qvalue.get_qvalues([0.1, 0.2, 0.9], engine='r') == [0.25, 0.5, 1.0]
+
+    with pytest.raises(RuntimeError, match='returned 3 q-values but expected 2'):
+        op_qvalue.get_qvalues([0.1, 0.2], engine='r')
+
+    monkeypatch.setattr(op_qvalue.r_pool, 'get_pool', lambda: AnsweringPool(op_qvalue.r_pool.RWorkerError('qval failed')))
+    with pytest.raises(RuntimeError, match='^R worker failed: qval failed$'):
+        op_qvalue.get_qvalues([0.1, 0.2], engine='r')
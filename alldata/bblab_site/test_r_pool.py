@@ -0,0 +1,66 @@
+"""
+Tests for the R worker pool, using a small Python program that speaks the worker protocol in place of R.
+"""
+
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'depend', 'util_scripts'))
+import r_pool
+
+# Answers "double" jobs, fails "fail" jobs and hangs on "sleep" jobs, like qvalue_worker.r does for qval().
+FAKE_WORKER = r'''
+import sys, time
+for line in sys.stdin:
+    function, _, values = line.rstrip("\n").partition("\t")
+    values = [float(v) for v in values.split(",") if v]
+    if function == "double":
+        print("OK\t" + " ".join(str(2 * v) for v in values), flush=True)
+    elif function == "sleep":
+        time.sleep(values[0])
+    else:
+        print("ERROR\tunknown function " + function, flush=True)
+'''
+
+
+@pytest.fixture
+def pool():
+    pool = r_pool.RWorkerPool([sys.executable, '-c', FAKE_WORKER], size=2, max_jobs=3, timeout=2)
+    yield pool
+    pool.shutdown()
+
+
+def test_jobs_reuse_and_recycle_workers(pool):
+    for i in range(7):
+        assert pool.run('double', [i, 0.5]) == '{} 1.0'.format(2.0 * i)
+    stats = pool.stats()
+    assert stats['jobs'] == 7
+    assert stats['started'] == 3  # A new worker every max_jobs jobs.
+    assert stats['recycled'] == 2
+    assert stats['idle'] == 1 and stats['busy'] == 0 and stats['queue_depth'] == 0
+
+
+def test_errors_and_timeouts(pool):
+    with pytest.raises(r_pool.RWorkerError):
+        pool.run('fail', [1])
+    pool.timeout = 0.2
+    with pytest.raises(r_pool.RWorkerTimeout):
+        pool.run('sleep', [5])
+    pool.timeout = 2
+    assert pool.run('double', [1]) == '2.0'
+    stats = pool.stats()
+    assert stats['errors'] == 2 and stats['timeouts'] == 1
+
+
+def test_concurrent_callers_share_workers(pool):
+    results = []
+    threads = [threading.Thread(target=lambda i=i: results.append(pool.run('double', [i]))) for i in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(results, key=float) == [str(2.0 * i) for i in range(10)]
+    assert pool.stats()['started'] <= 2 + 10 // 3 + 1
@@ -0,0 +1,107 @@
+"""
+Tests for the result cache of the deterministic tools.
+"""
+
+import os
+import sys
+
+import pytest
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(BASE_DIR, 'depend', 'util_scripts'))
+import result_cache
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return result_cache.ResultCache(str(tmp_path / 'cache'), max_bytes=10000)
+
+
+def test_key():
+    key = result_cache.cache_key('qvalue', 1, [0.5, 0.01], {'engine': 'python', 'x': 1})
+    assert key == result_cache.cache_key('qvalue', '1', [0.5, 0.01], {'x': 1, 'engine': 'python'})
+    assert key != result_cache.cache_key('qvalue', 2, [0.5, 0.01], {'engine': 'python', 'x': 1})
+    assert key != result_cache.cache_key('qvalue', 1, [0.5, 0.01], {'engine': 'r', 'x': 1})
+    assert key != result_cache.cache_key('phage', 1, [0.5, 0.01], {'engine': 'python', 'x': 1})
+    assert key != result_cache.cache_key('qvalue', 1, [0.01, 0.5], {'engine': 'python', 'x': 1})
+
+
+def test_normalize_text():
+    assert result_cache.normalize_text('a\tb\r\nc\rd\n\n') == 'a\tb\nc\nd'
+    assert result_cache.normalize_text(b'a\r\n') == 'a'
+
+
+def test_hits_and_misses(cache):
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return {'rows': [[1, 'A'], [2, 'B']]}
+
+    assert cache.cached('k1', compute) == {'rows': [[1, 'A'], [2, 'B']]}
+    assert cache.cached('k1', compute) == {'rows': [[1, 'A'], [2, 'B']]}
+    assert len(calls) == 1
+    with pytest.raises(KeyError):
+        cache.get('k2')
+
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['entries']) == (1, 2, 1)
+    assert stats['bytes'] > 0
+
+    # Another process sharing the directory sees the same results.
+    other = result_cache.ResultCache(cache.directory, cache.max_bytes)
+    assert other.get('k1') == {'rows': [[1, 'A'], [2, 'B']]}
+
+    cache.clear()
+    assert cache.stats() == {'hits': 0, 'misses': 0, 'entries': 0, 'bytes': 0}
+
+
+def test_least_recently_used_are_evicted(cache):
+    for key in 'abcd':
+        cache.put(key, 'x' * 3000)
+    assert cache.stats()['entries'] == 3  # 4 * 3000 bytes don't fit in 10000.
+    with pytest.raises(KeyError):
+        cache.get('a')
+
+    cache.get('b')  # Now c is the least recently used.
+    cache.put('e', 'x' * 3000)
+    with pytest.raises(KeyError):
+        cache.get('c')
+    assert cache.get('b') and cache.get('d') and cache.get('e')
+    assert not os.path.exists(cache._file('c'))
+
+    cache.put('big', 'x' * 20000)  # Bigger than the whole cache, not stored.
+    with pytest.raises(KeyError):
+        cache.get('big')
+    assert cache.stats()['entries'] == 3
+
+
+def test_damaged_entries_are_computed_again(cache):
+    cache.put('k', [1, 2, 3])
+    with open(cache._file('k'), 'wb') as file:
+        file.write(b'not a pickle')
+    assert cache.cached('k', lambda: [4]) == [4]
+    assert cache.get('k') == [4]
+
+
+def test_errors_are_not_cached(cache):
+    def fail():
+        raise ValueError('bad input')
+
+    with pytest.raises(ValueError):
+        cache.cached('k', fail)
+    assert cache.stats()['entries'] == 0
+
+
+def test_cached(tmp_path, monkeypatch):
+    monkeypatch.setattr(result_cache, '_cache', result_cache.ResultCache(str(tmp_path), 10000))
+    calls = []
+    compute = lambda: calls.append(1) or [0.2, 0.4]
+    assert result_cache.cached('qvalue', 1, [0.1, 0.2], compute) == [0.2, 0.4]
+    assert result_cache.cached('qvalue', 1, [0.1, 0.2], compute) == [0.2, 0.4]
+    assert result_cache.cached('qvalue', 2, [0.1, 0.2], compute) == [0.2, 0.4]
+    assert len(calls) == 2
+
+    monkeypatch.setattr(result_cache, 'CACHE_MAX_BYTES', 0)
+    assert result_cache.cached('qvalue', 1, [0.1, 0.2], compute) == [0.2, 0.4]
+    assert len(calls) == 3
@@ -0,0 +1,159 @@
+"""
+Tests for the result tables and their CSV, TSV and XLSX exporters.
+"""
+
+import io
+import json
+import os
+import sys
+
+import pytest
+from django.conf import settings
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(BASE_DIR, 'depend', 'util_scripts'))
+sys.path.append(os.path.join(BASE_DIR, 'depend', 'libraries'))
+
+if not settings.configured:
+    settings.configure()
+
+import result_table
+from result_table import ResultTable
+from openpyxl import load_workbook
+
+
+def make_table():
+    table = ResultTable(['category', 'n', 'p-value'])
+    table.append(['A*02', 3, 0.25])
+    table.append(['B,57', 1, 1e-05])
+    return table
+
+
+def test_csv():
+    assert ''.join(result_table.export(make_table(), 'csv')) == (
+        'category,n,p-value\r\n'
+        'A*02,3,0.25\r\n'
+        '"B,57",1,1e-05\r\n'
+    )
+
+
+def test_tsv():
+    assert ''.join(result_table.export(make_table(), 'tsv')) == 'category\tn\tp-value\nA*02\t3\t0.25\nB,57\t1\t1e-05\n'
+
+
+def test_xlsx():
+    data = b''.join(result_table.export(make_table(), 'xlsx'))
+    sheet = load_workbook(io.BytesIO(data))['Data']
+    assert [[cell.value for cell in row] for row in sheet.iter_rows()] == [
+        ['category', 'n', 'p-value'],
+        ['A*02', 3, 0.25],
+        ['B,57', 1, 1e-05],
+    ]
+
+
+def test_rows_are_generated_lazily():
+    made = []
+
+    def rows():
+        for i in range(5):
+            made.append(i)
+            yield [i, i * i]
+
+    chunks = result_table.export(ResultTable(['x', 'x^2'], rows()), 'csv')
+    assert made == []
+    assert ''.join(chunks).splitlines() == ['x,x^2', '0,0', '1,1', '2,4', '3,9', '4,16']
+    assert made == [0, 1, 2, 3, 4]
+
+
+def test_large_tables_are_sent_in_chunks():
+    table = ResultTable(['i', 'sequence'], ([i, 'ACGT' * 25] for i in range(5000)))
+    chunks = list(result_table.export(table, 'tsv'))
+    assert len(chunks) > 1
+    assert all(len(chunk) < 2 * result_table.EXPORT_CHUNK_SIZE for chunk in chunks)
+    assert ''.join(chunks).count('\n') == 5001
+
+
+@pytest.mark.parametrize('data, expected', [
+    ({}, 'csv'),
+    ({'format': 'TSV'}, 'tsv'),
+    ({'format': 'xlsx'}, 'xlsx'),
+    ({'format': 'parquet'}, 'csv'),
+])
+def test_requested_format(data, expected):
+    assert result_table.requested_format(data, 'csv') == expected
+
+
+def test_response():
+    response = result_table.response(make_table(), 'tsv', 'results')
+    assert response.streaming
+    assert response['Content-Type'] == 'text/tab-separated-values'
+    assert response['Content-Disposition'] == 'attachment; filename=results.tsv'
+    assert b''.join(response.streaming_content).startswith(b'category\tn\tp-value\n')
+
+
+def test_stored_table(tmp_path):
+    table = ResultTable(['id', 'p', 'note'])
+    for row in [['b', 0.5, 'x'], ['a', float('nan'), ''], ['c', '0.05', None], ['d', 10, 'y']]:
+        table.append(row)
+    result_table.store(table, str(tmp_path))
+
+    stored = result_table.StoredTable(str(tmp_path))
+    assert stored.columns == ['id', 'p', 'note']
+    assert stored.total == 4
+    assert stored.rows() == [['b', 0.5, 'x'], ['a', 'nan', ''], ['c', '0.05', None], ['d', 10, 'y']]
+    assert stored.rows(1, 2) == [['a', 'nan', ''], ['c', '0.05', None]]
+    assert stored.rows(limit=2, descending=True) == [['d', 10, 'y'], ['c', '0.05', None]]
+
+    # Numbers (also as text) sort before other text, empty cells last.
+    assert [row[0] for row in stored.rows(sort=1)] == ['c', 'b', 'd', 'a']
+    assert [row[0] for row in stored.rows(sort=1, descending=True)] == ['a', 'd', 'b', 'c']
+    assert [row[0] for row in stored.rows(sort=2)] == ['b', 'd', 'a', 'c']  # Ties keep their input order.
+    assert stored.rows(0, 2, sort=0, column_offset=1, column_limit=1) == [['nan'], [0.5]]
+
+    with pytest.raises(IndexError):
+        stored.rows(sort=3)
+
+
+def test_stored_table_missing(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        result_table.StoredTable(str(tmp_path))
+
+
+def test_rows_view(tmp_path, monkeypatch):
+    import job_queue
+    from django.test import RequestFactory, override_settings
+    from tools.jobs import views
+
+    queue = job_queue.JobQueue(str(tmp_path / 'jobs.sqlite3'), str(tmp_path / 'jobs'))
+    monkeypatch.setattr(job_queue, '_queue', queue)
+    rows = ([i, 'ACGT'[i % 4], i * 0.5] for i in range(5000))
+    with override_settings(ROOT_URLCONF='tools.jobs.urls'):  # redirect() tries reversing the url first.
+        response = views.show_table('test', result_table.TablePage('<html></html>', ResultTable(['i', 'base', 'half'], rows)))
+    job_id = response.url.rstrip('/').split('/')[-1]
+    assert queue.get(job_id)['status'] == job_queue.DONE
+    assert queue.result(job_id) == '<html></html>'
+
+    def get(**params):
+        return views.rows(RequestFactory().get('/', params), job_id)
+
+    data = json.loads(get(offset=10, limit=3).content)
+    assert data == {'columns': ['i', 'base', 'half'], 'total': 5000, 'offset': 10,
+                    'rows': [[10, 'G', 5.0], [11, 'T', 5.5], [12, 'A', 6.0]]}
+    data = json.loads(get(limit=2, sort=1, order='desc', col_offset=1).content)
+    assert data['rows'] == [['T', 2499.5], ['T', 2497.5]]  # Descending is ascending reversed.
+    assert len(json.loads(get(limit=100000).content)['rows']) == views.ROWS_LIMIT
+    assert get(sort='x').status_code == 400
+    assert get(sort=7).status_code == 400
+
+
+def test_tools_return_a_table_page():
+    import django
+    django.setup()  # static() asks the app registry whether staticfiles is installed.
+    from tools.text_to_columns import text_to_columns
+
+    is_download, page = text_to_columns.run('AB[CD]\nA-[CD]\n', 'run')
+    assert not is_download and isinstance(page, result_table.TablePage)
+    assert 'class="result-table"' in page.html
+    # The input's columns (it has no header) and the counts of their values last.
+    assert page.table.columns == ['', '', '']
+    assert list(page.table) == [['A', 'B', '[CD]'], ['A', '-', '[CD]'], ['A:2', 'B:1 -:1', '[CD]:2']]
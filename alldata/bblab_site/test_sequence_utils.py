@@ -0,0 +1,113 @@
+"""
+Tests for the sequence utilities shared by the sequence tools.
+"""
+
+import io
+import os
+import random
+import sys
+
+import numpy
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'depend', 'util_scripts'))
+import sequence_utils
+
+
+def reference_translate_nuc(seq, offset, resolve=False):
+    """The codon-by-codon translate_nuc() that the lookup tables replaced."""
+    seq = '-'*offset + seq
+    aa_seq = ''
+    for codon_site in range(0, len(seq), 3):
+        codon = seq[codon_site:codon_site+3]
+        if len(codon) < 3:
+            break
+        if codon.count('-') > 1 or '?' in codon:
+            aa_seq += '-' if codon == '---' else '?'
+            continue
+        num_mixtures = len(sequence_utils.mixture_regex.findall(codon))
+        if num_mixtures == 0:
+            aa_seq += sequence_utils.codon_dict[codon]
+        elif num_mixtures == 1:
+            resolved_AAs = []
+            for pos in range(3):
+                if codon[pos] in sequence_utils.mixture_dict.keys():
+                    for r in sequence_utils.mixture_dict[codon[pos]]:
+                        rcodon = codon[0:pos] + r + codon[(pos+1):]
+                        if sequence_utils.codon_dict[rcodon] not in resolved_AAs:
+                            resolved_AAs.append(sequence_utils.codon_dict[rcodon])
+            if len(resolved_AAs) > 1:
+                aa_seq += resolved_AAs[0] if resolve else '?'
+            else:
+                aa_seq += resolved_AAs[0]
+        else:
+            aa_seq += '?'
+    return aa_seq
+
+
+def random_sequences(count, seed=1):
+    rng = random.Random(seed)
+    chars = 'ACGT' * 8 + sequence_utils.iupac_nuc_chars + '?'
+    return [''.join(rng.choice(chars) for _ in range(rng.randint(0, 90))) for _ in range(count)]
+
+
+@pytest.mark.parametrize('resolve', [False, True])
+def test_translate_nuc_all_codons(resolve):
+    table = sequence_utils.codon_table_resolved if resolve else sequence_utils.codon_table
+    assert len(table) == 16 ** 3
+    for codon, aa in table.items():
+        assert aa == reference_translate_nuc(codon, 0, resolve)
+
+
+@pytest.mark.parametrize('resolve', [False, True])
+@pytest.mark.parametrize('offset', [0, 1, 2, 4])
+def test_translate_nuc_matches_reference(resolve, offset):
+    for seq in random_sequences(300):
+        assert sequence_utils.translate_nuc(seq, offset, resolve) == reference_translate_nuc(seq, offset, resolve)
+
+
+def test_translate_nuc_invalid_codon_raises():
+    with pytest.raises(KeyError):
+        sequence_utils.translate_nuc('ATGXTG', 0)
+
+
+@pytest.mark.parametrize('resolve', [False, True])
+@pytest.mark.parametrize('offset', [0, 2])
+def test_translate_nuc_batch(resolve, offset):
+    seqs = random_sequences(300, seed=2)
+    expected = [reference_translate_nuc(seq, offset, resolve) for seq in seqs]
+
+    assert sequence_utils.translate_nuc_batch(seqs, offset, resolve) == expected
+    assert sequence_utils.translate_nuc_batch(numpy.array([s.encode() for s in seqs]), offset, resolve) == expected
+
+    same_length = [seq.ljust(90, 'A') for seq in seqs]
+    matrix = numpy.array([list(s.encode()) for s in same_length], dtype=numpy.uint8)
+    assert sequence_utils.translate_nuc_batch(matrix, offset, resolve) == \
+        [reference_translate_nuc(seq, offset, resolve) for seq in same_length]
+
+
+FASTA_TEXT = '$annotation\r\n>seq1\r\nATG\r\nAAA\r\n\r\n>empty\n>seq2\nTT\nTAA\n#seq3\nCCC'
+
+
+def test_iter_fasta_matches_convert_fasta():
+    lines = [e + '\n' for e in FASTA_TEXT.replace('\r', '\n').replace('\n\n', '\n').split('\n') if e]
+    expected = [tuple(block) for block in sequence_utils.convert_fasta(lines)]
+    assert expected == [('seq1', 'ATGAAA'), ('seq2', 'TTTAA'), ('seq3', 'CCC')]
+
+    assert list(sequence_utils.iter_fasta(FASTA_TEXT)) == expected
+    assert list(sequence_utils.iter_fasta(io.StringIO(FASTA_TEXT), chunk_size=3)) == expected
+    # Multi-byte characters and line endings split across chunks.
+    data = FASTA_TEXT.replace('seq1', 'séq1').encode('utf-8')
+    assert list(sequence_utils.iter_fasta(io.BytesIO(data), chunk_size=1))[0] == ('séq1', 'ATGAAA')
+
+
+def test_iter_fasta_errors():
+    with pytest.raises(ValueError):
+        list(sequence_utils.iter_fasta('ATG\n>seq1\nATG'))
+    with pytest.raises(ValueError):
+        list(sequence_utils.iter_fasta(''))
+
+
+def test_iter_fasta_text_round_trip():
+    records = [('seq1', 'ATGAAA'), ('seq2', 'TTTAA')]
+    assert list(sequence_utils.iter_fasta(''.join(sequence_utils.iter_fasta_text(records)))) == records
@@ -0,0 +1,65 @@
+"""
+Tests for the SVG output stage of the plotting tools: shared style classes and the gzipped copy.
+"""
+
+import gzip
+import os
+import sys
+
+import drawsvg as draw
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'depend', 'util_scripts'))
+import svg_output
+
+COLORS = ['#440154', '#31688e', '#35b779', '#fde725']
+
+
+def make_plot(samples):
+    """Draws tracks like the proviral landscape plot: a row of rects and a label per sample."""
+    drawing = draw.Drawing(900, samples * 6 + 20)
+    for i in range(samples):
+        row = draw.Group(transform='translate(0, {})'.format(i * 6))
+        for j in range(4):
+            row.append(draw.Rectangle(j * 200, 0, 150 + i % 7, 5, fill=COLORS[j], stroke='black', stroke_width=0.5))
+        row.append(draw.Text('sample {}'.format(i), 5, 850, 4, font_family='monospace', text_anchor='end'))
+        drawing.append(row)
+    drawing.append(draw.Line(0, 0, 900, 0, stroke='red', style='stroke-width: 2'))
+    return drawing
+
+
+def test_shared_styles_become_classes():
+    drawing = svg_output.compact_styles(make_plot(3))
+    svg = drawing.as_svg()
+
+    assert 'fill="' not in svg and 'font-family="' not in svg
+    assert '.s0{fill:#440154;stroke:black;stroke-width:0.5px}' in svg
+    assert '.s4{font-family:monospace;font-size:5px;text-anchor:end}' in svg
+    assert svg.count('class="s0"') == 3
+    assert 'style="stroke-width: 2"' in svg and 'stroke="red"' in svg  # Styled already, left alone.
+
+
+def test_styles_used_once_are_kept():
+    drawing = draw.Drawing(10, 10)
+    drawing.append(draw.Rectangle(0, 0, 5, 5, fill='red'))
+    drawing.append(draw.Rectangle(5, 5, 5, 5, fill='blue'))
+    svg = svg_output.compact_styles(drawing).as_svg()
+    assert 'fill="red"' in svg and 'fill="blue"' in svg and '<style>' not in svg
+
+
+def test_large_plot_is_smaller():
+    plain = make_plot(5000).as_svg()
+    compact = svg_output.compact_styles(make_plot(5000)).as_svg()
+    gzipped = svg_output.gzip_bytes(compact)
+    assert len(compact) < 0.7 * len(plain)
+    assert len(gzipped) < 0.15 * len(compact)
+    assert gzip.decompress(gzipped).decode() == compact
+
+
+def test_gzip_is_reproducible(tmp_path):
+    assert svg_output.gzip_bytes('<svg/>') == svg_output.gzip_bytes(b'<svg/>')
+    path = str(tmp_path / 'plot.svg')
+    svg_output.save(path, '<svg/>')
+    with open(path) as file:
+        assert file.read() == '<svg/>'
+    with gzip.open(path + '.gz') as file:
+        assert file.read() == b'<svg/>'
@@ -0,0 +1,78 @@
+"""
+Tests for the variable function tool's Mann-Whitney screen against SciPy, one category at a time.
+"""
+
+import os
+import random
+import sys
+
+import pytest
+from scipy import stats
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(BASE_DIR, 'depend', 'util_scripts'))
+import result_cache
+from tools.variable_function import variable_function
+
+
+def make_input(rows, alleles, decimals, seed=1):
+    rng = random.Random(seed)
+    lines = []
+    for _ in range(rows):
+        hlas = [rng.choice('ABC') + '%02d' % rng.randrange(alleles) if rng.random() > 0.2 else '' for _ in range(6)]
+        lines.append('\t'.join(hlas + [repr(round(rng.random() * 10 - 1, decimals))]))
+    return '\r\n'.join(lines)
+
+
+def screen(text, monkeypatch):
+    monkeypatch.setattr(result_cache, 'CACHE_MAX_BYTES', 0)
+    is_download, table, _ = variable_function.run(text, True)
+    assert is_download
+    return list(table)
+
+
+def scipy_screen(text):
+    """What the tool computed before: separate groups and a SciPy test per category."""
+    rows = [line.split('\t') for line in text.splitlines()]
+    values = [float(row[-1]) for row in rows]
+    ties = len(set(values)) != len(values)
+    results = {}
+    for category in {hla for row in rows for hla in row[:-1] if hla}:
+        pos = [value for row, value in zip(rows, values) if category in row[:-1]]
+        neg = [value for row, value in zip(rows, values) if category not in row[:-1]]
+        method = 'asymptotic' if min(len(pos), len(neg)) > 99 or ties else 'exact'
+        p = stats.mannwhitneyu(pos, neg, alternative='two-sided', method=method).pvalue
+        results[category] = [len(pos), len(neg), p, method]
+    return results
+
+
+@pytest.mark.parametrize('rows, alleles, decimals', [
+    (40, 5, 9),  # No ties: exact p-values for groups under 100.
+    (40, 5, 1),
+    (150, 10, 9),
+    (600, 30, 2),
+])
+def test_matches_scipy(rows, alleles, decimals, monkeypatch):
+    text = make_input(rows, alleles, decimals)
+    expected = scipy_screen(text)
+    results = screen(text, monkeypatch)
+    assert len(results) == len(expected)
+    for category, n_with, n_without, _, _, p, method in results:
+        assert [n_with, n_without, p, method] == expected[category]  # Exactly the same p-values.
+
+
+def test_medians(monkeypatch):
+    text = 'A01\tB07\t1.5\nA01\tB08\t3\nA02\tB07\t2\nA01\tB07\t10\nA02\tB08\t-4'
+    results = {row[0]: row[1:5] for row in screen(text, monkeypatch)}
+    assert results == {
+        'A01': [3, 2, 3.0, -1.0],
+        'A02': [2, 3, -1.0, 3.0],
+        'B07': [3, 2, 2.0, -0.5],
+        'B08': [2, 3, -0.5, 2.0],
+    }
+
+
+def test_category_in_every_row(monkeypatch):
+    results = screen('A01\tB07\t1\nA01\tB08\t2\nA01\tB07\t3', monkeypatch)
+    assert results[0][:5] == ['A01', 3, 0, 2.0, 'N/A']
+    assert results[0][5] != results[0][5]  # No second group, the p-value is nan.
@@ -0,0 +1,90 @@
+"""
+Tests for web_output.Site, and a benchmark of its render time against the number of result rows.
+"""
+
+import os
+import sys
+import time
+
+import pytest
+from django.conf import settings
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'depend', 'util_scripts'))
+
+if not settings.configured:
+    settings.configure()
+
+import django
+django.setup()  # static() asks the app registry whether staticfiles is installed.
+
+from django.template import Context, Engine
+from django.test import override_settings
+import web_output
+
+
+@pytest.fixture(autouse=True)
+def static_url():
+    with override_settings(STATIC_URL='/static/'):
+        yield
+
+
+def make_site(rows):
+    site = web_output.Site('codon by codon output', web_output.SITE_BOXED)
+    site.send('<h3>Results Table</h3>')
+    site.send('<table>')
+    for i in range(rows):
+        site.send('<tr><td>{}</td><td>K</td><td>0.250</td><td>0.500</td><td>12</td><td>30</td><td>{:.5f}</td></tr>'.format(i, i / rows))
+    site.send('</table>')
+    return site
+
+
+def test_output_is_plain_html():
+    site = web_output.Site('Results')
+    site.send_warning('Some mixtures,', ' they were ignored.')
+    site.send('first')
+    site.new_box()
+    site.send('{{ not a template }}')
+    html = site.generate_site()
+
+    assert html == ''.join(site.iter_site())
+    assert html.startswith('<html><head><link rel="stylesheet" href="/static/wo_style.css"/><title>Results</title>')
+    assert '{% load static %}' not in html
+    assert '<div class="box"><br><b><r style="color: orange">Warning: </r>Some mixtures,</b> they were ignored.<br><br></div>' in html
+    assert '<div class="box"><br>first<br><br></div><div class="box"><br>{{ not a template }}<br><br></div>' in html
+    assert 'analysis executed successfully' not in html
+    assert site.has_warning() and not site.has_error()
+
+
+def test_response():
+    site = make_site(10)
+    response = site.response()
+    assert response.content.decode() == site.generate_site()
+
+
+def render_through_template(site):
+    """How the views used to render a site: as a template, to expand {% load static %}."""
+    html = '{% load static %}' + site.generate_site()
+    engine = Engine(libraries={'static': 'django.templatetags.static'})
+    return engine.from_string(html).render(Context())
+
+
+def test_render_matches_template():
+    site = make_site(1000)
+    assert render_through_template(site) == site.generate_site()
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize('rows', [1000, 10000, 50000])
+def test_render_benchmark(rows):
+    site = make_site(rows)
+
+    start = time.perf_counter()
+    html = site.generate_site()
+    direct = time.perf_counter() - start
+
+    start = time.perf_counter()
+    rendered = render_through_template(site)
+    template = time.perf_counter() - start
+
+    assert rendered == html
+    assert direct < template
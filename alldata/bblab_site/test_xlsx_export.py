@@ -0,0 +1,109 @@
+"""
+Tests for the streaming .xlsx export used by the tools' emailed and downloaded results.
+"""
+
+import hashlib
+import inspect
+import os
+import sys
+import tracemalloc
+
+import pytest
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(BASE_DIR, 'depend', 'util_scripts'))
+sys.path.append(os.path.join(BASE_DIR, 'depend', 'libraries'))
+import xlsx_export
+import openpyxl
+from openpyxl import load_workbook
+from openpyxl.workbook import Workbook
+from openpyxl.worksheet.write_only import WriteOnlyWorksheet
+from openpyxl.writer.excel import ExcelWriter
+
+# The openpyxl internals xlsx_export overrides or relies on, with a sha256 (start) of their source in openpyxl 2.5.4.
+OPENPYXL_INTERNALS = [
+    (WriteOnlyWorksheet._write_header, '14bfcb74f935a5f2'),
+    (WriteOnlyWorksheet.append, '063242260b2a6d47'),
+    (WriteOnlyWorksheet.close, 'aad0d8e154168b04'),
+    (WriteOnlyWorksheet._cleanup, '0de129049bf9b7ad'),
+    (Workbook._add_sheet, '7658ebe4441c2677'),
+    (ExcelWriter.__init__, 'cd36c3736cf4260e'),
+    (ExcelWriter._write_worksheets, '41df3debcea6feb8'),
+]
+
+
+def test_openpyxl_internals_are_unchanged():
+    # If this fails openpyxl was updated, check xlsx_export's streaming classes against it before changing the hashes.
+    assert openpyxl.__version__ == xlsx_export.OPENPYXL_VERSION
+    for function, digest in OPENPYXL_INTERNALS:
+        assert hashlib.sha256(inspect.getsource(function).encode()).hexdigest()[:16] == digest, function.__qualname__
+
+
+def test_round_trip():
+    xlsx = xlsx_export.XlsxExport()
+    data = xlsx.add_sheet('Data', ['ID', 'Sequence', 'Length', 'Ratio'])
+    data.append(['seq1', 'ATG', 3, 0.5])
+    data.append(['seq2', ' ATGA ', None, True])
+    other = xlsx.add_sheet('Other', ['x'])
+    other.append([1])
+
+    workbook = load_workbook(xlsx.save())
+    xlsx.close()
+    assert workbook.sheetnames == ['Data', 'Other']
+    assert [[cell.value for cell in row] for row in workbook['Data'].iter_rows()] == [
+        ['ID', 'Sequence', 'Length', 'Ratio'],
+        ['seq1', 'ATG', 3, 0.5],
+        ['seq2', ' ATGA ', None, True],
+    ]
+    assert [[cell.value for cell in row] for row in workbook['Other'].iter_rows()] == [['x'], [1]]
+
+
+def test_fail_cells_are_red():
+    row = ['FAIL id', 'ACGT', 4, 'PASS', 'FAIL at codon 2']
+    assert sorted(xlsx_export.fail_fonts(row)) == [4]
+
+    xlsx = xlsx_export.XlsxExport()
+    xlsx.add_sheet('Data').append(row, xlsx_export.fail_fonts(row))
+    sheet = load_workbook(xlsx.save())['Data']
+    xlsx.close()
+    assert sheet['E1'].value == 'FAIL at codon 2'
+    assert sheet['E1'].font.color.rgb == '00FF0000'
+    assert sheet['A1'].font.color is None or sheet['A1'].font.color.rgb != '00FF0000'
+    assert sheet['D1'].font.color is None or sheet['D1'].font.color.rgb != '00FF0000'
+
+
+def test_empty_workbook_and_single_save():
+    xlsx = xlsx_export.XlsxExport()
+    assert load_workbook(xlsx.save()).sheetnames == ['Sheet']
+    assert xlsx.save().read(2) == b'PK'  # Saving again returns the same file.
+    xlsx.close()
+
+
+def test_attachment():
+    xlsx = xlsx_export.XlsxExport()
+    xlsx.add_sheet('Data', ['a'])
+    attachment = xlsx.attachment('results')
+    xlsx.close()
+    assert attachment.get_filename() == 'results.xlsx'
+    assert attachment.get_payload(decode=True)[:2] == b'PK'
+
+
+def _peak_memory(rows):
+    tracemalloc.start()
+    try:
+        xlsx = xlsx_export.XlsxExport()
+        sheet = xlsx.add_sheet('Data', ['ID', 'Result', 'Sequence', 'Value'])
+        for i in range(rows):
+            sheet.append(['seq{}'.format(i), 'FAIL', 'ACGT' * 10 + str(i), i * 0.5])
+        xlsx.save()
+        xlsx.close()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def test_memory_does_not_grow_with_rows():
+    small = _peak_memory(1000)
+    large = _peak_memory(10000)
+    # Only the compressed workbook grows (a few hundred kB here), the rows themselves aren't kept.
+    assert large < small + 1024 * 1024
@@ -1,15 +1,19 @@
 # Checked for python 3.7
-import cgi, sys
+import cgi, sys, os
+
+sys.path.append( os.environ.get('BBLAB_UTIL_PATH', 'fail') )
+from result_table import ResultTable, TablePage, viewer_html
+from web_output import static_url
 
 def run(userinput, button):
 	
 	out_str = ""
 
 	def printHtmlHeaders():
-		return ("""{% load static %}<!DOCTYPE html><html><head>
+		return ("""<!DOCTYPE html><html><head>
 		<script src="//ajax.googleapis.com/ajax/libs/jquery/1.11.1/jquery.min.js"></script>
-		<script src="{% static "bphi_script.js" %}"></script>
-		<link rel="stylesheet" href="{% static "/bphi_css/style.css" %}"></head><body>""")
+		<script src="{}"></script>
+		<link rel="stylesheet" href="{}"></head><body>""".format(static_url("bphi_script.js"), static_url("/bphi_css/style.css")))
 	
 	def makeD(lines):
 		tbl = str.maketrans(dict.fromkeys('\r'))
@@ -25,34 +29,23 @@ def run(userinput, button):
 				d[line[0]].append(line[1:])	
 		return d
 	
+	# Keep the most probable imputation of each patient.
+	d = makeD(userinput)
+	table = ResultTable(["pid", "A1", "A2", "B1", "B2", "C1", "C2", "Probability", "Ethnicity", "Error"])
+	for id in list(d.keys()):
+		table.append([id] + sorted([x for x in d[id]],key=lambda x: x[-1], reverse=True)[0])
+	
 	if button == "run":
 		is_download = False
 		out_str += printHtmlHeaders()+'<div class="container">'
-		d = makeD(userinput)
-		
-		out_str += """<table> <tr>
-			<th>pid</th>
-			<th>A1</th>
-			<th>A2</th>
-			<th>B1</th>
-			<th>B2</th>
-			<th>C1</th>
-			<th>C2</th>
-			<th>Probability</th>
-			<th>Ethnicity</th>
-			<th>Error</th> </tr>"""
-
-		for id in list(d.keys()):
-			item = '<td>'+id+'</td><td>'+('</td><td>').join(sorted([x for x in d[id]],key=lambda x: x[-1], reverse=True)[0])+'</td>'
-			out_str += '<tr>{}</tr>'.format(item)
 		
-		out_str += '</table>'
+		# The page shows the table a screenful at a time, from the copy stored with its job (see jobs.views.show_table).
+		out_str += viewer_html()
+		out_str += '</div></body></html>'
+		return (is_download, TablePage(out_str, table))
 
 	elif button == "dl":
-		is_download = True
-		out_str += "pid,A1,A2,B1,B2,C1,C2,Probability,Ethnicity,Error\r\n"
-		d = makeD(userinput)
-		for id in list(d.keys()):
-			out_str += id+','+','.join(sorted([x for x in d[id]],key=lambda x: x[-1], reverse=True)[0])+'\r\n'
+		# The view exports the table in the requested format.
+		return (True, table, "best_prob_HLA_imputation")
 
-	return (is_download, out_str, "best_prob_HLA_imputation.csv")
+	return (is_download, out_str)
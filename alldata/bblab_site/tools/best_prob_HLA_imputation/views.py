@@ -1,6 +1,11 @@
 from django.shortcuts import render
 from django.http import HttpResponse
 from django.template import Context, loader, RequestContext, Template
+from ..jobs.views import show_table
+import os, sys
+
+sys.path.append( os.environ.get('BBLAB_UTIL_PATH', 'fail') )
+import result_table
 
 def index(request):
     context = {}
@@ -27,12 +32,10 @@ def results(request):
         from . import best_prob_HLA_imputation
         output_t = best_prob_HLA_imputation.run(userinput, button)
         if output_t[0] == False:
-                template = Template(output_t[1])
-                context = RequestContext(request)
-                return HttpResponse(template.render(context))
+                if isinstance(output_t[1], result_table.TablePage):  # The results page and its table, which the page shows a part of at a time.
+                        return show_table("best_prob_HLA_imputation", output_t[1])
+                return HttpResponse(output_t[1])
         else:
-                response = HttpResponse(output_t[1], content_type="application/octet-stream")
-                response['Content-Disposition'] = 'attachment; filename={}'.format(output_t[2])
-                return response
+                return result_table.response(output_t[1], result_table.requested_format(data, "csv"), output_t[2])
     else:
         return HttpResponse("Please use the form to submit data.")
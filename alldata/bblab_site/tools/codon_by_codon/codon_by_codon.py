@@ -2,18 +2,15 @@
 
 import re, sys, os
 
-sys.path.append(
-    os.environ.get("BBLAB_LIB_PATH", "fail")
-)  # Add the path to openpyxl, (excel files.)
-from openpyxl import Workbook
-import openpyxl
-
 sys.path.append(os.environ.get("BBLAB_UTIL_PATH", "fail"))
 import sequence_utils
 import math_utils
 import mailer
 import web_output
 import test_utils
+import xlsx_export
+import result_table
+import job_queue
 
 sys.path.append(os.environ.get("BBLAB_OP_PATH", "fail"))
 import op_codon_by_codon
@@ -27,9 +24,9 @@ def run(protein_in, min_count, desc_string, email_address_string):
     ##### Get website input.
 
     # Assign form data to variables.
-    protein_in = protein_in.replace("\r", "\n").replace("\n\n", "\n").replace(" ", "")
     protein_sequences = [
-        tuple(e.split("\t")) for e in protein_in.split("\n")
+        tuple(line.replace(" ", "").split("\t"))
+        for line in sequence_utils.iter_lines(protein_in)
     ]  # Turn this into a list of tuples. -> (decimal_value, protein_sequence)
 
     analysis_id = desc_string
@@ -119,12 +116,11 @@ def run(protein_in, min_count, desc_string, email_address_string):
 
     XLSX_FILENAME = "_".join(s for s in ["codon_by_codon_data", analysis_id] if s)
 
-    wb = Workbook()  # Create a new workbook.
-    ws = wb.active  # Create a new page. (worksheet [ws])
-    ws.title = "Data"  # Page title
+    xlsx = xlsx_export.XlsxExport()  # Create a new workbook.
 
-    # Create the title row information (key).
-    ws.append(
+    # Create a new page with the title row information (key).
+    ws = xlsx.add_sheet(
+        "Data",
         [
             "Coord",
             "Amino",
@@ -134,39 +130,45 @@ def run(protein_in, min_count, desc_string, email_address_string):
             "N(Without)",
             "Kruskal-wallis p",
             "q-value",
-        ]
+        ],
     )
 
-    # Add rows to the document.
-    for item in sorted(output_matrix, key=lambda x: x.p_value):
-        ws.append(item.get_formatted_row())
+    # Add rows to the document, sorted by p-value.
+    results = [item.get_formatted_row() for item in sorted(output_matrix, key=lambda x: x.p_value)]
+    for row in results:
+        ws.append(row)
 
-    # Save a string version of the excel workbook and send it to the file builder.
-    file_text = openpyxl.writer.excel.save_virtual_workbook(wb)
-    xlsx_file = mailer.create_file(XLSX_FILENAME, "xlsx", file_text)
+    # Stream the workbook to a temporary file and send it to the file builder.
+    xlsx_file = xlsx.attachment(XLSX_FILENAME)
+    xlsx.close()
 
     ##### Display results on webpage
 
     # Display results table if we have any
     if output_matrix:
         site.send("<h3>Results Table</h3>")
-        site.send(
-            '<table border="1" cellpadding="5" cellspacing="0" style="margin: 10px 0;">'
-        )
-        site.send(
-            "<tr><th>Position</th><th>Amino Acid</th><th>Median (With)</th><th>Median (Without)</th><th>N (With)</th><th>N (Without)</th><th>P-value</th><th>Q-value</th></tr>"
+        columns = ["Position", "Amino Acid", "Median (With)", "Median (Without)", "N (With)", "N (Without)", "P-value", "Q-value"]
+        table = result_table.ResultTable(
+            columns,
+            [
+                [row[0], row[1], "{:.3f}".format(row[2]), "{:.3f}".format(row[3]), row[4], row[5], "{:.5f}".format(row[6]), "{:.5f}".format(row[7])]
+                for row in results
+            ],
         )
 
-        # Sort by p-value and display rows
-        for item in sorted(output_matrix, key=lambda x: x.p_value):
-            row = item.get_formatted_row()
+        job_path = job_queue.current_job_path()
+        if job_path is not None:
+            # Run by the job queue: the job's page shows the table a screenful at a time.
+            result_table.store(table, job_path)
+            site.send(result_table.viewer_html())
+        else:
             site.send(
-                "<tr><td>{}</td><td>{}</td><td>{:.3f}</td><td>{:.3f}</td><td>{}</td><td>{}</td><td>{:.5f}</td><td>{:.5f}</td></tr>".format(
-                    row[0], row[1], row[2], row[3], row[4], row[5], row[6], row[7]
-                )
+                '<table border="1" cellpadding="5" cellspacing="0" style="margin: 10px 0;">'
             )
-
-        site.send("</table>")
+            site.send("<tr><th>" + "</th><th>".join(columns) + "</th></tr>")
+            for row in table:
+                site.send("<tr><td>" + "</td><td>".join(str(v) for v in row) + "</td></tr>")
+            site.send("</table>")
         site.send("<p>Total results: {}</p>".format(len(output_matrix)))
     else:
         site.send("No significant results found for the given parameters.")
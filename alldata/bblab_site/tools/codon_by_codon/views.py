@@ -3,6 +3,8 @@ from django.http import HttpResponse
 from django.template import Context, loader, RequestContext, Template
 from django.contrib.auth.decorators import login_required
 
+from ..jobs.views import submit
+
 def index(request):
     context = {}
     if request.user.is_authenticated:
@@ -21,13 +23,9 @@ def calculate(request):
         desc = data['analysisID']
         email_address = data['emailAddress']
 
-        # Run actual calulation (by passing data)
+        # Queue the calculation, the job page shows its output when it's done.
         from . import codon_by_codon
-        output_t = codon_by_codon.run(fasta_data, min_count, desc, email_address)
-        template = Template(output_t)
-
-        context = RequestContext(request)
-        return HttpResponse(template.render(context))
+        return submit(codon_by_codon.run, fasta_data, min_count, desc, email_address)
     else:
         return HttpResponse("Please use the form to submit data.")
 
@@ -45,9 +45,7 @@ def calculate(request):
         from . import fasta_converter
         output_t = fasta_converter.run(fasta_data, button, delim, splitfastaheader, stripwhitespace)
         if output_t[0] == False:
-                template = Template(output_t[1])
-                context = RequestContext(request)
-                return HttpResponse(template.render(context))
+                return HttpResponse(output_t[1])
         else:
                 response = HttpResponse(output_t[1], content_type="application/octet-stream")
                 response['Content-Disposition'] = 'attachment; filename={}'.format(output_t[2])
@@ -34,7 +34,7 @@ def run(input_string, session_id, row_column, email_address_string):
 	
 	if input_string.find(',') == -1:
 		website.send_error( "Could not find any ',' characters,", " did you format your input correctly?" )
-		return website.generate_site()		
+		return website.response()		
 
 	row_id_list = [ row[:row.find(',')] for row in input_string.split('\n') if row.find(',') != -1 ]
 
@@ -69,7 +69,7 @@ def run(input_string, session_id, row_column, email_address_string):
 			website.send_error( "{} could not be added to the archive,".format(csv_filename), " a file already exists with the same name." )
 	else:
 		website.send_error("Improper Filename,", " make sure your filename does not include any invalid characters.")
-		return website.generate_site()
+		return website.response()
 
 	
 	##### Create .html file.  (for person.)
@@ -141,7 +141,7 @@ def run(input_string, session_id, row_column, email_address_string):
 			website.send_error( "{} could not be added to the archive,".format(html_filename), " a file already exists with the same name." )
 	else: 
 		website.send_error("Improper Filename,", " make sure your filename does not include any invalid characters.")
-		return website.generate_site()	
+		return website.response()	
 	
 
 	##### Give user a link to the file directory.  ( Before the email )
@@ -186,4 +186,4 @@ def run(input_string, session_id, row_column, email_address_string):
 	print_string = filesys_utils.archive_in_dir(OUT_PATH, archive_path, 30)  # Move files older that 30 days from OUT_PATH to archive_path, 
 	website.send(print_string + "<br>")	
 	
-	return website.generate_site()
+	return website.response()
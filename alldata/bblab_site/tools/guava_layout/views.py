@@ -37,10 +37,7 @@ def generate_files(request):
 		# Run actual calculatiuon
 		from . import guava_generate_files
 		output_t = guava_generate_files.run(input_str, session_id, row_column, email_address)
-		template = Template(output_t)
-
-		context = RequestContext(request)	
-		return HttpResponse(template.render(context))
+		return output_t  # The Site's HttpResponse.
 	else:
 		return HttpResponse("Please use the form to submit data.")
 
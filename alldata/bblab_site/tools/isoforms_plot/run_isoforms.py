@@ -4,11 +4,16 @@ import os
 sys.path.append(os.environ.get("BBLAB_UTIL_PATH", "fail"))
 
 import traceback
+from io import StringIO
 from pathlib import Path
 from typing import TextIO
 
+import job_queue
+import result_cache
+import svg_output
+
 # Constants
-OUTPUT_SVG = "/alldata/bblab_site/media/output.svg"
+CACHE_VERSION = 2  # Change when the plot drawn for the same input changes.
 DEFAULT_CSV_PATH = Path(__file__).parent / "test_isoforms.csv"
 
 
@@ -38,16 +43,26 @@ def run(csv_file: TextIO) -> dict:
     try:
         from .isoforms_plot_lib import parser, compiler, plotter, lexer
 
-        lexed = lexer.lex(csv_file)
-        parsed = parser.parse(lexed)
-        compiled = compiler.compile(parsed)
-        drawing = plotter.plot(
-            compiled.transcripts,
-            compiled.groups,
-            compiled.splicing_sites,
-            compiled.title,
-        )
-        drawing.save_svg(OUTPUT_SVG)
+        content = csv_file.read()
+        if isinstance(content, bytes):
+            content = lexer.decode_bytes(content)
+        content = lexer.normalize_line_endings(content)
+
+        def draw() -> str:
+            lexed = lexer.lex(StringIO(content))
+            parsed = parser.parse(lexed)
+            compiled = compiler.compile(parsed)
+            drawing = plotter.plot(
+                compiled.transcripts,
+                compiled.groups,
+                compiled.splicing_sites,
+                compiled.title,
+            )
+            return svg_output.compact_styles(drawing).as_svg()
+
+        # The same file is often plotted again, its SVG comes from the result cache then.
+        svg = result_cache.cached("isoforms_plot", CACHE_VERSION, content, draw)
+        svg_path = job_queue.save_output("isoforms_plot", svg, "svg", svg_output.gzip_bytes(svg))
 
     except Exception as exc:
         return {
@@ -57,4 +72,4 @@ def run(csv_file: TextIO) -> dict:
         }
 
     # Return success with SVG path
-    return {"success": True, "svg_path": "/media/output.svg"}
+    return {"success": True, "svg_path": svg_path}
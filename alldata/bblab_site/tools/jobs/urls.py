@@ -0,0 +1,9 @@
+from django.urls import path
+from . import views
+
+urlpatterns = [
+    path('<slug:job_id>/', views.job, name='job'),
+    path('<slug:job_id>/status/', views.status, name='status'),
+    path('<slug:job_id>/rows/', views.rows, name='rows'),
+    path('<slug:job_id>/files/<str:name>', views.job_file, name='job_file'),
+]
@@ -0,0 +1,109 @@
+import os, sys, json, mimetypes
+
+from django.shortcuts import render, redirect
+from django.http import HttpResponse, HttpResponseBadRequest, Http404
+from django.template import RequestContext, Template
+
+sys.path.append(os.environ.get('BBLAB_UTIL_PATH', 'fail'))
+import job_queue
+import result_table
+import django_utils
+
+# Long analyses run in the job queue's worker processes (see depend/util_scripts/job_queue.py).
+# A tool's view submits the job and redirects here, this page waits for it and then shows its output.
+
+ROWS_LIMIT = 1000  # Most rows sent in one page of a result table.
+
+def submit(function, *args, **kwargs):
+    '''
+    Queues function(*args, **kwargs) and returns a redirect to the page of the job.
+    '''
+    job_id = job_queue.get_queue().submit(function, *args, **kwargs)
+    return redirect(job_queue.JOB_URL.format(job_id))
+
+def show_table(name, page):
+    '''
+    For tools that run in the request: stores their output page and result table (a result_table.TablePage)
+    as a finished job, and returns a redirect to the job's page. The page shows the table with result_table.viewer_html().
+    '''
+    queue = job_queue.get_queue()
+    job_id = queue.record(name, page.html)
+    result_table.store(page.table, queue.job_path(job_id))
+    return redirect(job_queue.JOB_URL.format(job_id))
+
+def _get_job(job_id):
+    job = job_queue.get_queue().get(job_id)
+    if job is None:
+        raise Http404("No such job.")
+    return job
+
+# Shows the tool's output when the job is done, otherwise a page that waits for it.
+def job(request, job_id):
+    job = _get_job(job_id)
+
+    if job["status"] == job_queue.DONE:
+        output_t = job_queue.get_queue().result(job_id)
+        if output_t is None:
+            output_t = "The analysis has finished."
+        if output_t.startswith("{% load static %}"):
+            # Output stored before web_output resolved static urls itself.
+            return HttpResponse(Template(output_t).render(RequestContext(request)))
+        return HttpResponse(output_t)
+
+    context = {"job": job}
+    if job["status"] == job_queue.FAILED and job["error"]:
+        # The last line of the traceback, the exception (the worker's own message if it stopped).
+        context["error"] = job["error"].strip().splitlines()[-1]
+    if request.user.is_authenticated:
+        context["user_authenticated"]=True
+        context["username"]=request.user.username
+    return render(request, "jobs/job.html", context)
+
+# Returns the state of a job as json, the job page polls this.
+def status(request, job_id):
+    job = _get_job(job_id)
+    response_data = { "status" : job["status"], "position" : job["position"] }
+    return HttpResponse( json.dumps(response_data), content_type="application/json" )
+
+# Returns a page of a job's result table as json.
+# Parameters: offset, limit, sort (column index), order ("asc" or "desc"), col_offset and col_limit.
+def rows(request, job_id):
+    _get_job(job_id)
+    try:
+        table = result_table.StoredTable(job_queue.get_queue().job_path(job_id))
+    except FileNotFoundError:
+        raise Http404("This job has no result table.")
+
+    try:
+        offset = max(int(request.GET.get("offset", 0)), 0)
+        limit = min(max(int(request.GET.get("limit", 100)), 0), ROWS_LIMIT)
+        sort = request.GET.get("sort", "")
+        sort = int(sort) if sort != "" else None
+        column_offset = max(int(request.GET.get("col_offset", 0)), 0)
+        column_limit = request.GET.get("col_limit", "")
+        column_limit = max(int(column_limit), 0) if column_limit != "" else None
+        rows = table.rows(offset, limit, sort, request.GET.get("order") == "desc", column_offset, column_limit)
+    except (ValueError, IndexError) as e:
+        return HttpResponseBadRequest(str(e))
+
+    response_data = { "columns" : table.columns, "total" : table.total, "offset" : offset, "rows" : rows }
+    return HttpResponse( json.dumps(response_data), content_type="application/json" )
+
+# Sends a file saved with job_queue.save_output(), or its gzipped copy if there is one and the browser accepts gzip.
+# Its name is its hash, so it can be cached for good.
+def job_file(request, job_id, name):
+    _get_job(job_id)
+    path = os.path.join(job_queue.get_queue().job_path(job_id), name)
+    if not job_queue.JOB_FILE_NAME.match(name) or not os.path.isfile(path):
+        raise Http404("No such file.")
+    content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+
+    gzipped = os.path.isfile(path + ".gz")
+    send_gzipped = gzipped and "gzip" in request.META.get("HTTP_ACCEPT_ENCODING", "")
+    response = django_utils.file_response(request, path + ".gz" if send_gzipped else path, content_type, name)
+    if send_gzipped:
+        response["Content-Encoding"] = "gzip"
+    if gzipped:
+        response["Vary"] = "Accept-Encoding"
+    response["Cache-Control"] = "public, max-age=31536000, immutable"
+    return response
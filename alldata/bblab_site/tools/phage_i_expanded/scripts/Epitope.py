@@ -1,7 +1,10 @@
+from bisect import bisect_left, bisect_right
 
 
 class Epitope:
 
+    __slots__ = ('epitope', 'protein', 'hlas', 'start', 'end', 'source', 'r4', 'r2', 'created_at', 'updated_at')
+
     def __init__(self, epitope=None, protein=None,
     hlas=None, start=None, end=None,
     source=None, r4=None, r2=None, created_at=None, updated_at=None):
@@ -46,4 +49,45 @@ class Epitope:
             val = 'N-{}'.format(self.start - pos)
         else:
             val = 'C+{}'.format(pos - self.end)
-        return val
\ No newline at end of file
+        return val
+
+
+class EpitopeIndex:
+    """
+    The epitopes by protein and HLA, to find the ones around a position without scanning all of
+    them. There is an index for each list of HLAs (hlas, r4 and r2) of the epitopes: (protein, hla)
+    -> the epitopes' starts, sorted, and the epitopes' numbers in the same order, for bisecting.
+    """
+
+    window = 3  # positions up to this far outside an epitope are around it too
+
+    def __init__(self, epitopes):
+        self.epitopes = epitopes
+        self.max_length = max([0] + [e.end - e.start for e in epitopes])
+        self.indexes = {name: self._index(name) for name in ('hlas', 'r4', 'r2')}
+
+    def _index(self, name):
+        entries = {}
+        for i, epitope in enumerate(self.epitopes):
+            for hla in getattr(epitope, name):
+                entries.setdefault((epitope.protein, hla), []).append((epitope.start, i))
+        index = {}
+        for key, starts in entries.items():
+            starts.sort()
+            index[key] = ([start for start, _ in starts], [i for _, i in starts])
+        return index
+
+    def find(self, protein, hla, pos, names=('hlas',)):
+        """
+        Returns the epitopes of protein with hla in one of the HLA lists names, that pos is in or
+        at most window positions away from, in the order of the epitopes file.
+        """
+        found = set()
+        for name in names:
+            entry = self.indexes[name].get((protein, hla))
+            if entry:
+                starts, numbers = entry
+                first = bisect_left(starts, pos - self.window - self.max_length)
+                last = bisect_right(starts, pos + self.window)
+                found.update(i for i in numbers[first:last] if pos <= self.epitopes[i].end + self.window)
+        return [self.epitopes[i] for i in sorted(found)]
@@ -2,11 +2,31 @@ import sys
 import math
 import os
 import datetime
+import pickle
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from .Codon import *
 from .Epitope import *
 import logging
 from itertools import *
 
+sys.path.append(os.environ.get('BBLAB_UTIL_PATH', 'fail'))
+from result_table import ResultTable, TablePage, viewer_html
+import result_cache
+
+EPITOPES_FILE = 'epitopes_v1.0.3.txt'
+CACHE_VERSION = '4/' + EPITOPES_FILE  # Change when the results for the same input change.
+# The indexed epitopes are pickled here, so other workers don't parse them again. Empty turns it off.
+EPITOPES_PICKLE = os.environ.get('BBLAB_PHAGE_EPITOPES_PICKLE', os.path.join(result_cache.CACHE_DIR, 'phage_epitopes.pickle'))
+EPITOPES_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', EPITOPES_FILE)
+
+# The proteins of the form, also the ones a batch can have. BATCH is the form's choice for a batch.
+PROTEINS = ('Gag', 'Pol', 'Vif', 'Vpr', 'Vpu', 'Tat', 'Rev', 'Env', 'gp41', 'Nef')
+BATCH = 'batch'
+# Processes analyzing the proteins of a batch, 1 runs everything in the calling process and 0 uses every core.
+WORKERS = int(os.environ.get('BBLAB_PHAGE_WORKERS', '1'))
+START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
 output_cols = (
     'patient_id',
     'hiv_protein',
@@ -37,52 +57,68 @@ def printFileHeaders(filename):
 # Flag = 1 will output all mixtures as "X"
 # Flag = 2 will output all synonymous mixtures as they are and all non-synonymous mixtures as "X"
 # Flag = 3 will output all mixtures in the format [A/B] if a mixture encodes for amino acid A or B
-def translateDNA(sequence, resolvecharacter="X", flag=3):
-    chars = [' ', '\r\n', '\n', '\r']
-    for char in chars:
-        if char in sequence:
-            sequence = sequence.replace(char, '')
-    sequence = sequence.upper()
-    aaseq = []
-    i = 0
-    while i < len(sequence):
+def translateCodon(codon, resolvecharacter="X", flag=3):
+    """Returns the amino acid (or mixture) of codon, or None if it can't be resolved."""
+    resolved = Codon.resolveCodon(codon)
+    # If the codon has no mixture bases just add it to the amino acid chain
+    if len(resolved) <= 1:
         try:
-            codon = Codon.resolveCodon(sequence[i:i+3])
-        except IndexError:
-            codon = Codon.resolveCodon('???')
-        # If the codon has no mixture bases just add it to the amino acid chain
-        if len(codon) <= 1:
-            try:
-                aaseq.append(Codon.codon_dict[codon[0]])
-            except KeyError:
-                logging.error(f'Could not resolve codon: "{codon}"')
-        # Codon contains mixture base
-        else:
-            # If flag is set to 1
-            if (flag == 1):
-                aaseq.append(resolvecharacter)
-            # If flag is set to 2
-            elif (flag == 2):
-                unique = set([Codon.codon_dict[potential] for potential in codon])
-                # If there is more than resolved one amino acid
-                if (len(unique) > 1):
-                    aaseq.append(resolvecharacter)
-                else:
-                    aaseq.append(unique.pop())
-            # If flag is set to 3
-            else:
-                try:
-                    unique = set([Codon.codon_dict[potential] for potential in codon])
-                except KeyError:
-                    print('Could not map one of the codons in: {}'.format(codon))
-                    print('Sequence was: {}'.format(sequence[i:i+3]))
-                    sys.exit(1)
-                # If there is more than resolved one amino acid
-                if (len(unique) > 1):
-                    aaseq.append('['+('/').join(unique)+']')
-                else:
-                    aaseq.append(unique.pop())
-        i += 3
+            return Codon.codon_dict[resolved[0]]
+        except KeyError:
+            logging.error(f'Could not resolve codon: "{resolved}"')
+            return None
+    # Codon contains mixture base
+    # If flag is set to 1
+    if (flag == 1):
+        return resolvecharacter
+    # If flag is set to 2
+    elif (flag == 2):
+        unique = set([Codon.codon_dict[potential] for potential in resolved])
+        # If there is more than resolved one amino acid
+        if (len(unique) > 1):
+            return resolvecharacter
+        return unique.pop()
+    # If flag is set to 3
+    try:
+        unique = set([Codon.codon_dict[potential] for potential in resolved])
+    except KeyError:
+        print('Could not map one of the codons in: {}'.format(resolved))
+        print('Sequence was: {}'.format(codon))
+        sys.exit(1)
+    # If there is more than resolved one amino acid
+    if (len(unique) > 1):
+        return '['+('/').join(sorted(unique))+']'  # Sorted, the same in every process.
+    return unique.pop()
+
+# Every codon of bases, IUPAC mixtures, gaps and X is translated ahead, for each flag (and the default
+# resolvecharacter), so translating a sequence is a lookup per codon. Other codons are translated one by one.
+CODON_ALPHABET = 'ACGTWRKYSMVHDBN-X'
+_codon_tables = {}
+
+def codonTable(resolvecharacter="X", flag=3):
+    """Returns {codon: translateCodon(codon, resolvecharacter, flag)} for the codons of CODON_ALPHABET."""
+    key = (resolvecharacter, flag if flag in (1, 2) else 3)
+    table = _codon_tables.get(key)
+    if table is None:
+        table = _codon_tables[key] = {
+            codon: translateCodon(codon, resolvecharacter, flag)
+            for codon in map(''.join, product(CODON_ALPHABET, repeat=3))
+        }
+    return table
+
+for flag in (1, 2, 3):
+    codonTable(flag=flag)
+
+_WHITESPACE = str.maketrans('', '', ' \r\n')
+
+def translateDNA(sequence, resolvecharacter="X", flag=3):
+    table = codonTable(resolvecharacter, flag)
+    sequence = sequence.translate(_WHITESPACE).upper()
+    codons = [sequence[i:i+3] for i in range(0, len(sequence), 3)]
+    aaseq = list(map(table.get, codons))
+    if None in aaseq:
+        aaseq = [translateCodon(codon, resolvecharacter, flag) if aa is None else aa for aa, codon in zip(aaseq, codons)]
+        aaseq = [aa for aa in aaseq if aa is not None]
     return aaseq
 
 def parse(input):
@@ -170,12 +206,9 @@ def analyzePatient(patient, patient_id, protein, grouped_hlas, epitopes):
     results = []
     ghlas = grouped_hlas
     for hla in patient['hlas']:
-        compare_hlas = [x[:len(hla)] for x in ghlas]
-        try:
-            compare_index = list(ghlas.keys()).index(hla[:len(hla)])
-        except ValueError:
+        if hla not in ghlas:
             continue
-        compare_hla = compare_hlas[compare_index]
+        compare_hla = hla
         done = set()
         for state in ghlas[compare_hla]:
             for pos in ghlas[compare_hla][state]:
@@ -198,65 +231,21 @@ def analyzePatient(patient, patient_id, protein, grouped_hlas, epitopes):
                         'pos': pos,
                         'aa': aa,
                         'patient_aa': patient_aa,
-                        'epitope': set(),
+                        'epitope': epitopes.find(protein, hla, pos),
                         'type': False
                     }
-                    _min = None
-                    for epitope in epitopes:
-                        if (epitope.protein == protein) and ((hla in epitope.hlas)):
-                            if ((epitope.start - 3) <= result['pos'] <= (epitope.end + 3)):
-                                result['epitope'].add(epitope)
                     if not result['epitope']:
-                        for epitope in epitopes:
-                            if (epitope.protein == protein) and ((hla in epitope.r4) or (hla in epitope.r2)):
-                                if ((epitope.start - 3) <= result['pos'] <= (epitope.end + 3)):
-                                    result['epitope'].add(epitope)
-                                    result['type'] = True
-                    #print(result['epitope'])
+                        result['epitope'] = epitopes.find(protein, hla, pos, ('r4', 'r2'))
+                        result['type'] = bool(result['epitope'])
                     results.append(result)
                     done.add((pos, patient_aa))
     return results
 
-def htmlResults(results, protein):
-    html = printHtmlHeaders()
-    html += '<table id="output_table">'
-    html += '<th>{}</th>'.format('</th><th>'.join(output_cols))
-    for result in results:
-        html += ('<tr>'
-              '<td>{}</td>'
-              '<td>{}</td>'
-              '<td>{}</td>'
-              '<td>{}</td>'
-              '<td>{}</td>'
-              '<td>{}</td>').format(result['pid'],
-                                   protein,
-                                   result['hla'],
-                                   str(result['pos']),
-                                   result['patient_aa'],
-                                   result['state'])
-        first = (',').join(['('+(',').join(x.epitope)+')' for x in result['epitope']])
-        if first:
-            html += ('<td>{}</td>'
-                  '<td>{}</td>'
-                  '<td>{}</td>'
-                  '<td>{}</td>'
-                  '<td>{}</td>'
-                  '<td>{}</td>').format(first,
-                                       (',').join(['('+(',').join(x.hlas)+')' for x in result['epitope']]),
-                                       (',').join(['({}-{})'.format(x.start, x.end) for x in result['epitope']]),
-                                       (',').join(['({})'.format(x.source) for x in result['epitope']]),
-                                       'Y' if result['type'] else 'NA',
-                                       '('+(',').join([x.getPos(result['pos'])for x in result['epitope']])+')')
-        else:
-            html += ('<td>NA</td>' * 6)
-            continue
-        html += ('</tr>')
-    html += '</table></body></html>'
-    return html
+def htmlResults():
+    # The page shows the table a screenful at a time, from the copy stored with its job (see jobs.views.show_table).
+    return printHtmlHeaders() + viewer_html() + '</body></html>'
 
-def tsvResults(results, protein, delim='\t'):
-    tsv = []
-    tsv.append(delim.join(output_cols))
+def _tableRows(results, protein):
     for result in results:
         temp = [
             result['pid'],
@@ -271,7 +260,7 @@ def tsvResults(results, protein, delim='\t'):
         if first:
             temp.extend([
                 first,
-                ','.join(['({})'.format(','.join(x.hlas)) for x in result['epitope']]),
+                ','.join(['({})'.format(','.join(sorted(x.hlas))) for x in result['epitope']]),
                 ','.join(['({}-{})'.format(x.start, x.end) for x in result['epitope']]),
                 ','.join(['({})'.format(x.source) for x in result['epitope']]),
                 'Y' if result['type'] else 'NA',
@@ -279,45 +268,163 @@ def tsvResults(results, protein, delim='\t'):
             ])
         else:
             temp.extend(('NA',)*6)
-        temp = delim.join(temp)
-        tsv.append(temp)
-    return '\n'.join(tsv)
+        yield temp
 
 def get_current_datetime():
     return datetime.datetime.now().strftime('%Y-%m-%d_%H:%M:%S')
 
-def run(hlas, patients, protein, button):
-    current_path = os.path.dirname(os.path.realpath(__file__))
-    epitopes_file = os.path.join(current_path, '..', 'epitopes_v1.0.3.txt')
-
+def readEpitopes(epitopes_file):
+    """Returns the epitopes in epitopes_file, with their HLAs normalized by parseHLA into frozensets.
+    Each HLA, and each set of HLAs, is one object shared by all the epitopes that have it."""
+    normalized = {}
+    hla_sets = {}
+    def normalize(hlas):
+        for hla in hlas:
+            if hla not in normalized:
+                normalized[hla] = sys.intern(parseHLA(hla))
+        hlas = frozenset(normalized[hla] for hla in hlas)
+        return hla_sets.setdefault(hlas, hlas)
     epitopes = Epitope.parseEpitopes(epitopes_file)
     for e in epitopes:
-        for i,hla in enumerate(e.hlas):
-            e.hlas[i] = parseHLA(hla)
-        for i,hla in enumerate(e.r2):
-            e.r2[i] = parseHLA(hla)
-        for i,hla in enumerate(e.r4):
-            e.r4[i] = parseHLA(hla)
-        e.hlas = set(e.hlas)
-        e.r2 = set(e.r2)
-        e.r4 = set(e.r4)
+        e.protein = sys.intern(e.protein)
+        e.hlas = normalize(e.hlas)
+        e.r2 = normalize(e.r2)
+        e.r4 = normalize(e.r4)
+    return epitopes
 
+_epitope_indexes = {}  # epitopes file: (its version, EpitopeIndex)
+
+def epitopesVersion(epitopes_file):
+    """Returns what identifies the epitopes in epitopes_file (and this version of PHAGE), it changes when the file is edited."""
+    stat = os.stat(epitopes_file)
+    return (os.path.realpath(epitopes_file), stat.st_mtime_ns, stat.st_size, CACHE_VERSION)
+
+def loadEpitopes(epitopes_file):
+    """Returns the EpitopeIndex of the epitopes in epitopes_file. They're read once per process, and
+    again when the file changes, from the EPITOPES_PICKLE copy if another worker read them already."""
+    version = epitopesVersion(epitopes_file)
+    loaded = _epitope_indexes.get(epitopes_file)
+    if loaded and loaded[0] == version:
+        return loaded[1]
+    index = None
+    if EPITOPES_PICKLE:
+        try:
+            with open(EPITOPES_PICKLE, 'rb') as f:
+                pickled_version, index = pickle.load(f)
+            if pickled_version != version:
+                index = None
+        except (OSError, EOFError, ValueError, AttributeError, pickle.UnpicklingError):
+            index = None
+    if index is None:
+        index = EpitopeIndex(readEpitopes(epitopes_file))
+        if EPITOPES_PICKLE:
+            part_path = '{}.{}.part'.format(EPITOPES_PICKLE, os.getpid())
+            try:
+                with open(part_path, 'wb') as f:
+                    pickle.dump((version, index), f, pickle.HIGHEST_PROTOCOL)
+                os.replace(part_path, EPITOPES_PICKLE)
+            except OSError:
+                pass
+    _epitope_indexes[epitopes_file] = (version, index)
+    return index
+
+def getBatchPatients(patients):
+    """Returns {protein: patients like getPatients(patients, 1), with the 'dna' sequence not translated
+    yet} for a batch, where each line has a patient's id, HLAs, a protein and the patient's sequence
+    of that protein. The HLAs of all a patient's lines are shared by its proteins."""
+    proteins = {protein.lower(): protein for protein in PROTEINS}
+    d = {}
+    patient_hlas = {}
+    for line in patients:
+        if line == ['']:
+            continue
+        if len(line) < 3:
+            raise ValueError('each line of a batch needs a patient id, HLAs, a protein and a sequence')
+        pid = line[0]
+        protein = proteins.get(line[-2].strip().lower())
+        if protein is None:
+            raise ValueError('unknown protein "{}" for patient {}'.format(line[-2], pid))
+        if pid not in patient_hlas:
+            patient_hlas[pid] = {'hlas': set(), 'i': len(patient_hlas)}
+        for hla in line[1:-2]:
+            hla = parseHLA(hla)
+            if (hla == ""):
+                continue
+            patient_hlas[pid]['hlas'].add(hla)
+        patients_of_protein = d.setdefault(protein, {})
+        if pid in patients_of_protein:
+            raise ValueError('patient {} has more than one {} sequence'.format(pid, protein))
+        patients_of_protein[pid] = dict(patient_hlas[pid], dna=line[-1])
+    return d
+
+def groupedHLAs(hlas):
     hlas = parse(hlas)
     for hla in hlas:
         hla[0] = parseHLA(hla[0])
-    grouped_hlas = groupHLA(hlas)
+    return groupHLA(hlas)
 
-    patients = getPatients(parse(patients), 1)
+def analyzeProtein(protein, patients, grouped_hlas):
+    """Returns the result table rows for the patients' (from getPatients) sequences of protein."""
+    epitopes = loadEpitopes(EPITOPES_PATH)
 
     results = []
-    done = set()
     for patient in patients:
         patient_results = analyzePatient(patients[patient], patient, protein, grouped_hlas, epitopes)
         results += patient_results
 
     results = sorted(results, key = lambda x: (x['pid'], x['pos'], x['hla']))
+    return list(_tableRows(results, protein))
+
+def analyze(hlas, patients, protein):
+    """Returns the result table rows for the patients' sequences of protein."""
+    return analyzeProtein(protein, getPatients(parse(patients), 1), groupedHLAs(hlas))
+
+def analyzeBatchProtein(protein, patients, grouped_hlas):
+    """Translates the patients' (from getBatchPatients) sequences of protein, once, and returns their result table rows."""
+    for patient in patients.values():
+        patient['seq'] = translateDNA(patient.pop('dna'))
+    return analyzeProtein(protein, patients, grouped_hlas)
+
+def analyzeBatch(hlas, patients, workers=None):
+    """Returns the result table rows for a batch (see getBatchPatients), protein by protein.
+    The proteins are translated and analyzed by `workers` processes (default WORKERS), with the same HLA table."""
+    grouped_hlas = groupedHLAs(hlas)
+    batch = getBatchPatients(parse(patients))
+    proteins = [protein for protein in PROTEINS if protein in batch]
+
+    if workers is None:
+        workers = WORKERS
+    if workers == 0:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(proteins))
+    if workers <= 1:
+        tables = [analyzeBatchProtein(protein, batch[protein], grouped_hlas) for protein in proteins]
+    else:
+        # PHAGE runs in the (threaded) mod_wsgi process, which mustn't be forked: a child could inherit a lock
+        # another thread holds. The workers come from a forkserver, and read the epitopes pickled here.
+        loadEpitopes(EPITOPES_PATH)
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(START_METHOD)) as executor:
+            futures = [executor.submit(analyzeBatchProtein, protein, batch[protein], grouped_hlas) for protein in proteins]
+            tables = [future.result() for future in futures]
+    return [row for table in tables for row in table]
+
+def run(hlas, patients, protein, button):
+    # Resubmitting the same alignment and HLA types is common, the rows come from the result cache then.
+    hlas = result_cache.normalize_text(hlas)
+    patients = result_cache.normalize_text(patients)
+    if protein == BATCH:
+        compute = lambda: analyzeBatch(hlas, patients)
+    else:
+        compute = lambda: analyze(hlas, patients, protein)
+    try:
+        # Keyed by the epitopes file's version too, so an edited file isn't hidden by cached rows.
+        rows = result_cache.cached('phage_i_expanded', epitopesVersion(EPITOPES_PATH), [hlas, patients], compute,
+                                   params={'protein': protein})
+    except ValueError as e:
+        return (False, '<b><span style="color:red;">Error:</span></b> {}.'.format(e))
+    table = ResultTable(output_cols, rows)
 
     if button == 'run':
-        return (False, htmlResults(results, protein))
+        return (False, TablePage(htmlResults(), table))
     elif button == 'dl':
-        return (True, tsvResults(results, protein), 'phage_i_expanded_results_{}_{}.tsv'.format(protein.lower(), get_current_datetime()))
\ No newline at end of file
+        return (True, table, 'phage_i_expanded_results_{}_{}'.format(protein.lower(), get_current_datetime()))
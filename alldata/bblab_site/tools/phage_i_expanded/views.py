@@ -1,6 +1,11 @@
 from django.shortcuts import render
 from django.http import HttpResponse
 from django.template import Context, loader, RequestContext, Template
+from ..jobs.views import show_table
+import os, sys
+
+sys.path.append( os.environ.get('BBLAB_UTIL_PATH', 'fail') )
+import result_table
 
 def index(request):
     context = {}
@@ -17,7 +22,15 @@ def results(request):
 
         # Get main inputs.
         hlas = data['hlas_input']
-        patients = data['patients_input']
+        patients = data.get('patients_input', '')
+        if 'patients_file' in request.FILES:
+            # A batch of sequences for every protein is easier to upload than to paste.
+            try:
+                patients = b''.join(request.FILES['patients_file'].chunks()).decode('utf-8')
+            except UnicodeDecodeError:
+                return HttpResponse("The patients file must be a text file (utf-8).")
+        if not patients.strip():
+            return HttpResponse("Please enter or upload the patients' HLAs and sequences.")
 
         protein = data['protein_selection']
 
@@ -30,12 +43,10 @@ def results(request):
         from .scripts import PHAGE
         output_t = PHAGE.run(hlas, patients, protein, button)
         if output_t[0] == False:  # output_t[0] is is_download
-            template = Template(output_t[1])
-            context = RequestContext(request)
-            return HttpResponse(template.render(context))
+            if isinstance(output_t[1], result_table.TablePage):  # The results page and its table, which the page shows a part of at a time.
+                return show_table("phage_i_expanded", output_t[1])
+            return HttpResponse(output_t[1])
         else:
-            response = HttpResponse(output_t[1], content_type="application/octet-stream")
-            response['Content-Disposition'] = 'attachment; filename={}'.format(output_t[2])
-            return response
+            return result_table.response(output_t[1], result_table.requested_format(data, "tsv"), output_t[2])
     else:
         return HttpResponse("Please use the form to submit data.")
\ No newline at end of file
@@ -1,8 +1,9 @@
+import os
 from csv import DictReader
 from argparse import ArgumentParser
 from genetracks import Figure, Track, Multitrack, Label
 from itertools import groupby
-from operator import itemgetter
+from operator import attrgetter, itemgetter
 import drawsvg as draw
 from collections import defaultdict
 from math import ceil
@@ -86,6 +87,9 @@ RIGHT_PRIMER_START = 9604
 GAG_END = 2292
 XOFFSET = 400
 SMALLEST_GAP = 50
+# Above this many samples the plot is drawn in dense mode: neighbouring samples that would be drawn
+# the same are merged into one band, so the SVG grows with the number of patterns, not samples.
+DENSE_SAMPLES = int(os.environ.get('BBLAB_PROVIRAL_DENSE_SAMPLES', '2000'))
 
 # default HXB2 landmarks for the small overview graphic
 # assigned to three frames (0/1/2) so overlapping genes stack vertically
@@ -284,19 +288,6 @@ def add_genome_overview(figure, landmarks, height=12, xoffset=XOFFSET):
     figure.add(_MultiRowDrawer(items, connectors, row_h, gap))
 
 
-def defect_order(defect):
-    defect_type = DEFECT_TYPE[defect]
-    try:
-        order = DEFECT_ORDER[defect_type]
-    except KeyError:
-        max_order = max(DEFECT_ORDER.values())
-        order = max_order + 1
-        DEFECT_ORDER[defect] = order
-        print(f"The order of defect type {defect_type} was not specified -"
-              f" it will just get appended to the end of the plot.")
-    return order
-
-
 class XAxis:
     def __init__(self, h=3):
         self.a = START_POS + XOFFSET
@@ -486,11 +477,14 @@ class LegendAndPercentages:
 
 
 class ProviralLandscapePlot:
-    def __init__(self, figure, tot_samples):
+    def __init__(self, figure, tot_samples, dense=False):
         self.curr_samp_name = ''
         self.defects = set()
         self.figure = figure
-        self.curr_multitrack = []
+        self.curr_multitrack = []  # (xstart, xend, color) of each track in the current sample's line
+        self.dense = dense
+        self.band = None  # tracks of the line(s) not drawn yet
+        self.band_weight = 0  # number of samples in the band
         self.tot_samples = tot_samples
         self.lineheight = 500 / self.tot_samples if self.tot_samples > 0 else 0
         if self.lineheight > 5:
@@ -545,15 +539,30 @@ class ProviralLandscapePlot:
             xstart = START_POS
         if xend > END_POS:
             xend = END_POS
-        track = Track(xstart + XOFFSET, xend + XOFFSET, color=color, h=self.lineheight)
-        return track
+        return (xstart + XOFFSET, xend + XOFFSET, color)
 
     def draw_current_multitrack(self):
-        # draw line and reset multitrack
+        # finish the current sample's line and reset multitrack; in dense mode it joins the band
+        # above it when they look the same
         if self.curr_multitrack:
-            self.figure.add(Multitrack(self.curr_multitrack), gap=1)
+            line = tuple(self.curr_multitrack)
+            if self.dense and line == self.band:
+                self.band_weight += 1
+            else:
+                self.draw_band()
+                self.band = line
+                self.band_weight = 1
         self.curr_multitrack = []
 
+    def draw_band(self):
+        # draw the band as one line as high as its samples' lines and the gaps between them
+        if self.band:
+            h = self.band_weight * self.lineheight + (self.band_weight - 1)
+            tracks = [Track(xstart, xend, color=color, h=h) for xstart, xend, color in self.band]
+            self.figure.add(Multitrack(tracks), gap=1)
+        self.band = None
+        self.band_weight = 0
+
     def add_xaxis(self):
         padding = 20
         gap = 100
@@ -570,109 +579,163 @@ class ProviralLandscapePlot:
                                              force_move_percentages))
 
 
-def sort_csv_lines(lines):
-    lines.sort(key=lambda elem: defect_order(elem['defect'].strip()))
-    for _, defect_rows in groupby(lines, key=lambda elem: DEFECT_TYPE[elem['defect']]):
-        defect_rows = list(defect_rows)
-        defect_rows.sort(key=lambda elem: elem['samp_name'].strip())
-        all_rows_by_sample = []
-        for _, samp_rows in groupby(defect_rows, itemgetter('samp_name')):
-            samp_rows = list(samp_rows)
-            samp_rows.sort(key=lambda elem: int(elem['ref_start'].strip()))
-            if DEFECT_TYPE[samp_rows[0]['defect']] not in ["5' Defect"] + LINE_DEFECTS:
-                # We want to remove 50bp gaps, unless it's a 5'defect. Can also skip line defects
-                for i, row in enumerate(samp_rows):
-                    ref_start = int(row['ref_start'].strip())
-                    ref_end = int(row['ref_end'].strip())
-                    if is_truthy(row['is_inverted']) or is_truthy(row['is_defective']):
-                        continue
-                    if i == 0:
-                        if (ref_start - LEFT_PRIMER_END) < SMALLEST_GAP and ref_end > LEFT_PRIMER_END:
-                            row['ref_start'] = str(LEFT_PRIMER_END)
-                        continue
-                    prev_ref_end = int(samp_rows[i - 1]['ref_end'].strip())
-                    if (ref_start - prev_ref_end) < SMALLEST_GAP and ref_start > prev_ref_end:
-                        row['ref_start'] = samp_rows[i-1]['ref_end']
-                        samp_rows[i - 1]['ref_end'] = row['ref_end']  # this is for sorting purposes
-                prev_ref_start = int(samp_rows[-1]['ref_start'].strip())
-                prev_ref_end = int(samp_rows[-1]['ref_end'].strip())
-                if (RIGHT_PRIMER_START - prev_ref_end) < SMALLEST_GAP and prev_ref_start < RIGHT_PRIMER_START:
-                    samp_rows[-1]['ref_end'] = str(RIGHT_PRIMER_START)
-            all_rows_by_sample.append(samp_rows)
-        all_rows_by_sample.sort(key=sort_defect_rows)
-        all_rows_this_defect = [item for sublist in all_rows_by_sample for item in sublist]
-        yield all_rows_this_defect
-
-
-def sort_defect_rows(samp_list):
-    first_ref_start = int(samp_list[0]['ref_start'].strip())
-    first_ref_end = int(samp_list[0]['ref_end'].strip())
-    if first_ref_start <= LEFT_PRIMER_END:
-        return -first_ref_end
+class Segment:
+    """
+    A row of the proviral landscape csv: the part of HXB2 (start to end) a sample's sequence aligns
+    to, the indexes of its sample and defect type (see read_segments) and its highlights.
+    """
+    __slots__ = ('sample', 'defect', 'start', 'end', 'inverted', 'defective')
+
+    def __init__(self, sample, defect, start, end, inverted=False, defective=False):
+        self.sample = sample
+        self.defect = defect
+        self.start = start
+        self.end = end
+        self.inverted = inverted
+        self.defective = defective
+
+
+def read_segments(input_file):
+    """
+    Reads the rows of the proviral landscape csv into Segments. Returns (sample names, defect types,
+    segments): a segment's sample is an index in the list of sample names, its defect is the order
+    of its defect type in the plot, a key of the defect types dict.
+    """
+    sample_indexes = {}
+    defect_orders = {}  # csv defect: order of its defect type
+    type_orders = {}  # defect type: order
+    segments = []
+    for row in DictReader(input_file):
+        defect = row['defect'].strip()
+        order = defect_orders.get(defect)
+        if order is None:
+            defect_type = DEFECT_TYPE[defect]
+            order = type_orders.get(defect_type, DEFECT_ORDER.get(defect_type))
+            if order is None:
+                order = max(list(DEFECT_ORDER.values()) + list(type_orders.values())) + 1
+                print(f"The order of defect type {defect_type} was not specified -"
+                      f" it will just get appended to the end of the plot.")
+            defect_orders[defect] = type_orders[defect_type] = order
+        sample = sample_indexes.setdefault(row['samp_name'].strip(), len(sample_indexes))
+        segments.append(Segment(sample, order, int(row['ref_start']), int(row['ref_end']),
+                                is_truthy(row['is_inverted']), is_truthy(row['is_defective'])))
+    defect_types = {order: defect_type for defect_type, order in type_orders.items()}
+    return list(sample_indexes), defect_types, segments
+
+
+def close_small_gaps(segs):
+    """
+    Closes the gaps smaller than SMALLEST_GAP between a sample's segments (sorted by start) and
+    next to the primers. The new coordinates only depend on the old ones, they are set at the end.
+    """
+    starts = [seg.start for seg in segs]
+    ends = [seg.end for seg in segs]
+    for i, seg in enumerate(segs):
+        if seg.inverted or seg.defective:
+            continue
+        if i == 0:
+            if seg.start - LEFT_PRIMER_END < SMALLEST_GAP and seg.end > LEFT_PRIMER_END:
+                starts[0] = LEFT_PRIMER_END
+        elif 0 < seg.start - segs[i - 1].end < SMALLEST_GAP:
+            starts[i] = segs[i - 1].end
+            ends[i - 1] = seg.end  # this is for sorting purposes
+    if RIGHT_PRIMER_START - ends[-1] < SMALLEST_GAP and starts[-1] < RIGHT_PRIMER_START:
+        ends[-1] = RIGHT_PRIMER_START
+    for seg, start, end in zip(segs, starts, ends):
+        seg.start = start
+        seg.end = end
+
+
+def sort_csv_lines(segments, defect_types, sample_names):
+    """
+    Sorts the segments once, by defect order, sample name and start, then yields each defect type
+    in plot order with its samples, in sample name order. A sample is a (sort_defect_rows key,
+    segments sorted by start) pair. Gaps under SMALLEST_GAP are closed, except for 5' Defect and
+    line defects.
+    """
+    name_ranks = [0] * len(sample_names)
+    for rank, sample in enumerate(sorted(range(len(sample_names)), key=sample_names.__getitem__)):
+        name_ranks[sample] = rank
+    segments.sort(key=lambda seg: (seg.defect, name_ranks[seg.sample], seg.start))
+    for defect, defect_segments in groupby(segments, key=attrgetter('defect')):
+        defect_type = defect_types[defect]
+        samples = []
+        for _, segs in groupby(defect_segments, key=attrgetter('sample')):
+            segs = list(segs)
+            if defect_type not in ["5' Defect"] + LINE_DEFECTS:
+                close_small_gaps(segs)
+            key = sort_defect_rows(segs)
+            if any(a.start > b.start for a, b in zip(segs, segs[1:])):
+                segs.sort(key=attrgetter('start'))  # the first start can move past the next ones
+            samples.append((key, segs))
+        yield defect_type, samples
+
+
+def sort_defect_rows(segs):
+    first = segs[0]
+    if first.start <= LEFT_PRIMER_END:
+        return -first.end
     else:
         return -LEFT_PRIMER_END
 
 
-def order_samples_by_gaps(rows, threshold=SMALLEST_GAP):
+def order_samples_by_gaps(samples, threshold=SMALLEST_GAP, dense=False):
     """
-    Within a defect category, sort samples by their gaps:
+    Within a defect category, sort samples (from sort_csv_lines) by their gaps:
     1. Identify and record each gap as (start, end, size).
     2. For each sample, sort its gaps by descending size.
     3. Build per-sample lists of (start, end) from those sorted gaps.
     4. Pad shorter lists with (END_POS+1, END_POS+1) to equal length.
     5. Sort samples lexicographically by these flattened (start,end) lists,
        ties on equal starts are broken by earlier ends.
+    In dense mode, ties are broken by the samples' segments, so samples drawn the same end up
+    next to each other (and are merged into one band). Other ties keep the sort_defect_rows order,
+    then the input order. Returns the samples' segment lists.
     """
-    # group rows by sample
-    sample_rows = defaultdict(list)
-    for r in rows:
-        sample_rows[r['samp_name'].strip()].append(r)
     # compute gaps per sample
-    sample_gap_feats = {}
+    sample_gap_feats = []
     max_len = 0
-    for samp, segs in sample_rows.items():
-        segs_sorted = sorted(segs, key=lambda x: int(x['ref_start'].strip()))
+    for _, segs in samples:
         prev_end = START_POS
         feats = []  # list of (start,end,size)
-        for seg in segs_sorted:
-            start = int(seg['ref_start'].strip())
-            if start - prev_end > threshold:
-                size = start - prev_end
-                feats.append((prev_end, start, size))
-            prev_end = max(prev_end, int(seg['ref_end'].strip()))
+        for seg in segs:
+            if seg.start - prev_end > threshold:
+                feats.append((prev_end, seg.start, seg.start - prev_end))
+            prev_end = max(prev_end, seg.end)
         if END_POS - prev_end > threshold:
-            size = END_POS - prev_end
-            feats.append((prev_end, END_POS, size))
-        # sort features by descending size
-        feats_sorted = sorted(feats, key=lambda x: x[2], reverse=True)
-        # extract only (start,end)
-        pos_list = [(s, e) for s, e, _ in feats_sorted]
-        sample_gap_feats[samp] = pos_list
-        max_len = max(max_len, len(pos_list))
-    # pad with out-of-range pairs to equal length
-    pad_pair = (END_POS + 1, END_POS + 1)
-    for samp, pos_list in sample_gap_feats.items():
-        if len(pos_list) < max_len:
-            pos_list.extend([pad_pair] * (max_len - len(pos_list)))
-        sample_gap_feats[samp] = pos_list
-    # final sort: flatten each (start,end) list and compare lex
-    def sample_key(samp):
-        flat = []
-        for start, end in sample_gap_feats[samp]:
-            flat.append(start)
-            flat.append(end)
-        return tuple(flat)
-    sorted_samples = sorted(sample_gap_feats.keys(), key=sample_key)
-    return sorted_samples
-
-
-def create_proviral_plot(input_file, output_svg):
+            feats.append((prev_end, END_POS, END_POS - prev_end))
+        # sort features by descending size, and keep only (start,end)
+        feats.sort(key=itemgetter(2), reverse=True)
+        sample_gap_feats.append([pos for start, end, _ in feats for pos in (start, end)])
+        max_len = max(max_len, len(feats))
+    # final sort, in one pass over precomputed keys: the flattened (start,end) lists padded with
+    # out-of-range pairs to equal length, compared lex
+    pad = (END_POS + 1,) * (2 * max_len)
+    keys = []
+    for (first_key, segs), pos_list in zip(samples, sample_gap_feats):
+        key = tuple(pos_list) + pad[len(pos_list):]
+        if dense:
+            key += tuple((seg.start, seg.end, seg.inverted) for seg in segs)
+        keys.append((key, first_key, segs))
+    keys.sort(key=itemgetter(0, 1))
+    return [segs for _, _, segs in keys]
+
+
+def create_proviral_plot(input_file, output_svg, dense=None):
+    draw_proviral_plot(input_file, dense).save_svg(output_svg)
+
+
+def draw_proviral_plot(input_file, dense=None):
+    """Returns the plot of the proviral landscape csv in input_file, as a drawsvg drawing.
+    dense (merge samples drawn the same into bands) defaults to more than DENSE_SAMPLES samples."""
     # read all rows, set up figure and counters
-    lines = list(DictReader(input_file))
+    sample_names, defect_types, segments = read_segments(input_file)
     # total unique samples (across all defects)
-    total_samples = len(set(r['samp_name'].strip() for r in lines if r['defect'].strip() in DEFECT_TYPE))
+    total_samples = len(sample_names)
+    if dense is None:
+        dense = total_samples > DENSE_SAMPLES
     figure = Figure()
-    plot = ProviralLandscapePlot(figure, total_samples)
+    plot = ProviralLandscapePlot(figure, total_samples, dense)
     # add genome overview at the top of the figure so it appears above sample tracks
     add_genome_overview(figure, LANDMARKS)
     # add a small blank multitrack to create vertical separation between the overview
@@ -686,33 +749,23 @@ def create_proviral_plot(input_file, output_svg):
     defect_counts = defaultdict(int)
     highlighted_set = set()
     # group and plot by defect category, preserving category order
-    for all_rows_this_defect in sort_csv_lines(lines):
-        defect = DEFECT_TYPE[all_rows_this_defect[0]['defect'].strip()]
+    for defect, samples in sort_csv_lines(segments, defect_types, sample_names):
         # within this defect, sort samples by their gap patterns
-        # collect rows for this defect
-        rows = all_rows_this_defect
-        sample_rows = defaultdict(list)
-        for r in rows:
-            sample_rows[r['samp_name'].strip()].append(r)
-        # determine order of samples in this defect
-        sample_order = order_samples_by_gaps(rows)
+        sample_order = order_samples_by_gaps(samples, dense=dense)
         # plot each sample in the defect group
-        for samp in sample_order:
-            segs = sample_rows[samp]
-            segs.sort(key=lambda x: int(x['ref_start'].strip()))
-            for row in segs:
-                xstart = int(row['ref_start'].strip())
-                xend = int(row['ref_end'].strip())
+        for segs in sample_order:
+            samp = sample_names[segs[0].sample]
+            for seg in segs:
                 highlighted = False
-                if is_truthy(row['is_inverted']):
+                if seg.inverted:
                     highlighted_set.add('Inverted Region')
                     highlighted = 'Inverted Region'
-                if is_truthy(row['is_defective']):
+                if seg.defective:
                     # TODO: incorporate this when we get ranges info from proviral.
                     # highlighted_set.add('Defect Region')
                     # highlighted = 'Defect Region'
                     pass
-                plot.add_line(samp, xstart, xend, defect, highlighted)
+                plot.add_line(samp, seg.start, seg.end, defect, highlighted)
         # count samples in this defect for percentages
         defect_counts[defect] += len(sample_order)
 
@@ -742,10 +795,11 @@ def create_proviral_plot(input_file, output_svg):
 
     # finalize plot
     plot.draw_current_multitrack()
+    plot.draw_band()
     plot.add_xaxis()
     plot.legends_and_percentages(defect_percentages, highlighted_set, force_move_percentages=neighbour_flag)
     # display with a standard width so the overview is visible
-    figure.show(w=900).save_svg(output_svg)
+    return figure.show(w=900)
 
 
 def main():
@@ -754,10 +808,12 @@ def main():
                         help="Proviral landscape input file, produced by proviral pipeline")
     parser.add_argument("output_svg",
                         help="Output SVG")
+    parser.add_argument("--dense", action="store_true", default=None,
+                        help=f"Merge samples drawn the same into bands (default above {DENSE_SAMPLES} samples)")
     args = parser.parse_args()
 
     with open(args.proviral_landscape_csv, 'r') as input_file:
-        create_proviral_plot(input_file, args.output_svg)
+        create_proviral_plot(input_file, args.output_svg, args.dense)
 
 
 if __name__ == '__main__':
@@ -13,11 +13,14 @@ from typing import List, Tuple
 import web_output
 import mailer
 import difflib
+import job_queue
+import result_cache
+import svg_output
 
 # Constants
 REQUIRED_COLUMNS = ['samp_name', 'ref_start', 'ref_end', 'defect', 'is_defective', 'is_inverted']
 MAX_INSPECT_ROWS = 2000
-OUTPUT_SVG = '/alldata/bblab_site/media/output.svg'
+CACHE_VERSION = 3  # Change when the plot drawn for the same input changes.
 
 
 # -- Utility helpers -------------------------------------------------------
@@ -354,10 +357,14 @@ def run(csv_data, analysis_id, email_address_string):
         website.send(f"<pre style='background:#fff;padding:8px;border:1px solid #eee;'>{html.escape(traceback.format_exc())}</pre>")
         return website.generate_site()
 
-    # Generate plot
+    # Generate plot, or take it from the result cache when the same CSV was plotted before
     try:
-        input_stream = io.StringIO(csv_text)
-        plot_mod.create_proviral_plot(input_stream, OUTPUT_SVG)
+        csv_text = result_cache.normalize_text(csv_text)
+        svg_content = result_cache.cached(
+            'proviral_landscape_plot', CACHE_VERSION, csv_text,
+            lambda: svg_output.compact_styles(plot_mod.draw_proviral_plot(io.StringIO(csv_text))).as_svg(),
+        )
+        svg_url = job_queue.save_output('proviral_landscape_plot', svg_content, 'svg', svg_output.gzip_bytes(svg_content))
     except Exception as exc:
         website.send("<h2 style='color:#a94442'>Plot generation failed</h2>")
         website.send(
@@ -367,11 +374,11 @@ def run(csv_data, analysis_id, email_address_string):
         return website.generate_site()
 
     # Show SVG output
-    website.send("<img width='100%' src='/media/output.svg' alt='Output svg' />")
+    website.send(f"<img width='100%' src='{svg_url}' alt='Output svg' />")
     # Add a centered, prominent download button so non-technical users can easily save the image
     website.send(
         "<div style='text-align:center;margin:16px 0;'>"
-        "<a href='/media/output.svg' download='proviral_landscape.svg' "
+        f"<a href='{svg_url}' download='proviral_landscape.svg' "
         "style='display:inline-block;background:#31708f;color:#fff;padding:10px 18px;border-radius:6px;text-decoration:none;font-weight:600;box-shadow:0 4px 10px rgba(0,0,0,0.12);'>"
         "Download"
         "</a>"
@@ -392,7 +399,6 @@ def run(csv_data, analysis_id, email_address_string):
 
     # Attach and send email
     try:
-        svg_content = Path(OUTPUT_SVG).read_text(encoding='utf8')
         plot_file = mailer.create_file(short_description, 'svg', svg_content)
         if mailer.send_sfu_email("proviral_landscape_plot", email_address_string, subject_line, msg_body, [plot_file]) == 0:
             website.send(("An email has been sent to <b>{}</b> with your image." "<br>Make sure <b>{}</b> is spelled correctly.").format(email_address_string, email_address_string))
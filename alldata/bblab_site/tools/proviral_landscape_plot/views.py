@@ -2,7 +2,8 @@ from django.shortcuts import render
 from django.http import HttpResponse
 from django.template import Context, loader, RequestContext, Template
 from django.contrib.auth.decorators import login_required
-from io import StringIO
+
+from ..jobs.views import submit
 
 
 def index(request):
@@ -19,18 +20,14 @@ def results(request):
         # Process data a bit
         data = request.POST
 
-        # Read file
-        csv_data = StringIO(request.FILES['file'].read().decode("utf-8"))
+        # The uploaded file is saved with the job and read by the worker.
+        csv_data = request.FILES['file']
 
         email_address = data['emailAddress']
         desc = data['analysisID']
 
-        # Run actual calulation (by passing data)
+        # Queue the calculation, the job page shows its output when it's done.
         from . import run_proviral_landscape
-        output_t = run_proviral_landscape.run(csv_data, desc, email_address)
-        template = Template(output_t)
-
-        context = RequestContext(request)
-        return HttpResponse(template.render(context))
+        return submit(run_proviral_landscape.run, csv_data, desc, email_address)
     else:
         return HttpResponse("Please use the form to submit data.")
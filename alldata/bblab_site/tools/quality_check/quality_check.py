@@ -2,17 +2,12 @@
 
 import sys, re, os
 
-sys.path.append( os.environ.get('BBLAB_LIB_PATH', 'fail') )
-from openpyxl import Workbook
-import openpyxl
-from openpyxl.styles import colors
-from openpyxl.styles import Font, Color
-
 sys.path.append( os.environ.get('BBLAB_UTIL_PATH', 'fail') )
 import sequence_utils
 import format_utils
 import mailer
 import web_output
+import xlsx_export
 from web_output import clean_html
 
 def run(fasta_data, desc_string, email_address_string, div3, start, stop, internal, mixture, quick):  # Make fasta_data be pre-processed.
@@ -29,9 +24,6 @@ def run(fasta_data, desc_string, email_address_string, div3, start, stop, intern
                 website.send_error("Input field is empty,", " cannot run analysis")
                 return website.generate_site()
 
-        # Read the file's text.
-        input_field_text = [e+'\n' for e in str( fasta_data ).replace('\r', '\n').replace('\n\n', '\n').split('\n') if e]
-
         # Add the parameters to a list.
         flag_list = []  
         flag_list.append( div3 )
@@ -41,18 +33,12 @@ def run(fasta_data, desc_string, email_address_string, div3, start, stop, intern
         flag_list.append( mixture )
 
         try:
-                # Convert file to a list of tuples.
-                fasta_list = sequence_utils.convert_fasta( input_field_text )
+                # Read the text or uploaded file into a list of tuples, with the dna sequences converted to uppercase.
+                fasta_list = [ (header, sequence.upper()) for header, sequence in sequence_utils.iter_fasta( fasta_data ) ]
         except Exception:
                 website.send_error("Failed to read fasta data,", " is something formatted wrong?")
                 return website.generate_site()
 
-        # Convert the dna sequences to uppercase.
-        index = 0
-        for tuple in fasta_list:
-                fasta_list[index] = (tuple[0], tuple[1].upper())
-                index += 1
-
 
         ##### Run tests on the given sequences and save the results in matrix. 
 
@@ -174,14 +160,12 @@ def run(fasta_data, desc_string, email_address_string, div3, start, stop, intern
 
         XLSX_FILENAME = "_".join(s for s in ["quality_check_data", analysis_id] if s)
 
-        wb = Workbook()  # Create a new workbook.
-        ws = wb.active  # Create a new page. (worksheet [ws])
-        ws.title = "Data"  # Page title
+        xlsx = xlsx_export.XlsxExport()  # Create a new workbook.
 
-        # Create the title row information.
+        # Create a new page with the title row information.
         first_three_tests = ([] if flag_list[0] == 0 else ["Divisible by 3"]) + ([] if flag_list[1] == 0 else ["Has Start Codon"]) + ([] if flag_list[2] == 0 else ["Has End Codon"]) 
         tests = first_three_tests + ([] if flag_list[3] == 0 else ["No Internal Codons"]) + ([] if flag_list[4] == 0 else ["Contains No Mixtures"])
-        ws.append( ["Sequence ID", "Sequence", "Sequence Length"] + tests + ["% Mixtures"] )
+        ws = xlsx.add_sheet( "Data", ["Sequence ID", "Sequence", "Sequence Length"] + tests + ["% Mixtures"] )
 
         # Create data row information.
         for dict in results_matrix:
@@ -198,17 +182,13 @@ def run(fasta_data, desc_string, email_address_string, div3, start, stop, intern
                 
                 percent_mixture = [ str(dict['mixture_percent']) + " %" ]
                 
-                ws.append( [sequence_id, dna_sequence, sequence_length] + div3 + start + stop + internal + mixture + percent_mixture )
-
-        # Add colour to fails.
-        for row in ws.iter_rows():
-                for cell in row:
-                        if str(cell.value)[:4] == "FAIL" and cell.column != 'A':
-                                cell.font = Font(color=colors.RED)
+                # Add colour to fails (except in the ID column) as the row is written.
+                row = [sequence_id, dna_sequence, sequence_length] + div3 + start + stop + internal + mixture + percent_mixture
+                ws.append( row, xlsx_export.fail_fonts(row) )
 
-        # Save a string version of the excel workbook and send it to the file builder.
-        file_text = openpyxl.writer.excel.save_virtual_workbook(wb)
-        xlsx_file = mailer.create_file( XLSX_FILENAME, 'xlsx', file_text )
+        # Stream the workbook to a temporary file and send it to the file builder.
+        xlsx_file = xlsx.attachment( XLSX_FILENAME )
+        xlsx.close()
 
 	
 	##### Print error messages that go under quick results.
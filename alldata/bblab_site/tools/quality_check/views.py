@@ -3,6 +3,8 @@ from django.http import HttpResponse
 from django.template import Context, loader, RequestContext, Template
 from django.contrib.auth.decorators import login_required
 
+from ..jobs.views import submit
+
 def index(request):
     context = {}
     if request.user.is_authenticated:
@@ -16,14 +18,11 @@ def results(request):
         # Process data a bit
         data = request.POST
 
-        # Read file in chunks if it exists.
+        # The uploaded file is handed over as is, it's saved with the job and read in chunks while parsing.
         if 'file' in data:
             fasta_data = data['fastaInputArea']
         else:
-            fasta_data = b''  # This is a bytestring
-            for chunk in request.FILES['file'].chunks():
-                fasta_data += chunk
-            fasta_data = fasta_data.decode("utf-8")
+            fasta_data = request.FILES['file']
 
         email_address = data['emailAddress']
         desc = data['analysisID']
@@ -35,12 +34,8 @@ def results(request):
         mixture = (1 if "mixture" in data else 0)
         quick = (1 if "quick" in data else 0)
 
-        # Run actual calulation (by passing data)
+        # Queue the calculation, the job page shows its output when it's done.
         from . import quality_check
-        output_t = quality_check.run(fasta_data, desc, email_address, div3, start, stop, internal, mixture, quick)
-        template = Template(output_t)
-
-        context = RequestContext(request)
-        return HttpResponse(template.render(context))
+        return submit(quality_check.run, fasta_data, desc, email_address, div3, start, stop, internal, mixture, quick)
     else:
         return HttpResponse("Please use the form to submit data.")
@@ -1,10 +1,13 @@
 # Checked for Python3.7
 
 import re, sys, os
-from django.http import HttpResponse
 
 sys.path.append( os.environ.get('BBLAB_UTIL_PATH', 'fail') ) 
 import math_utils 
+from result_table import ResultTable
+import result_cache
+
+CACHE_VERSION = 1  # Change when the q-values computed for the same input change.
 
 def run(pvalue_string):
 	##### Make sure data is acceptable (validate input) and process data.
@@ -34,36 +37,20 @@ def run(pvalue_string):
 	sys.path.append( os.environ.get('BBLAB_OP_PATH', 'fail') )  # Add the path to this tool's operations module.
 	import op_qvalue
 	
-	qvalues = op_qvalue.get_qvalues( pvalue_list )
-	
-	
-	##### Create an excel file to hold qvalue data
-	
+	# Identical p-value lists are common (resubmissions), their q-values come from the result cache.
+	qvalues = result_cache.cached( "qvalue", CACHE_VERSION, pvalue_list, lambda: op_qvalue.get_qvalues( pvalue_list ),
+		params={"engine": op_qvalue.QVALUE_ENGINE} )
 	
-	sys.path.append( os.environ.get('BBLAB_LIB_PATH', 'fail') )  # Add the path to openpyxl, (excel files.)
-	from openpyxl import Workbook
-	import openpyxl
 	
-	XLSX_FILENAME = "q-values"
+	##### Create a table to hold qvalue data, the view sends it to the browser as an excel file (or the requested format).
 	
-	wb = Workbook()
-	ws = wb.active
-	ws.title = "Data"
 	
-	ws.append( ["p-values", "q-values"] )
+	table = ResultTable( ["p-values", "q-values"] )
 	
 	for i in range(len(qvalues)):
-		ws.append( [pvalue_list[i], qvalues[i]] )
-	
-	file_text = openpyxl.writer.excel.save_virtual_workbook(wb)
-	
-	
-	##### Push file to the browser.
-
+		table.append( [pvalue_list[i], qvalues[i]] )
 	
-	response = HttpResponse(file_text, content_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
-	response['Content-Disposition'] = 'inline; filename={}.xlsx'.format(XLSX_FILENAME)
-	return (True, response)
+	return (True, table, "q-values")
 
 	# I am so proud of this garbage but I don't need it anymore so I'm saving it.
 	'''
@@ -1,6 +1,10 @@
 from django.shortcuts import render
 from django.http import HttpResponse
 from django.template import Context, loader, RequestContext, Template
+import os, sys
+
+sys.path.append( os.environ.get('BBLAB_UTIL_PATH', 'fail') )
+import result_table
 from django.contrib.auth.decorators import login_required
 
 def index(request):
@@ -23,10 +27,8 @@ def results(request):
         from . import qvalue_generate_file
         output_t = qvalue_generate_file.run(pvalue_string)
         if output_t[0] == False:	
-                template = Template(output_t[1])
-                context = RequestContext(request)
-                return HttpResponse(template.render(context))
+                return HttpResponse(output_t[1])
         else:
-                return output_t[1]
+                return result_table.response(output_t[1], result_table.requested_format(data, "xlsx"), output_t[2])
     else:
         return HttpResponse("Please use the form to submit data.")
@@ -31,7 +31,7 @@ def run(input_string, username, plate_id, email_address_string, machine):
 
 	if input_string.find('+') == -1:
 		website.send_error( "Could not find any '+' characters,", " did you format your input correctly?" )
-		return website.generate_site()
+		return website.response()
 
 	input_list = input_string.strip('\n').split('\n')
 	#input_list.pop()  # This is an evil line I thought i already fixed this bug... 
@@ -98,7 +98,7 @@ def run(input_string, username, plate_id, email_address_string, machine):
 			website.send_error("{} could not be added to the archive,".format(plt_filename), " a file already exists with the same name.")
 	else:
 		website.send_error("Improper Filename,", " make sure your filename does not include any invalid characters.")
-		return website.generate_site()
+		return website.response()
 
 	
 	##### Create .html file
@@ -147,7 +147,7 @@ def run(input_string, username, plate_id, email_address_string, machine):
 
 	else:
 		website.send_error("Improper Filename,", " make sure your filename does not include any invalid characters.")
-		return website.generate_site()
+		return website.response()
 
 	
 	##### Give user a link to the file directory.  ( Before the email )
@@ -189,5 +189,5 @@ def run(input_string, username, plate_id, email_address_string, machine):
 	print_string = filesys_utils.archive_in_dir(OUT_PATH, archive_path, 30)  # Archive files in OUT_PATH, older than 30 days. 
 	website.send( print_string + "<br>" )	
 	
-	return website.generate_site()  # This returns the website string.
+	return website.response()  # This returns the website as an HttpResponse.
 		
@@ -31,10 +31,7 @@ def generate_files(request):
 		# Run actual calculatiuon
 		from . import sequencing_generate_files
 		output_t = sequencing_generate_files.run(input_str, username, plate_id, email_address, machine)
-		template = Template(output_t)
-
-		context = RequestContext(request)	
-		return HttpResponse(template.render(context))
+		return output_t  # The Site's HttpResponse.
 	else:
 		return HttpResponse("Please use the form to submit data.")
 
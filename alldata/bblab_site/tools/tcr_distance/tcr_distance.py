@@ -1,10 +1,11 @@
 # Checked for Python 3.7
 
-import sys, re, os, time, subprocess, shlex, shutil
+import sys, re, os, time, subprocess, shlex, shutil, zipfile
 
 sys.path.append( os.environ.get('BBLAB_UTIL_PATH', 'fail') )
 import format_utils
 import mailer
+import pipeline_supervisor
 
 # todo: fix this path -> turn it into an env var
 tcr_dist_path = os.environ.get('BBLAB_UTIL_PATH', 'fail') + "../apps/tcr-dist"
@@ -12,6 +13,7 @@ this_file_path = os.path.dirname(os.path.realpath(__file__))
 tmp_dirs_path = this_file_path + "/tmp_dirs"
 
 g_TIMEOUT = 600 * 3  # 30 mins
+MATRIX_FILES = ["clones__A.dist", "clones__B.dist", "clones__AB.dist"]
 
 
 def create_random_directory():
@@ -36,7 +38,7 @@ def terminate(dir_num):
         assert (shutil.rmtree.avoids_symlink_attacks == True), "version needs to protect against symlink attacks"
         shutil.rmtree( "{}/tmp_{}".format(tmp_dirs_path, dir_num) )
 
-# this function removes all files except for matrices.zip and status
+# this function removes all files except for matrices.zip
 def clear_dir(dir_num):
     #file = open("{}/status".format(wd), "a")
     #file.write("clearing directory! #{}".format(dir_num) + str("\n"))	   
@@ -71,8 +73,28 @@ def remove_bad_dirs():
             # remove directory given that it should be destroyed or is empty and more than 1 minute old or more than 4 days old.
             assert (shutil.rmtree.avoids_symlink_attacks == True), "version needs to protect against symlink attacks"
             shutil.rmtree(dir_path)
-
-def run(input_kind, filtered_contig_annotations, consensus_annotations, clones_file, dir_num, organism, send_email, email_address, download_file, forward_to_visualizer):
+            if name.startswith("tmp_"):
+                pipeline_supervisor.Registry().delete_run(name[len("tmp_"):])
+
+# This function writes the matrix files that exist in wd to matrices.zip. Each file is copied into the
+# archive in chunks, so the matrices are never held in memory, and the archive only appears once complete.
+def write_matrices_zip(wd):
+        part_path = "{}/matrices.zip.part".format(wd)
+        found = 0
+        with zipfile.ZipFile(part_path, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+                for name in MATRIX_FILES:
+                        if not os.path.exists("{}/{}".format(wd, name)):
+                                continue
+                        with open("{}/{}".format(wd, name), "rb") as source, archive.open(name, "w", force_zip64=True) as target:
+                                shutil.copyfileobj(source, target, 1024 * 1024)
+                        found += 1
+
+        if found == 0:
+                os.remove(part_path)
+                raise FileNotFoundError("no matrix files were generated")
+        os.replace(part_path, "{}/matrices.zip".format(wd))
+
+def run(input_kind, dir_num, organism, send_email, email_address, download_file, forward_to_visualizer):
 
  
         ##### Check if directory exists.	
@@ -85,27 +107,22 @@ def run(input_kind, filtered_contig_annotations, consensus_annotations, clones_f
         wd = tmp_dirs_path + "/" + tmpdir # wd --> working directory
 
 
-        ##### Convert annotations files into clones file (using tcr dist)
-        
-        def append_status_file(val):
-                file = open("{}/status".format(wd), "a")
-                file.write(str(val) + str("\n"))	   
-                file.close()
+        ##### The input files were written to the working directory by the view, the status messages go to the pipeline registry.
 
-        if input_kind == "10x":                
-                append_status_file("starting 10x")
- 
-                # write input files to tmpdir 
-                file = open("{}/filtered_contig_annotations.tsv".format(wd), "w")
-                file.write(filtered_contig_annotations)
-                file.close()
+        registry = pipeline_supervisor.Registry()
+
+        def append_status(val):
+                registry.add_event(dir_num, val)
 
-                file = open("{}/consensus_annotations.tsv".format(wd), "w")
-                file.write(consensus_annotations)
-                file.close()
+        def finish(state):
+                registry.finish_run(dir_num, state)
 
-                append_status_file("10x files written")
+        stages = []
+        if input_kind == "10x":                
+                append_status("starting 10x")
+                append_status("10x files written")
 
+                # Convert annotations files into clones file (using tcr dist)
                 command = [
                         "python2",
                         "{}/make_10x_clones_file.py".format(tcr_dist_path),
@@ -114,152 +131,50 @@ def run(input_kind, filtered_contig_annotations, consensus_annotations, clones_f
                         "-o", "{}/clones_file".format(wd),
                         "--organism", organism
                 ]
-
-                append_status_file("starting 10x conversion")
-                process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-      
-                # This loop allows for the process to be terminated 
-                process_done = False
-                time_waited = 0
-                while not process_done:
-                        try: 
-                                process.wait(1)  # give the process some time to complete.
-                                process_done = True
-                        except subprocess.TimeoutExpired as e:
-                                time_waited += 1
-                                if os.path.exists( tmpdir + "/terminate" ):
-                                        process.terminate()
-                                        append_status_file("took {} seconds".format(time_waited))
-                                        append_status_file( "10x conversion terminated" )
-                                        append_status_file( "done" )
-                                        remove_bad_dirs()
-                                        return
-                                elif time_waited > g_TIMEOUT:
-                                        process.terminate()
-                                        append_status_file("took {} seconds".format(time_waited))
-                                        append_status_file( "10x conversion timed out" )
-                                        append_status_file( "done" )
-                                        remove_bad_dirs()
-                                        with open("{}/terminate".format(wd), "w") as f:
-                                                f.write("terminate")
-                                        return
- 
-                append_status_file("took {} seconds".format(time_waited))
-                append_status_file("done 10x conversion")
-                process.terminate()  # just in case
+                stages.append( pipeline_supervisor.Stage("10x", command, description="10x conversion") )
 
         elif input_kind == "clones_file":
-                append_status_file("starting clones_file")
+                append_status("starting clones_file")
+                append_status("clones_file written")
 
-                # write input files to tmpdir 
-                file = open("{}/clones_file".format(wd), "w")
-                file.write(clones_file)
-                file.close()
 
-                append_status_file("clones_file written")
+        ##### Convert clones file into matrix files (also using tcr dist), then compress the 3 matrix files (in-process)
 
 
-        ##### Convert clones file into matrix files (also using tcr dist)
-        
-        
         command = [
                 "python2",
                 "{}/compute_distances.py".format(tcr_dist_path),
                 "--clones_file", "{}/clones_file".format(wd),
                 "--organism", organism
         ]
+        stages.append( pipeline_supervisor.Stage("distances", command, after=[stage.name for stage in stages], description="distance computation") )
 
-        append_status_file("starting distance computation");
-        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-
-        # This loop allows for the process to be terminated 
-        process_done = False
-        time_waited = 0
-        while not process_done:
-                try: 
-                        process.wait(1)  # give the process some time to complete.
-                        process_done = True
-                except subprocess.TimeoutExpired as e:
-                        time_waited += 1
-                        if os.path.exists( tmpdir + "/terminate" ):
-                                process.terminate()
-                                append_status_file("took {} seconds".format(time_waited))
-                                append_status_file( "distance computation terminated" )
-                                append_status_file( "done" )
-                                remove_bad_dirs()
-                                return
-                        elif time_waited > g_TIMEOUT:
-                                process.terminate()
-                                append_status_file("took {} seconds".format(time_waited))
-                                append_status_file( "distance computation timed out" )
-                                append_status_file( "done" )
-                                remove_bad_dirs()
-                                with open("{}/terminate".format(wd), "w") as f:
-                                        f.write("terminate")
-                                return
-
-                        # TODO: do the errors before appending the error message so error check only has to check last line.
-                        #website.send("Error Message: {}".format( str(e) ))
-                        #stdout, stderr = process.communicate()
-                        #website.send("Other errors: {}".format( stderr ))
- 
-        append_status_file("took {} seconds".format(time_waited))
-        append_status_file("done distance computation")
-        process.terminate()  # just in case
-
+        stages.append( pipeline_supervisor.Stage("zip", function=lambda: write_matrices_zip(wd), after=["distances"], description="compression") )
 
-        ##### Compress 3 matrix files
-       
+        # The supervisor runs the stages in order, a cancelled run (views.terminate) stops right away.
+        state = pipeline_supervisor.Supervisor(registry, dir_num, stages, g_TIMEOUT).run()
 
-        append_status_file("compressing files")
+        if state == pipeline_supervisor.CANCELLED:
+                append_status( "done" )
+                remove_bad_dirs()
+                return
+        elif state == pipeline_supervisor.TIMED_OUT:
+                append_status( "done" )
+                finish(state)
+                remove_bad_dirs()
+                with open("{}/terminate".format(wd), "w") as f:
+                        f.write("terminate")
+                return
 
-        command = [
-                "zip", "matrices.zip",
-                "clones__A.dist", "clones__B.dist", "clones__AB.dist"
-        ]
-        process = subprocess.Popen(command, cwd=wd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        
-        # This loop allows for the process to be terminated 
-        process_done = False
-        time_waited = 0
-        while not process_done:
-                try: 
-                        process.wait(1)  # give the process some time to complete.
-                        process_done = True
-                except subprocess.TimeoutExpired as e:
-                        time_waited += 1
-                        if os.path.exists( tmpdir + "/terminate" ):
-                                process.terminate()
-                                append_status_file("took {} seconds".format(time_waited))
-                                append_status_file( "compressing terminated" )
-                                append_status_file( "done" )
-                                remove_bad_dirs()
-                                return
-                        elif time_waited > g_TIMEOUT:
-                                process.terminate()
-                                append_status_file("took {} seconds".format(time_waited))
-                                append_status_file( "compressing timed out" )
-                                append_status_file( "done" )
-                                remove_bad_dirs()
-                                with open("{}/terminate".format(wd), "w") as f:
-                                        f.write("terminate")
-                                return
-                        #website.send("Error Message: {}".format( str(e) ))
-                        #stdout, stderr = process.communicate()
-                        #website.send("Other errors: {}".format( stderr ))
- 
-        append_status_file("took {} seconds".format(time_waited))
-        append_status_file("done compression")
-        process.terminate()  # just in case
 
-         
         ##### Very hacky check for any errors
 
        
         # If the output file doesn't exist, then destroy the current directory 
         if not os.path.exists("{}/matrices.zip".format(wd)):
-                append_status_file("pipeline failed (output file was not generated). Make sure your input was correct.")
-                append_status_file("done")
+                append_status("pipeline failed (output file was not generated). Make sure your input was correct.")
+                append_status("done")
+                finish(pipeline_supervisor.FAILED)
                 time.sleep(5)
                 terminate(dir_num)
                 return
@@ -290,10 +205,10 @@ def run(input_kind, filtered_contig_annotations, consensus_annotations, clones_f
                         pass
 
                 if not download_file:
-                        append_status_file("no download") # in the case that only the email is sent, the directory is still terminated.
+                        append_status("no download") # in the case that only the email is sent, the directory is still terminated.
                         # can we also destroy everything during this step? 
         elif not download_file: # default to downloading the file
-                append_status_file("request download")
+                append_status("request download")
                 #clear_dir(dir_num)
         
         
@@ -301,10 +216,11 @@ def run(input_kind, filtered_contig_annotations, consensus_annotations, clones_f
 
 
         if download_file: 
-                append_status_file("request download")
+                append_status("request download")
                 #clear_dir(dir_num)
          
         # This is only temporarily disabled       
         clear_dir(dir_num) # the idea here is that the directory is cleared when everything is done, but the zip is still there
+        finish(state)
 
         return
@@ -1,10 +1,19 @@
-import os, json, datetime
+import os, sys, json, datetime
 
 from django.shortcuts import render
 from django.http import HttpResponse
 from django.template import Context, loader, RequestContext, Template
 from django.contrib.auth.decorators import login_required
 
+from ..jobs.views import submit
+
+sys.path.append(os.environ.get('BBLAB_UTIL_PATH', 'fail'))
+import pipeline_supervisor
+import django_utils
+
+STATUS_WAIT = 20  # Seconds a status request waits for new messages. It holds a mod_wsgi thread meanwhile,
+                  # asleep until the pipeline writes a message (no database polling), shorter waits mean more requests.
+
 # NOTE: If anyone ever has to update this tool, in hindsight, the structure of it
 # feels really confusing, but effectively what it does is uses ajax to communicate between 
 # the js portion to give users continuous updates, then this file which manages creating 
@@ -39,36 +48,20 @@ def start_tcr_pipeline(request):
         # Process data a bit
         data = request.POST
 
-        # Read the input files in chunks if they exist. Favour clones_file above others.
-        clones_file, filtered_contig_annotations, consensus_annotations = b'', b'', b''
+        # Favour clones_file above others.
         if 'filecf' in request.FILES:
             input_kind = "clones_file"
-            if request.FILES['filecf'].size > 500000000:
-                return HttpResponse("file too big")
-
-            for chunk in request.FILES['filecf'].chunks():
-                clones_file += chunk
-
-            clones_file = clones_file.decode("utf-8")
+            uploads = { "clones_file" : request.FILES['filecf'] }
         elif 'filef' in request.FILES and 'filec' in request.FILES:
             input_kind = "10x"
-            if request.FILES['filef'].size > 500000000 or request.FILES['filec'].size > 500000000:
-                return HttpResponse("file too big")
-                
-            for chunk in request.FILES['filef'].chunks():
-                filtered_contig_annotations += chunk
-            
-            for chunk in request.FILES['filec'].chunks():
-                consensus_annotations += chunk
-          
-            filtered_contig_annotations = filtered_contig_annotations.decode("utf-8")
-            consensus_annotations = consensus_annotations.decode("utf-8")
+            uploads = { "filtered_contig_annotations.tsv" : request.FILES['filef'],
+                        "consensus_annotations.tsv" : request.FILES['filec'] }
         else:
             return HttpResponse("need files")
 
-        if input_kind == "10x" and filtered_contig_annotations == "" or consensus_annotations == "":
-            return HttpResponse("file empty")
-        elif input_kind == "clones_file" and clones_file == "":
+        if any(upload.size > 500000000 for upload in uploads.values()):
+            return HttpResponse("file too big")
+        if any(upload.size == 0 for upload in uploads.values()):
             return HttpResponse("file empty")
 
         if not "organism" in data:
@@ -76,10 +69,14 @@ def start_tcr_pipeline(request):
         organism = ("human" if (data["organism"] == "human") else "mouse")
 
         # check if the directory number is okay
+        from . import tcr_distance
         try:
             dir_num = int(data["dirNum"])
         except ValueError:
-            return HttpReponse("bad dirNum")
+            return HttpResponse("bad dirNum")
+        wd = "{}/tmp_{}".format(tcr_distance.tmp_dirs_path, dir_num) # wd --> working directory
+        if not os.path.isdir(wd):
+            return HttpResponse("bad dirNum")
 	
         # Get options
         import re
@@ -92,45 +89,58 @@ def start_tcr_pipeline(request):
         download_file = (1 if "download" in data else 0)
         forward_to_visualizer = (1 if "visualizer" in data else 0)
 
-        # Run actual calulation (by passing data)
-        import threading
-        from . import tcr_distance
-        thread = threading.Thread(target=tcr_distance.run, args=(input_kind, filtered_contig_annotations, consensus_annotations, clones_file,
-                                     dir_num, organism, send_email, email_address, download_file, forward_to_visualizer))
-        thread.daemon = True
-        thread.start() # This runs pipeline in the background 
+        # Write the input files straight to the working directory in chunks, the pipeline reads them from there.
+        try:
+            for name, upload in uploads.items():
+                django_utils.save_upload(upload, "{}/{}".format(wd, name))
+        except UnicodeDecodeError:
+            return HttpResponse("file not utf-8")
+
+        # Run actual calulation (on the written input files)
+        # The pipeline runs in a job queue worker, the page follows it through get_status.
+        submit(tcr_distance.run, input_kind, dir_num, organism, send_email, email_address, download_file, forward_to_visualizer)
 
         return HttpResponse("started pipeline")
     else:
         return HttpResponse("use form")
 
-# reads from a special file called 'status'
+# Long-poll for the status messages of a pipeline run (after sequence number 'since').
+# Answers as soon as there are new messages, or with none after a while so the page asks again.
 def get_status(request):
     if request.method == 'GET':
         dirNum = request.GET["dirNum"]
-        
+        try:
+            since = int(request.GET.get("since", 0))
+        except ValueError:
+            since = 0
+
         tmp_dirs_path = os.path.dirname(os.path.realpath(__file__)) + "/tmp_dirs"
-        status_file_path = "{}/tmp_{}/status".format(tmp_dirs_path, dirNum)
-        if not os.path.exists(status_file_path):
-            return HttpResponse("requested status doesn't exist")
+        if not os.path.exists("{}/tmp_{}".format(tmp_dirs_path, dirNum)):
+            return HttpResponse( json.dumps({"state" : "missing"}), content_type="application/json" )
 
-        with open(status_file_path, "r") as file:
-            file_text = file.read()
-        
-        if file_text.split("\n")[-2] == "request download":
-            return HttpResponse("request download") 
-        elif file_text.split("\n")[-2] == "no download":
+        registry = pipeline_supervisor.Registry()
+        events = registry.wait_for_events(dirNum, since, timeout=STATUS_WAIT)
+        messages = [message for seq, message in events]
+        if "no download" in messages:
             terminate_directory(dirNum) # writes terminate file
-            return HttpResponse("no download")
-        
-        return HttpResponse(file_text) 
+
+        run = registry.get_run(dirNum)
+        response_data = {
+            "since" : events[-1][0] if events else since,
+            "messages" : messages,
+            "state" : run["state"] if run is not None else "queued",
+        }
+        return HttpResponse( json.dumps(response_data), content_type="application/json" )
     else:
         return HttpResponse("not allowed")
 
+# Streams matrices.zip in chunks. Accepts GET so browsers can resume the download with Range requests,
+# the directory is only marked for removal once the whole file has been sent.
 def download_file(request):
-    if request.method == "POST":
-        if "dirNum" in request.POST:
-            dirNum = request.POST["dirNum"]
+    if request.method in ("GET", "POST"):
+        data = request.POST if request.method == "POST" else request.GET
+        if "dirNum" in data:
+            dirNum = data["dirNum"]
         else:
             return HttpResponse("no dir")
 
@@ -138,21 +148,16 @@ def download_file(request):
         if not (os.path.exists(file_path) and os.path.isfile(file_path)):
             return HttpResponse("no file" + str(dirNum))
 
-        with open(file_path, "rb") as file:
-            file_dat = file.read()
-    
         from . import tcr_distance
         tcr_distance.remove_bad_dirs()
-     
-        terminate_directory(dirNum) # tell self to be destroyed on the next check -> there should only ever be 1 left over.
- 
-        response = HttpResponse(file_dat, content_type="application/zip")
-        response['Content-Disposition'] = "inline; filename=matrices.zip"
-        return response
+
+        # tell self to be destroyed on the next check -> there should only ever be 1 left over.
+        return django_utils.file_response(request, file_path, "application/zip", "matrices.zip",
+                                          on_complete=lambda: terminate_directory(dirNum))
     else:
         return HttpResponse("not allowed")
 
-# writes 'terminate' to a special file called 'terminate'
+# cancels the pipeline run and writes 'terminate' to a special file called 'terminate'
 def terminate(request):
     if request.method == 'POST':
         from . import tcr_distance
@@ -160,6 +165,7 @@ def terminate(request):
      
         dir_num = request.POST["dirNum"]
         if terminate_directory(dir_num) == True:
+            pipeline_supervisor.Registry().cancel(dir_num) # stops the running stage right away
             return HttpResponse("success")
         else:
             return HttpResponse("no dir") 
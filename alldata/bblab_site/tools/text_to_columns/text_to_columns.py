@@ -4,6 +4,10 @@ import cgi, re, sys, os
 import collections
 #import pickle as cp
 
+sys.path.append( os.environ.get('BBLAB_UTIL_PATH', 'fail') )
+from web_output import static_url
+from result_table import ResultTable, TablePage, viewer_html
+
 
 def run(userinput, button):
     
@@ -16,10 +20,10 @@ def run(userinput, button):
 
 
 	def printHtmlHeaders():
-		return '''{% load static %}<!DOCTYPE html><html><head> <title>Text to Columns - Results</title>
+		return '''<!DOCTYPE html><html><head> <title>Text to Columns - Results</title>
 			  <script src="//ajax.googleapis.com/ajax/libs/jquery/1.11.1/jquery.min.js"></script>
-			  <script src="{% static "ttc_script.js" %}"></script>
-			  <link rel="stylesheet" href="{% static "ttc_css/style.css" %}"></head><body>'''
+			  <script src="{}"></script>
+			  <link rel="stylesheet" href="{}"></head><body>'''.format(static_url("ttc_script.js"), static_url("ttc_css/style.css"))
 
 	def padLines(textmat):
 		maxLen = len(max(textmat, key=len))
@@ -51,22 +55,19 @@ def run(userinput, button):
 			output_str += printHtmlHeaders()
 			results = parseData(userinput)
 			output_str += ('<div class="container">\n')
-			output_str += ('<table>\n')
-			for line in results:
-				output_str += ('<tr>\n')
-				for char in line:
-					output_str += ('<td>{}</td>\n'.format(char))
-				output_str += ('</tr>\n')
-			output_str += ('<tr>\n')
+			# The page shows the table a screenful at a time, from the copy stored with its job (see jobs.views.show_table).
+			output_str += viewer_html(column_width=48)
+			output_str += ('</div>\n')
+			# The same columns as the input, which has no header, and the counts of each column's values last.
+			table = ResultTable([''] * len(results[0]), list(results))
+			counts = []
 			for column in range(len(results[0])):
 				inner = collections.Counter([x[column] for x in results])
 				collec_counts = ['{}:{}'.format(k,v) if k!='' else '' 
                  				for k,v in list(inner.items())]
-				output_str += ('<td>{}</td>\n').format(' '.join(collec_counts))
-			output_str += ('<tr>\n')
-			output_str += ('</table>\n')
-			output_str += ('</div>\n')
-			return (False, output_str)	
+				counts.append(' '.join(collec_counts))
+			table.append(counts)
+			return (False, TablePage(output_str, table))
 		
 		elif button == "dl":
 			results = parseData(userinput)
@@ -1,6 +1,11 @@
 from django.shortcuts import render
 from django.http import HttpResponse
 from django.template import Context, loader, RequestContext, Template
+from ..jobs.views import show_table
+import os, sys
+
+sys.path.append( os.environ.get('BBLAB_UTIL_PATH', 'fail') )
+import result_table
 
 def index(request):
     context = {}
@@ -27,9 +32,9 @@ def results(request):
         from . import text_to_columns
         output_t = text_to_columns.run(userinput, button)
         if output_t[0] == False:
-                template = Template(output_t[1])
-                context = RequestContext(request)
-                return HttpResponse(template.render(context))
+                if isinstance(output_t[1], result_table.TablePage):  # The results page and its table, which the page shows a part of at a time.
+                        return show_table("text_to_columns", output_t[1])
+                return HttpResponse(output_t[1])
         else:
                 response = HttpResponse(output_t[1], content_type="application/octet-stream")
                 response['Content-Disposition'] = 'attachment; filename={}'.format(output_t[2])
@@ -6,12 +6,33 @@ import sys, re, os
 sys.path.append( os.environ.get('BBLAB_UTIL_PATH', 'fail') )
 import sequence_utils
 import mailer
-
-# Add the path to openpyxl.
-sys.path.append( os.environ.get('BBLAB_LIB_PATH', 'fail') )
-from openpyxl import Workbook
-import openpyxl
 import web_output
+import xlsx_export
+
+
+def find_unique_sequences(fasta_list):
+	'''
+	Group the (name, dna sequence) tuples in fasta_list by identical sequence.
+	Returns two dicts, { dna sequence : [names] } and { amino acid sequence : [names] },
+	with the names in input order.  Each distinct dna sequence is only translated once.
+	'''
+	dna_sequences_dict = {}  # key = DNA sequence, value = list of dna sequence names.
+	amino_acid_sequences_dict = {}  # key = amino acid sequence, value = list of amino acid sequence names.
+	translations = {}  # key = DNA sequence, value = its amino acid sequence.
+
+	for name, dna_sequence in fasta_list:
+		names = dna_sequences_dict.get(dna_sequence)
+		if names is None:  # Case: first time this sequence is seen.
+			dna_sequences_dict[dna_sequence] = [name]
+			amino_acid_sequence = translations[dna_sequence] = sequence_utils.translate_nuc( dna_sequence, 0 )
+		else:
+			names.append(name)
+			amino_acid_sequence = translations[dna_sequence]
+
+		amino_acid_sequences_dict.setdefault(amino_acid_sequence, []).append(name)
+
+	return dna_sequences_dict, amino_acid_sequences_dict
+
 
 def run(fasta_data, desc_string, email_address_string):
 
@@ -23,21 +44,14 @@ def run(fasta_data, desc_string, email_address_string):
 	##### Get website input.
 	
 	analysis_id = desc_string
-	input_field_text = [e+'\n' for e in str( fasta_data ).replace('\r', '\n').replace('\n\n', '\n').split('\n') if e]
 	
 	try:
-		# Convert file to a list of tuples.
-		fasta_list = sequence_utils.convert_fasta( input_field_text )
+		# Read the text or uploaded file into a list of tuples, with the dna sequences converted to uppercase.
+		fasta_list = [ (header, sequence.upper()) for header, sequence in sequence_utils.iter_fasta( fasta_data ) ]
 	except Exception:
 		website.send_error("Failed to read fasta data,", " is something formatted wrong?")
 		return website.generate_site()		
 
-	# Convert the dna sequences to uppercase.
-	index = 0
-	for tup in fasta_list:
-		fasta_list[index] = (tup[0], tup[1].upper())
-		index += 1
-
 	
 	##### Validate Input
 
@@ -46,10 +60,13 @@ def run(fasta_data, desc_string, email_address_string):
 	send_error = False
 	char_messages = ""
 
+	valid_characters = set(sequence_utils.valid_protein_character_list)
 	for tup in fasta_list:
+		if set(tup[1]) <= valid_characters:  # Only walk the sequence when there is something to report.
+			continue
 		char_pos = 0
 		for char in tup[1]:
-			if (char in sequence_utils.valid_protein_character_list) == False:
+			if (char in valid_characters) == False:
 				send_error = True
 				char_messages += "<br><b>{}</b> was found at position {} of {}.".format(char, char_pos, tup[0])  # Report any invalid characters.
 			char_pos += 1
@@ -60,76 +77,17 @@ def run(fasta_data, desc_string, email_address_string):
 		return website.generate_site()
 
 
-	##### Fill the DNA sequence dictionary.
-	
-	
-	# key = DNA sequence, value = list of dna sequence names.
-	dna_sequences_dict = {}  # store all unique dna sequences and their name.
-	
-	# Iterate through all dna sequences and find the unique sequences.
-	for tuple in fasta_list:
-		is_sequence_unique = True
+	##### Fill the DNA and Amino Acid sequence dictionaries.
 
-		# Iterate through all the current unique dna sequences.
-		for key in dna_sequences_dict:
-			if tuple[1] == key:  # Case: current tuple is not unique.
-				dna_sequences_dict[key].append(tuple[0])  # Add the name for the current dna sequence to the list.
-	
-				# Processing of the current tuple is complete, sequence is not unique.
-				is_sequence_unique = False
-				continue
-	
-	    # Case: current tuple was found to be unique.
-		if is_sequence_unique == True:
-			sequence_index = len(dna_sequences_dict) + 1  # Find the sequence's id. (or index)
-			dna_sequences_dict[ tuple[1] ] = [ tuple[0] ]  # Add a dna sequence to the dict.
-	
-	
-	##### Fill the Amino Acid sequence dictionary.
-	
-	
-	# key = amino acid sequence, value = list of amino acid sequence names.
-	amino_acid_sequences_dict = {}  # store all unique dna sequences and their name.
-	
-	# Iterate through all dna sequences, convert them to amino acids, then find the unique sequences.
-	for tuple in fasta_list:
-		is_sequence_unique = True
-	
-		amino_acid_sequence = sequence_utils.translate_nuc( tuple[1], 0 )  # Convert the dna part of the sequence into an amino acid sequence.
-	
-		# Iterate through all the current unique amino acid sequences.
-		for key in amino_acid_sequences_dict:
-			if amino_acid_sequence == key:  # Case: current tuple is not unique.
-				amino_acid_sequences_dict[key].append(tuple[0])  # Add the name for the current amino acid sequence to the list.
-	
-				# Processing of the current tuple is complete, sequence is not unique.
-				is_sequence_unique = False
-				continue
-	
-		# Case: current tuple was found to be unique.
-		if is_sequence_unique == True:
-			sequence_index = len(amino_acid_sequences_dict) + 1  # Find the sequence's id. (or index)
-			amino_acid_sequences_dict[ amino_acid_sequence ] = [ tuple[0] ]  # Add a amino acid sequence to the dict and add the id at [0].
+
+	dna_sequences_dict, amino_acid_sequences_dict = find_unique_sequences(fasta_list)
 	
 	
 	##### Find most repetitions.
 	
 	
-	most_DNA_repetitions = 0  # This holds the most repetitions for any sequence.
-	for key, value in list( dna_sequences_dict.items() ):
-		repetitions = len(value)
-	
-		# Check for largest repetitions value.
-		if repetitions > most_DNA_repetitions:
-			most_DNA_repetitions = repetitions
-	
-	most_amino_acid_repetitions = 0  # This holds the most repetitions for any sequence.
-	for key, value in list( amino_acid_sequences_dict.items() ):
-		repetitions = len(value)
-	
-		# Check for largest repetitions value.
-		if repetitions > most_amino_acid_repetitions:
-			most_amino_acid_repetitions = repetitions 
+	most_DNA_repetitions = max( (len(value) for value in dna_sequences_dict.values()), default=0 )  # This holds the most repetitions for any sequence.
+	most_amino_acid_repetitions = max( (len(value) for value in amino_acid_sequences_dict.values()), default=0 )
 	
 	
 	##### Create an xlsx file.
@@ -137,12 +95,10 @@ def run(fasta_data, desc_string, email_address_string):
 	
 	XLSX_FILENAME = "_".join(s for s in ["unique_sequence_data", analysis_id] if s)
 	
-	wb = Workbook()  # Create a new workbook.
-	ws = wb.active  # Create a new page. (worksheet [ws])
-	ws.title = "DNA Sequences"
+	xlsx = xlsx_export.XlsxExport()  # Create a new workbook.
 	
-	# Create key row information.
-	ws.append( ["Number", "Frequency", "Sequence", "Sequence Length", "Unique Sequence ID"] + ["Duplicate Sequence ID" for i in range(1, most_DNA_repetitions)] )
+	# Create a new page with the key row information.
+	ws = xlsx.add_sheet( "DNA Sequences", ["Number", "Frequency", "Sequence", "Sequence Length", "Unique Sequence ID"] + ["Duplicate Sequence ID" for i in range(1, most_DNA_repetitions)] )
 	
 	# Create data row information.
 	index = 0
@@ -156,11 +112,8 @@ def run(fasta_data, desc_string, email_address_string):
 		
 		ws.append( [sequence_id, repetitions, dna_sequence, sequence_length] + identical_sequence_list )
 	
-	ws2 = wb.create_sheet("Mysheet")
-	ws2.title = "Amino Acid Sequences"
-	
 	# Create key row information.
-	ws2.append( ["Number", "Frequency", "Sequence", "Sequence Length", "Unique Sequence ID"] + ["Duplicate Sequence ID" for i in range(1, most_amino_acid_repetitions)] )
+	ws2 = xlsx.add_sheet( "Amino Acid Sequences", ["Number", "Frequency", "Sequence", "Sequence Length", "Unique Sequence ID"] + ["Duplicate Sequence ID" for i in range(1, most_amino_acid_repetitions)] )
 	
 	# Create data row information.
 	index = 0
@@ -174,9 +127,9 @@ def run(fasta_data, desc_string, email_address_string):
 		
 		ws2.append( [sequence_id, repetitions, amino_acid_sequence, sequence_length] + identical_sequence_list )
 	
-	# Save a string version of the excel workbook and send it to the file builder.
-	file_text = openpyxl.writer.excel.save_virtual_workbook(wb)
-	xlsx_file = mailer.create_file( XLSX_FILENAME, 'xlsx', file_text )
+	# Stream the workbook to a temporary file and send it to the file builder.
+	xlsx_file = xlsx.attachment( XLSX_FILENAME )
+	xlsx.close()
 
 	
 	##### Send an email with the xlsx file in it.
@@ -34,6 +34,7 @@ urlpatterns = [
 	path('tcr_visualizer/', include('tools.tcr_visualizer.urls')),
 	path('proviral_landscape_plot/', include('tools.proviral_landscape_plot.urls')),
 	path('isoforms_plot/', include('tools.isoforms_plot.urls')),
+	path('jobs/', include('tools.jobs.urls')),
 	path('', tool_redirect),
 ]
 
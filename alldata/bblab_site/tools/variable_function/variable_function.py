@@ -1,5 +1,7 @@
 # Checked for 3.7
-from scipy import stats
+import numpy
+import scipy
+from scipy import special, stats
 import cgi, sys, re, os
 
 """EXAMPLE OF VALID INPUT
@@ -9,6 +11,11 @@ A01\tA03\tB07\tB30\tC05\tC08\t0.3
 """
 sys.path.append( os.environ.get('BBLAB_UTIL_PATH', 'fail') )
 from math_utils import round_sf
+from result_table import ResultTable, TablePage, viewer_html
+from web_output import static_url
+import result_cache
+
+CACHE_VERSION = "1/scipy-" + scipy.__version__  # Change when the results for the same input change.
 
 def run(forminput, isCsv):
 
@@ -69,7 +76,8 @@ def run(forminput, isCsv):
 	# Note: this is our override of SciPy's _mwu_choose_method
 	#
 	# This functions identically to _mwu_choose_method in SciPy 1.7.3, 
-	# although it assumes x,y are (1-D) Python lists, not NumPy arrays.
+	# although it takes the sizes of the two groups and whether the
+	# values of both groups together have ties, not the groups.
 	#
 	# We use this to report whether thie MWU test was performed with 
 	# 'asymptotic' or 'exact' p-values, and stabilize our rules
@@ -77,60 +85,108 @@ def run(forminput, isCsv):
 	# or removes this internal method.
     # Update 2023-03-27: users now request that exact should be used when
 	# the smaller of the two groups is N<100
-	def mwu_choose_method(x, y):
+	def mwu_choose_method(n_x, n_y, ties):
 		# if the smaller of the two groups is > 99, use asymptotic
-		if min(len(x), len(y)) > 99:
+		if min(n_x, n_y) > 99:
 			return "asymptotic"
 		# if there are any ties, asymptotic is preferred
-		if len(x + y) != len(set(x + y)):
+		if ties:
 			return "asymptotic"
 		return "exact"	
 
-	def mannwhitneyu_category(result, category, stringify_p):
+	def mannwhitneyu_category(result, category):
 		pos = [float(x[-1]) for x in result if category in x[:-1]]
 		pos_median = median(pos)
 		neg = [float(x[-1]) for x in result if category not in x[:-1]]
 		neg_median = median(neg)
-		mwu_method = mwu_choose_method(pos, neg)
+		mwu_method = mwu_choose_method(len(pos), len(neg), len(pos + neg) != len(set(pos + neg)))
 		_, p = stats.mannwhitneyu(pos, neg, alternative='two-sided', method=mwu_method)
-		if stringify_p:
-			p = "{:.8f}".format(p)
 		return [len(pos), len(neg), pos_median, neg_median, p, mwu_method]
 
+	# The middle values of each row's samples, with the values sorted: the first sample where
+	# the row's running count (cumulative) passes the middle.
+	def medians(cumulative, counts, sorted_values):
+		low = sorted_values[numpy.argmax(cumulative > ((counts - 1) // 2)[:, None], axis=1)]
+		high = sorted_values[numpy.argmax(cumulative > (counts // 2)[:, None], axis=1)]
+		return [
+			"N/A" if count == 0 else a if count % 2 == 1 else round_sf((a + b) / 2.0, 15)
+			for count, a, b in zip(counts.tolist(), low.tolist(), high.tolist())
+		]
+
+	# Same results as mannwhitneyu_category for every category, but the values are ranked
+	# and sorted once, and the categories are tested together from a (category x sample)
+	# membership matrix, with the arithmetic of SciPy's asymptotic test (two-sided, with
+	# continuity correction). SciPy is only called for the exact tests, and for categories
+	# every sample has (no second group).
+	def mannwhitneyu_categories(result, categories):
+		values = numpy.array([float(x[-1]) for x in result])
+		if numpy.isnan(values).any():
+			return [[category, *mannwhitneyu_category(result, category)] for category in categories]
+		index = {category: i for i, category in enumerate(categories)}
+		member = numpy.zeros((len(categories), len(values)), dtype=bool)
+		for j, row in enumerate(result):
+			for category in row[:-1]:
+				if category:
+					member[index[category], j] = True
+
+		n = len(values)
+		n1 = member.sum(axis=1)
+		n2 = n - n1
+		_, tie_counts = numpy.unique(values, return_counts=True)
+		ties = tie_counts.max() > 1
+		tie_counts = tie_counts.astype(float)
+		tie_term = numpy.sum(tie_counts**3 - tie_counts)
+
+		R1 = member @ stats.rankdata(values)
+		U1 = R1 - n1*(n1+1)/2
+		U2 = n1 * n2 - U1
+		U = numpy.maximum(U1, U2)
+		with numpy.errstate(divide='ignore', invalid='ignore'):
+			s = numpy.sqrt(n1*n2/12 * ((n + 1) - tie_term/(n*(n-1))))
+			numerator = U - n1 * n2 / 2
+			numerator -= 0.5
+			z = numerator / s
+		p = special.ndtr(-z)
+		p *= 2
+		p = numpy.clip(p, 0., 1.)
+
+		order = numpy.argsort(values, kind='stable')
+		sorted_values = values[order]
+		pos_cumulative = numpy.cumsum(member[:, order], axis=1, dtype=numpy.int32)
+		pos_medians = medians(pos_cumulative, n1, sorted_values)
+		neg_medians = medians(numpy.arange(1, n + 1, dtype=numpy.int32) - pos_cumulative, n2, sorted_values)
+
+		rows = []
+		for i, category in enumerate(categories):
+			mwu_method = mwu_choose_method(n1[i], n2[i], ties)
+			p_value = p[i]
+			if mwu_method == "exact" or n2[i] == 0:
+				_, p_value = stats.mannwhitneyu(values[member[i]].tolist(), values[~member[i]].tolist(),
+					alternative='two-sided', method=mwu_method)
+			rows.append([category, int(n1[i]), int(n2[i]), pos_medians[i], neg_medians[i], p_value, mwu_method])
+		return rows
+
 	try:
+		# Fill the result table, one row per category (from the result cache when the same input was seen before).
+		rows = result_cache.cached("variable_function", CACHE_VERSION, "\n".join("\t".join(row) for row in result),
+			lambda: mannwhitneyu_categories(result, unique_categories))
+		table = ResultTable(["category", "n-with", "n-without", "median-with", "median-without", "p-value", "p-value-method"], rows)
+
 		# If the button clicked was not the "Download CSV" button then output HTML
 		if not isCsv:
 			### Regular Analysis
-			is_download = False
-			out_str += ("""{% load static %}<html><head>
-			<link rel="stylesheet" href="{% static "/jquery/themes/blue/style.css" %}">
-			<link rel="stylesheet" href="{% static "/vfa_css/style.css" %}">
-			<script src="//ajax.googleapis.com/ajax/libs/jquery/1.11.0/jquery.min.js"></script>
-			<script src="{% static "/jquery/jquery.tablesorter.js" %}"></script>
-			<script src="{% static "/jquery/myscript.js" %}"></script>
-			</head><body><div class="container">\n""")
-			
-			# The following is to print html
-			out_str += ("<table id='myTable' class='tablesorter'>")
-			out_str += ("""<thead><tr class="header"><th>category</th><th>n-with</th>
-			<th>n-without</th><th>median-with</th><th>median-without</th>
-			<th>p-value</th><th>p-value-method</th></tr></thead><tbody>""")
-			for category in unique_categories:
-				output = mannwhitneyu_category(result, category, True)
-				out_str += "<tr><td>" + "</td><td>".join(str(v) for v in [category, *output]) + "</td></tr>"
-			out_str += ("</tbody></table></body></div>")
-		
-		# The "Download CSV" button was pressed
-		else:
-			is_download = True	
+			out_str += ("""<html><head>
+			<link rel="stylesheet" href="{}">
+			</head><body><div class="container">\n""".format(static_url("/vfa_css/style.css")))
 			
-			# The following is to print csv style
-			out_str += ("category,n-with,n-without,median-with,median-without,p-value,p-value-method\r\n")
-			for category in unique_categories:
-				output = mannwhitneyu_category(result, category, False)
-				out_str += ",".join(str(v) for v in [category, *output]) + "\r\n"
+			# The page shows the table a screenful at a time, from the copy stored with its job (see jobs.views.show_table).
+			out_str += viewer_html()
+			out_str += ("</div></body></html>")
+			display = ResultTable(table.columns, [row[:5] + ["{:.8f}".format(row[5])] + row[6:] for row in table])
+			return (False, TablePage(out_str, display))
 		
-		return (is_download, out_str, "variable_function_output.csv")
+		# The "Download CSV" button was pressed, the view exports the table in the requested format.
+		return (True, table, "variable_function_output")
 	except ValueError as e:
 		return(False, f"""<b><span style=\"color:red;\">Error:</span></b> statistical test encountered an error with the given input. <br/>
 						Common issues are that the input data contains unique categories in each column, <br/>
@@ -1,6 +1,11 @@
 from django.shortcuts import render
 from django.http import HttpResponse
 from django.template import Context, loader, RequestContext, Template
+from ..jobs.views import show_table
+import os, sys
+
+sys.path.append( os.environ.get('BBLAB_UTIL_PATH', 'fail') )
+import result_table
 from django.contrib.auth.decorators import login_required
 
 def index(request):
@@ -28,12 +33,10 @@ def results(request):
         from . import variable_function
         output_t = variable_function.run(textinput, isCsv)
         if output_t[0] == False:  # output_t[0] == is_download
-            template = Template(output_t[1])
-            context = RequestContext(request)
-            return HttpResponse(template.render(context))
+            if isinstance(output_t[1], result_table.TablePage):  # The results page and its table, which the page shows a part of at a time.
+                return show_table("variable_function", output_t[1])
+            return HttpResponse(output_t[1])
         else:
-            response = HttpResponse(output_t[1], content_type="application/octet-stream")
-            response['Content-Disposition'] = 'attachment; filename={}'.format(output_t[2])
-            return response
+            return result_table.response(output_t[1], result_table.requested_format(data, "csv"), output_t[2])
     else:
         return HttpResponse("Please use the form to submit data.")